@@ -5,7 +5,16 @@ from cliff.lister import Lister
 from stevedore.extension import ExtensionManager
 import termcolor
 
-from .utils import get_plugin, get_plugin_class, get_plugin_options
+from .utils import (format_size, format_timestamp, get_plugin,
+                    get_plugin_class, get_plugin_options)
+
+
+def _report_write_stats(command, storage):
+    """Print counters of objects written to a storage by a command"""
+    stats = storage.write_stats
+    command.app.stdout.write(
+        'Objects written: {0}, skipped as unchanged: {1}\n'
+        .format(stats['written'], stats['skipped']))
 
 
 class PluginLister(Lister):
@@ -121,7 +130,9 @@ class Crawl(Command):
             'storage', parsed_args.storage,
             parsed_args.storage_option)
 
-        crawler.fetch_data(storage)
+        with storage.batch():
+            crawler.fetch_data(storage)
+        _report_write_stats(self, storage)
 
 
 class Convert(Command):
@@ -151,7 +162,9 @@ class Convert(Command):
             'storage', parsed_args.output,
             parsed_args.output_option)
 
-        converter.convert(storage_in, storage_out)
+        with storage_out.batch():
+            converter.convert(storage_in, storage_out)
+        _report_write_stats(self, storage_out)
 
 
 class Import(Command):
@@ -175,7 +188,9 @@ class Import(Command):
             'importer', parsed_args.importer,
             parsed_args.importer_option)
 
-        importer.sync_data(storage)
+        with storage.batch():
+            importer.sync_data(storage)
+        _report_write_stats(self, storage)
 
 
 class StorageInspect(Command):
@@ -206,22 +221,30 @@ class StorageInspect(Command):
             # self.app.stdout.write(''.join(('    ', text, '\n')))
             # self.app.stdout.write('=' * 70 + '\n')
 
-        def _get_table(hdr1='Bucket name', hdr2='Count'):
-            pt = PrettyTable([hdr1, hdr2])
-            pt.align[hdr1] = 'l'
-            pt.align[hdr2] = 'r'
+        def _get_table():
+            pt = PrettyTable(['Bucket name', 'Count', 'Size',
+                              'Last modified'])
+            pt.align['Bucket name'] = 'l'
+            pt.align['Count'] = 'r'
+            pt.align['Size'] = 'r'
             return pt
 
-        def _print_buckets_stats(objects):
-            items = sorted(objects.iteritems())
+        # Statistics come from metadata kept by storages, so we
+        # don't need to go through all the objects
+        stats = storage.stats()
+
+        def _print_buckets_stats(bucket_type):
+            items = sorted((name, st) for (type_, name), st
+                           in stats.iteritems() if type_ == bucket_type)
 
             if len(items) < 1:
                 self.app.stdout.write('None found.\n\n')
                 return
 
             pt = _get_table()
-            for name, objects in items:
-                pt.add_row((name, len(objects)))
+            for name, st in items:
+                pt.add_row((name, st.count, format_size(st.size),
+                            format_timestamp(st.last_modified)))
 
             self.app.stdout.write(str(pt) + '\n\n')
 
@@ -235,10 +258,97 @@ class StorageInspect(Command):
             self.app.stdout.write('None found.\n\n')
 
         _title('Documents')
-        _print_buckets_stats(storage.documents)
+        _print_buckets_stats('document')
 
         _title('Key/value')
-        _print_buckets_stats(storage.keyvals)
+        _print_buckets_stats('keyval')
 
         _title('Blobs')
-        _print_buckets_stats(storage.blobs)
+        _print_buckets_stats('blob')
+
+
+class StorageCopy(Command):
+    """copy all the data from a storage to another"""
+
+    logger = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(StorageCopy, self).get_parser(prog_name)
+        parser.add_argument('--input', help='input storage url')
+        parser.add_argument('--input-option', action='append')
+        parser.add_argument('--output', help='output storage url')
+        parser.add_argument('--output-option', action='append')
+        parser.add_argument(
+            '--jobs', type=int, default=4,
+            help='number of buckets to be copied in parallel')
+        parser.add_argument(
+            '--resume', action='store_true', default=False,
+            help='skip data copied by a previous, interrupted, run')
+        return parser
+
+    def take_action(self, parsed_args):
+        from prettytable import PrettyTable
+        from harvester.ext.storage.transfer import copy_storage
+
+        storage_in = get_plugin(
+            'storage', parsed_args.input,
+            parsed_args.input_option)
+        storage_out = get_plugin(
+            'storage', parsed_args.output,
+            parsed_args.output_option)
+
+        copied = copy_storage(storage_in, storage_out,
+                              jobs=parsed_args.jobs,
+                              resume=parsed_args.resume)
+
+        pt = PrettyTable(['Type', 'Bucket name', 'Copied'])
+        pt.align['Bucket name'] = 'l'
+        pt.align['Copied'] = 'r'
+        for row in copied:
+            pt.add_row(row)
+        self.app.stdout.write(str(pt) + '\n')
+        _report_write_stats(self, storage_out)
+
+
+class StorageDiff(Lister):
+    """list differences between two storages"""
+
+    logger = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(StorageDiff, self).get_parser(prog_name)
+        parser.add_argument('--old', help='url of the old storage')
+        parser.add_argument('--old-option', action='append')
+        parser.add_argument('--new', help='url of the new storage')
+        parser.add_argument('--new-option', action='append')
+        parser.add_argument(
+            '--summary', action='store_true', default=False,
+            help='only show counts of changed objects, per bucket')
+        return parser
+
+    def take_action(self, parsed_args):
+        from harvester.ext.storage.diff import (
+            ADDED, CHANGED, REMOVED, diff_storages)
+
+        storage_old = get_plugin(
+            'storage', parsed_args.old,
+            parsed_args.old_option)
+        storage_new = get_plugin(
+            'storage', parsed_args.new,
+            parsed_args.new_option)
+
+        diffs = sorted(diff_storages(storage_old, storage_new).iteritems())
+
+        if parsed_args.summary:
+            rows = [(bucket_type, name, len(diff.added), len(diff.removed),
+                     len(diff.changed))
+                    for (bucket_type, name), diff in diffs]
+            return (('Type', 'Bucket name', 'Added', 'Removed', 'Changed'),
+                    rows)
+
+        rows = []
+        for (bucket_type, name), diff in diffs:
+            for status in (ADDED, REMOVED, CHANGED):
+                for key in getattr(diff, status):
+                    rows.append((bucket_type, name, status, key))
+        return (('Type', 'Bucket name', 'Status', 'Key'), rows)
@@ -1,4 +1,10 @@
 import collections
+import contextlib
+import hashlib
+import heapq
+import io
+import json
+import tempfile
 
 from ..base import PluginBase
 
@@ -11,6 +17,53 @@ class NotFound(StorageError):
     pass
 
 
+#: Suffix appended to bucket names by ``BaseBucketManager.staging()``
+STAGING_SUFFIX = '__staging'
+
+#: A change to an object, as returned by ``iter_changed_since()``
+Change = collections.namedtuple('Change', 'key seq timestamp deleted')
+
+#: Statistics about a bucket, as returned by ``stats()``: number of
+#: objects, their total size in bytes, timestamp of the last change
+#: (either of the last two is None when not known)
+BucketStats = collections.namedtuple(
+    'BucketStats', 'count size last_modified')
+
+#: Bucket types, with the name of the corresponding storage attribute
+BUCKET_MANAGERS = (
+    ('document', 'documents'),
+    ('keyval', 'keyvals'),
+    ('blob', 'blobs'),
+)
+
+
+def iter_chunks(iterable, size):
+    """Split an iterable in lists of (at most) ``size`` items"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def content_hash(data):
+    """Hash of some binary content (eg. a blob), as hex string"""
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def document_hash(obj):
+    """
+    Hash of a json-serializable object. Keys are sorted, so equal
+    objects get the same hash whatever storage they come from.
+    """
+    return content_hash(json.dumps(obj, sort_keys=True))
+
+
 class BaseStorage(PluginBase):
     """
     Storages expose a common API to store data in
@@ -30,6 +83,30 @@ class BaseStorage(PluginBase):
     storage.blobs <-- dict-like
     storage.keyval <-- dict-like
     storage.info <-- dict-like (alias for ``.keyval['info']``)
+
+    Writes can be grouped using the ``batch()`` context manager::
+
+        with storage.batch():
+            for key, obj in objects:
+                storage.documents['dataset'][key] = obj
+
+    Backends supporting it (eg. SQLite) will then group writes in
+    large transactions, instead of committing each object separately.
+
+    Buckets can be rebuilt from scratch in a staging bucket, replacing
+    the original one only once complete::
+
+        with storage.documents.staging('dataset') as bucket:
+            for key, obj in objects:
+                bucket[key] = obj
+
+    Backends supporting it (eg. SQLite, MongoDB) swap buckets with a
+    rename, so that readers never see a partially written bucket.
+
+    Storages can be passed to worker processes (eg. using
+    ``multiprocessing``): only the URL and configuration are pickled,
+    and connections are opened again in each process, forked ones
+    included. Backends must not share connections across processes.
     """
 
     document_bucket_class = None
@@ -39,6 +116,12 @@ class BaseStorage(PluginBase):
     options = [
         ('clean_first', 'bool', False,
          'If set to True, will flush database before proceeding'),
+        ('codec', 'str', None,
+         'Compression codec for blobs: zlib, lzma, zstd (if available)'),
+        ('blob_store', 'str', None,
+         'URL of a storage keeping blob contents, deduplicated by hash'),
+        ('skip_unchanged', 'bool', False,
+         'Skip writing documents and blobs equal to the stored ones'),
     ]
 
     def __init__(self, url=None, conf=None):
@@ -52,6 +135,9 @@ class BaseStorage(PluginBase):
 
     @property
     def blobs(self):
+        if self.conf.get('blob_store'):
+            from .cas import ContentAddressedBlobBucket
+            return BaseBucketManager(self, ContentAddressedBlobBucket)
         return BaseBucketManager(self, self.blob_bucket_class)
 
     @property
@@ -66,6 +152,71 @@ class BaseStorage(PluginBase):
         raise NotImplementedError(
             "This storage does not support flushing")
 
+    def reopen(self):
+        """
+        Get another instance of this storage, pointing to the same data,
+        with its own connections (eg. to be used from another thread).
+        """
+        conf = dict(self.conf)
+        conf.pop('clean_first', None)
+        return self.__class__(self.url, conf)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager to group writes performed inside the block.
+
+        Blocks can be nested: pending writes will be flushed when
+        exiting the outermost one (even in case of exceptions, as
+        we want to keep whatever was stored until then).
+        """
+        self._batch_depth = getattr(self, '_batch_depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    @property
+    def in_batch(self):
+        """Whether we are currently inside a ``batch()`` block"""
+        return getattr(self, '_batch_depth', 0) > 0
+
+    def flush(self):
+        """
+        Make sure all the pending writes reached the backend.
+        Storages not buffering writes don't need to override this.
+        """
+        pass
+
+    def stats(self, bucket_types=None):
+        """
+        Get statistics about all the buckets (see ``BaseBucket.stats()``).
+
+        :param bucket_types: bucket types to include (default: all)
+        :return: a dict mapping ``(bucket_type, name)`` to
+            :py:class:`BucketStats`
+        """
+        result = {}
+        for bucket_type, manager_name in BUCKET_MANAGERS:
+            if bucket_types is not None and bucket_type not in bucket_types:
+                continue
+            manager = getattr(self, manager_name)
+            for name in manager:
+                result[bucket_type, name] = manager[name].stats()
+        return result
+
+    @property
+    def write_stats(self):
+        """
+        Counters of documents and blobs ``written`` and ``skipped``
+        (as unchanged, see the ``skip_unchanged`` option) so far.
+        """
+        if getattr(self, '_write_stats', None) is None:
+            self._write_stats = {'written': 0, 'skipped': 0}
+        return self._write_stats
+
 
 class BaseBucketManager(collections.MutableMapping):
     """
@@ -74,7 +225,8 @@ class BaseBucketManager(collections.MutableMapping):
     parent storage + requested name.
 
     It also allow listing buckets of a given type, by calling
-    the ``list_buckets()`` class method.
+    the ``list_buckets()`` class method (staging buckets, see
+    ``staging()``, are left out).
     """
 
     def __init__(self, storage, bucket_class):
@@ -91,11 +243,43 @@ class BaseBucketManager(collections.MutableMapping):
         raise NotImplementedError("Deleting a bucket is not supported")
 
     def __iter__(self):
-        return self.bucket_class.list_buckets(self.storage)
+        # Staging buckets are an implementation detail
+        for name in self.bucket_class.list_buckets(self.storage):
+            if not name.endswith(STAGING_SUFFIX):
+                yield name
 
     def __len__(self):
         return len(list(self.__iter__()))
 
+    def replace(self, name, source_name):
+        """
+        Replace the contents of a bucket with the ones of another
+        bucket, which is left empty (see ``BaseBucket.replace_bucket()``).
+        """
+        self.storage.flush()
+        self.bucket_class.replace_bucket(self.storage, name, source_name)
+
+    @contextlib.contextmanager
+    def staging(self, name):
+        """
+        Context manager yielding an empty staging bucket, which replaces
+        bucket ``name`` when the block exits. If the block raises an
+        exception, the staging bucket is cleared instead, leaving the
+        original bucket untouched.
+        """
+        staging_name = name + STAGING_SUFFIX
+        bucket = self[staging_name]
+        bucket.clear()
+        completed = False
+        try:
+            with self.storage.batch():
+                yield bucket
+            completed = True
+        finally:
+            if not completed:
+                bucket.clear()
+        self.replace(name, staging_name)
+
 
 class BaseBucket(collections.MutableMapping):
     """
@@ -106,8 +290,15 @@ class BaseBucket(collections.MutableMapping):
 
     - classmethod: list_buckets(cls, storage)
     - __getitem__, __setitem__, __delitem__, __iter__, __len__
+
+    Backends should also override ``iter_items()`` in order to
+    retrieve objects in batches, instead of one query per key.
     """
 
+    #: Whether the backend keeps the hashes of written objects (see
+    #: ``iter_hashes()``), so they must be computed on every write
+    _keeps_hashes = False
+
     def __init__(self, storage, name):
         self.storage = storage
         self.name = name
@@ -117,20 +308,499 @@ class BaseBucket(collections.MutableMapping):
         """List buckets of this type in a given storage"""
         raise NotImplementedError
 
+    def iter_items(self, batch_size=500, fields=None):
+        """
+        Iterate ``(key, value)`` pairs for all the objects in the bucket.
+
+        The default implementation retrieves objects one by one;
+        backends should override this to fetch objects in batches.
+
+        :param batch_size: number of objects to fetch at once
+        :param fields: for documents only, the field paths to get
+            (see ``BaseDocumentBucket.get()``)
+        """
+        projection = self._get_projection(fields)
+        for key in self:
+            yield key, self._project(self[key], projection)
+
+    def _get_projection(self, fields):
+        """Get a :py:class:`Projection` on fields (None for all fields)"""
+        if fields is not None:
+            raise ValueError("Only documents can be read by field")
+        return None
+
+    def _project(self, value, projection):
+        if projection is None:
+            return value
+        return projection(value)
+
+    def keys_page(self, after=None, limit=50):
+        """
+        Get a page of keys, in sorted order, for keyset pagination::
+
+            keys = bucket.keys_page(limit=50)
+            while keys:
+                ...
+                keys = bucket.keys_page(after=keys[-1], limit=50)
+
+        Unlike slicing ``keys()``, the cost of getting a page doesn't
+        depend on its position. The default implementation scans all
+        the keys; backends should override this to look up the range
+        in an index.
+
+        :param after: only return keys greater than this one
+        :param limit: maximum number of keys to return
+        :return: a list of keys
+        """
+        keys = iter(self)
+        if after is not None:
+            keys = (key for key in keys if key > after)
+        return heapq.nsmallest(limit, keys)
+
+    def iteritems(self):
+        return self.iter_items()
+
+    def itervalues(self):
+        for key, value in self.iter_items():
+            yield value
+
+    def items(self):
+        return list(self.iter_items())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def batch(self):
+        """Shortcut for the parent storage ``batch()``"""
+        return self.storage.batch()
+
+    def iter_hashes(self):
+        """
+        Iterate ``(key, hash)`` pairs for all the objects in the bucket,
+        sorted by key (used to quickly compare buckets).
+
+        Backends should keep hashes, updated on write, in order to
+        avoid loading objects; the default implementation computes
+        them from the objects.
+        """
+        for key in sorted(self):
+            yield key, self._hash_value(self[key])
+
+    def _hash_value(self, value):
+        return document_hash(value)
+
+    def _get_stored_hash(self, key):
+        """
+        Get the hash of the stored object, or None if missing.
+        Backends keeping hashes should override this.
+        """
+        if key not in self:
+            return None
+        return self._hash_value(self[key])
+
+    def _get_write_hash(self, value):
+        """
+        Get the hash of an object about to be written, or None if
+        not needed (ie. not kept by the backend, nor used to skip
+        unchanged objects).
+        """
+        if self._keeps_hashes or self.storage.conf.get('skip_unchanged'):
+            return self._hash_value(value)
+        return None
+
+    def _skip_write(self, key, hash):
+        """
+        Check whether writing an object (with the given hash, from
+        ``_get_write_hash()``) can be skipped, as unchanged; also
+        updates the storage write counters.
+        """
+        stats = self.storage.write_stats
+        skip_unchanged = self.storage.conf.get('skip_unchanged', False)
+        if skip_unchanged and hash == self._get_stored_hash(key):
+            stats['skipped'] += 1
+            return True
+        stats['written'] += 1
+        return False
+
+    def stats(self):
+        """
+        Get statistics about the bucket, as :py:class:`BucketStats`.
+
+        Sizes are the ones of stored objects (eg. after compression).
+        The default implementation just counts objects; backends should
+        override this to use metadata they keep, without loading objects.
+        """
+        return BucketStats(len(self), None, None)
+
+    def iter_changed_since(self, seq=0):
+        """
+        Iterate the objects written or deleted after a given sequence
+        number, as :py:class:`Change` tuples, ordered by sequence.
+
+        Only the last change to each key is reported; deletions are
+        reported with ``deleted=True``. Pass the largest ``seq`` seen
+        to the next call, in order to get just the new changes.
+
+        :param seq: sequence number of the last change already seen
+        """
+        raise NotImplementedError(
+            "This storage does not support change tracking")
+
+    def update_many(self, items):
+        """
+        Store many objects at once, inside a ``batch()`` block.
+
+        :param items: a dict-like, or an iterable of ``(key, value)``
+        """
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        with self.batch():
+            for key, value in items:
+                self[key] = value
+
+    def get_many(self, keys):
+        """
+        Get many objects at once, eg. to join two buckets::
+
+            docs = dict(documents.iter_items())
+            blobs = resources.get_many(docs)
+
+        The default implementation retrieves objects one by one;
+        backends should override this to fetch them in a few queries.
+
+        :param keys: an iterable of keys
+        :return: a dict mapping keys to objects (missing keys
+            are left out)
+        """
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self[key]
+            except NotFound:
+                pass
+        return result
+
+    def delete_many(self, keys):
+        """
+        Delete many objects at once, inside a ``batch()`` block;
+        missing keys are ignored.
+
+        :param keys: an iterable of keys
+        """
+        with self.batch():
+            for key in keys:
+                try:
+                    del self[key]
+                except NotFound:
+                    pass
+
+    def clear(self):
+        """
+        Delete all the objects in the bucket.
+
+        The default implementation deletes them by key, using
+        ``delete_many()``; backends should override this to empty
+        the whole bucket at once.
+        """
+        self.delete_many(list(self))
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        """
+        Replace the contents of bucket ``name`` with the ones of bucket
+        ``source_name``, which is left empty. Changes are recorded for
+        the objects added, changed or removed in bucket ``name``.
+
+        The default implementation copies objects over, then deletes
+        the ones missing from the source: readers might see a mix of
+        old and new objects meanwhile. Backends should override this
+        to swap buckets atomically (eg. renaming tables).
+        """
+        target, source = cls(storage, name), cls(storage, source_name)
+        keys = set()
+
+        def _iter_items():
+            for key, value in source.iter_items():
+                keys.add(key)
+                # Unchanged objects are left alone
+                if target._hash_value(value) != target._get_stored_hash(key):
+                    yield key, value
+
+        target.update_many(_iter_items())
+        target.delete_many([key for key in target if key not in keys])
+        source.clear()
+
 
 class BaseDocumentBucket(BaseBucket):
-    """Base for "document" buckets"""
-    pass
+    """
+    Base for "document" buckets.
+
+    Documents can be looked up by field values, using ``find()``;
+    fields used often should be indexed first::
+
+        bucket.create_index('tags.name')
+        for key, doc in bucket.find(tags__name='energia'):
+            ...
+    """
+
+    def get(self, key, default=None, fields=None):
+        """
+        Get a document, or ``default`` if missing.
+
+        :param fields: (dotted) paths of the fields to get, eg.
+            ``['title', 'resources.url']``: other fields are left out,
+            and the backend might not even read them (see
+            :py:class:`Projection`)
+        """
+        try:
+            doc = self[key]
+        except (KeyError, NotFound):
+            return default
+        return self._project(doc, self._get_projection(fields))
+
+    def _get_projection(self, fields):
+        if fields is None:
+            return None
+        return Projection(fields)
+
+    def create_index(self, path):
+        """
+        Create an index on a (dotted) field path, if not there already.
+
+        As for MongoDB multikey indexes, when the path traverses lists,
+        each of their items gets indexed.
+
+        The default implementation does nothing, and ``find()``
+        will scan the whole bucket.
+        """
+        pass
+
+    def find(self, criteria=None, **kwargs):
+        """
+        Iterate ``(key, document)`` pairs for documents matching all
+        the criteria.
+
+        :param criteria: a dict mapping dotted field paths to values
+        :param kwargs: more criteria, using ``__`` instead of dots
+            in paths (eg. ``organization__name='pat'``)
+
+        A field matches if its value is equal to the given one or, if
+        it is a list (or the path traverses lists), if any of the
+        items is equal to it.
+        """
+        criteria = prepare_criteria(criteria, kwargs)
+        for key, doc in self.iter_items():
+            if match_criteria(doc, criteria):
+                yield key, doc
+
+
+def prepare_criteria(criteria, kwargs):
+    """Merge ``find()`` criteria, converting ``__`` to dots in kwargs"""
+    result = dict(criteria or {})
+    for key, value in kwargs.iteritems():
+        result[key.replace('__', '.')] = value
+    return result
+
+
+def normalize_fields(fields):
+    """
+    Get a sorted list of field paths for projections, leaving out the
+    ones already included in others (eg. ``a.b``, when ``a`` is there).
+    """
+    if isinstance(fields, basestring):
+        fields = [fields]
+    result = []
+    for path in sorted(set(fields)):
+        if not any(path.startswith(other + '.') for other in result):
+            result.append(path)
+    return result
+
+
+class Projection(object):
+    """
+    Projection of documents on some (dotted) field paths, working the
+    same way as MongoDB ones: lists along the way are traversed,
+    keeping only their dict items, and fields missing from documents
+    are left out (rather than set to ``None``).
+
+    Instances are callables, taking a document and returning the
+    projected one.
+    """
+
+    def __init__(self, fields):
+        self.fields = normalize_fields(fields)
+        self._tree = {}
+        for path in self.fields:
+            parts = path.split('.')
+            node = self._tree
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = None  # The whole field
+
+    @property
+    def names(self):
+        """The top-level fields involved"""
+        return sorted(self._tree)
+
+    def __call__(self, doc):
+        return _project_value(doc, self._tree)
+
+
+def project_document(doc, fields):
+    """Keep only some (dotted) field paths of a document"""
+    return Projection(fields)(doc)
+
+
+def _project_value(value, tree):
+    if isinstance(value, list):
+        return [_project_value(item, tree) for item in value
+                if isinstance(item, (dict, list))]
+    result = {}
+    for name, subtree in tree.iteritems():
+        if name not in value:
+            continue
+        if subtree is None:
+            result[name] = value[name]
+        elif isinstance(value[name], (dict, list)):
+            result[name] = _project_value(value[name], subtree)
+    return result
+
+
+def get_field_values(doc, path):
+    """
+    Get all the values found at a dotted path in a document,
+    expanding lists along the way (the same way MongoDB does).
+    """
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            items = value if isinstance(value, list) else [value]
+            for item in items:
+                if isinstance(item, dict) and part in item:
+                    found.append(item[part])
+        values = found
+
+    result = []
+    for value in values:
+        result.append(value)
+        if isinstance(value, list):
+            result.extend(value)
+    return result
+
+
+def match_criteria(doc, criteria):
+    """Check whether a document matches all the ``find()`` criteria"""
+    for path, expected in criteria.iteritems():
+        key = index_key(expected)
+        if not any(index_key(v) == key
+                   for v in get_field_values(doc, path)):
+            return False
+    return True
+
+
+def index_key(value):
+    """
+    Get a key suitable for indexing a field value; json is used so that
+    values of different types never match (eg. ``1`` and ``True``).
+    """
+    return json.dumps(value, sort_keys=True)
 
 
 class BaseBlobBucket(BaseBucket):
-    """Base for "blob" buckets"""
-    pass
+    """
+    Base for "blob" buckets.
+
+    Apart from the dict-like interface, blobs can be accessed as
+    file-like objects, in order to process large objects in chunks::
+
+        with bucket.open_write('key') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+
+        with bucket.open_read('key') as fp:
+            data = fp.read(4096)
+    """
+
+    def open_read(self, key):
+        """
+        Open a blob for reading.
+
+        The default implementation loads the whole object in memory;
+        backends supporting it should return a streaming file object.
+
+        :raises NotFound: if the blob doesn't exist
+        """
+        return io.BytesIO(self[key])
+
+    def _hash_value(self, value):
+        return content_hash(value)
+
+    def open_write(self, key):
+        """
+        Open a blob for writing.
+
+        The blob will be stored when the returned file object is
+        closed; if the ``with`` block exits with an exception, the
+        write is discarded.
+        """
+        return BlobWriter(self, key)
+
+
+class BlobWriter(object):
+    """
+    File-like object returned by the default ``open_write()``.
+
+    Written data is spooled to a temporary file (kept in memory
+    until it reaches ``spool_size``), then stored in the bucket
+    when the file is closed.
+    """
+
+    spool_size = 4 * 1024 * 1024
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.closed = False
+        self._file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.seek(0)
+        self._store(self._file)
+        self._file.close()
+
+    def abort(self):
+        """Close the file, without storing anything"""
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+
+    def _store(self, fileobj):
+        self.bucket[self.key] = fileobj.read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
 
 class BaseKeyvalBucket(BaseBucket):
     """Base for "keyval" buckets"""
-    pass
+
+    def _skip_write(self, key, hash):
+        # Keyvals are small, and not counted as data
+        return False
 
 
 BaseStorage.document_bucket_class = BaseDocumentBucket
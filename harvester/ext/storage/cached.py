@@ -0,0 +1,369 @@
+"""
+Read-through caching wrapper for another storage.
+
+Storage URLs look like ``cached+<url of the wrapped storage>``, eg.
+``cached+sqlite+file:///tmp/data.sqlite``; options other than
+``cache_size`` are passed to the wrapped storage.
+
+- Documents and blobs read by key are kept in a LRU cache, bounded
+  by the total size in bytes (documents are cached as json)
+- Writes and deletions go straight to the wrapped storage, dropping
+  the cached copy
+- Bulk iteration (``iter_items()`` and friends) and keyvals are not
+  cached, as they would just flush the cache
+- Clearing or replacing a bucket drops the whole cache
+
+The cache is shared by all the instances wrapping the same URL, with
+the same ``cache_size``, in a process (eg. across the requests handled
+by the storage explorer); instances with a different ``cache_size``
+get a cache of their own. Changes made by other processes are not
+seen until objects get evicted.
+"""
+
+import contextlib
+import io
+import json
+import threading
+
+from harvester.utils import get_storage_direct, lazy_property
+from .base import (BaseStorage, BaseBucketManager, BaseBucket,
+                   BaseDocumentBucket, BaseBlobBucket, project_document)
+
+
+DEFAULT_CACHE_SIZE = 64 * 2 ** 20
+
+_MISSING = object()
+
+
+# Fields of the linked list nodes used by LRUCache
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache for strings, bounded by total size.
+
+    Entries are kept in a dict, and in a circular doubly linked list
+    ordered by last use (oldest first), as OrderedDict is not available
+    on Python 2.6.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = {}  # key -> [prev, next, key, value]
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+
+    def _link_last(self, node):
+        last = self._root[_PREV]
+        node[_PREV], node[_NEXT] = last, self._root
+        last[_NEXT] = self._root[_PREV] = node
+
+    def _unlink(self, node):
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+
+    def get(self, key, default=_MISSING):
+        with self._lock:
+            node = self._data.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+            self._unlink(node)
+            self._link_last(node)
+            self.hits += 1
+            return node[_VALUE]
+
+    def put(self, key, value):
+        if len(value) > self.max_size:
+            return  # Would evict everything else
+        with self._lock:
+            self._discard(key)
+            node = [None, None, key, value]
+            self._link_last(node)
+            self._data[key] = node
+            self.size += len(value)
+            while self.size > self.max_size:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._data[oldest[_KEY]]
+                self.size -= len(oldest[_VALUE])
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        node = self._data.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+            self.size -= len(node[_VALUE])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'count': len(self._data),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _get_shared_cache(url, max_size):
+    key = (url, max_size)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = LRUCache(max_size)
+        return _caches[key]
+
+
+class CachedStorage(BaseStorage):
+    options = [
+        ('cache_size', 'int', DEFAULT_CACHE_SIZE,
+         'Maximum size of cached objects, in bytes'),
+    ]
+
+    @lazy_property
+    def backend(self):
+        """The wrapped storage"""
+        if not self.url:
+            raise ValueError("The url of the wrapped storage is required")
+        conf = dict(self.conf)
+        conf.pop('cache_size', None)
+        conf.pop('clean_first', None)  # Already taken care of
+        return get_storage_direct(self.url, conf)
+
+    @lazy_property
+    def cache(self):
+        return _get_shared_cache(
+            self.url, self.conf.get('cache_size', DEFAULT_CACHE_SIZE))
+
+    @property
+    def documents(self):
+        return BaseBucketManager(self, CachedDocumentBucket)
+
+    @property
+    def blobs(self):
+        return BaseBucketManager(self, CachedBlobBucket)
+
+    @property
+    def keyvals(self):
+        return self.backend.keyvals
+
+    @property
+    def write_stats(self):
+        return self.backend.write_stats
+
+    def cache_stats(self):
+        """
+        Get cache counters, as a dict with keys: ``hits``, ``misses``,
+        ``evictions``, ``count``, ``size`` and ``max_size``.
+        """
+        return self.cache.stats()
+
+    @contextlib.contextmanager
+    def batch(self):
+        with super(CachedStorage, self).batch():
+            with self.backend.batch():
+                yield self
+
+    def flush(self):
+        self.backend.flush()
+
+    def flush_storage(self):
+        self.backend.flush_storage()
+        self.cache.clear()
+
+
+class BaseCachedBucket(BaseBucket):
+    bucket_type = None  # to be overwritten in subclasses
+    manager_name = None
+
+    def __init__(self, storage, name):
+        super(BaseCachedBucket, self).__init__(storage, name)
+        self._backend = getattr(storage.backend, self.manager_name)[name]
+
+    @classmethod
+    def list_buckets(cls, storage):
+        return iter(getattr(storage.backend, cls.manager_name))
+
+    def _cache_key(self, key):
+        return (self.bucket_type, self.name, key)
+
+    def __iter__(self):
+        return iter(self._backend)
+
+    def __len__(self):
+        return len(self._backend)
+
+    def __contains__(self, key):
+        cached = self.storage.cache.get(self._cache_key(key))
+        if cached is not _MISSING:
+            return True
+        return key in self._backend
+
+    def __getitem__(self, key):
+        cache_key = self._cache_key(key)
+        cached = self.storage.cache.get(cache_key)
+        if cached is not _MISSING:
+            return self._deserialize(cached)
+        value = self._backend[key]
+        self.storage.cache.put(cache_key, self._serialize(value))
+        return value
+
+    def __setitem__(self, key, value):
+        self.storage.cache.discard(self._cache_key(key))
+        self._backend[key] = value
+
+    def __delitem__(self, key):
+        self.storage.cache.discard(self._cache_key(key))
+        del self._backend[key]
+
+    def get_many(self, keys):
+        result, missing = {}, []
+        for key in keys:
+            cached = self.storage.cache.get(self._cache_key(key))
+            if cached is _MISSING:
+                missing.append(key)
+            else:
+                result[key] = self._deserialize(cached)
+
+        if missing:
+            for key, value in self._backend.get_many(missing).iteritems():
+                self.storage.cache.put(
+                    self._cache_key(key), self._serialize(value))
+                result[key] = value
+        return result
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self.storage.cache.discard(self._cache_key(key))
+        self._backend.delete_many(keys)
+
+    def clear(self):
+        # Cache keys can't be looked up by bucket: drop them all
+        self._backend.clear()
+        self.storage.cache.clear()
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        getattr(storage.backend, cls.manager_name).replace(
+            name, source_name)
+        storage.cache.clear()
+
+    def keys_page(self, after=None, limit=50):
+        return self._backend.keys_page(after=after, limit=limit)
+
+    def stats(self):
+        return self._backend.stats()
+
+    def iter_items(self, batch_size=500, fields=None):
+        return self._backend.iter_items(batch_size=batch_size, fields=fields)
+
+    def iter_changed_since(self, seq=0):
+        return self._backend.iter_changed_since(seq)
+
+    def iter_hashes(self):
+        return self._backend.iter_hashes()
+
+    def _serialize(self, value):
+        return value
+
+    def _deserialize(self, value):
+        return value
+
+
+class CachedDocumentBucket(BaseCachedBucket, BaseDocumentBucket):
+    bucket_type = 'document'
+    manager_name = 'documents'
+
+    def _serialize(self, value):
+        # Keeping json makes sizes easy to compute, and makes sure
+        # callers never share mutable objects
+        return json.dumps(value)
+
+    def _deserialize(self, value):
+        return json.loads(value)
+
+    def get(self, key, default=None, fields=None):
+        if fields is None:
+            return super(CachedDocumentBucket, self).get(key, default)
+        # Partial documents are not cached, nor worth fetching whole
+        cached = self.storage.cache.get(self._cache_key(key))
+        if cached is not _MISSING:
+            return project_document(self._deserialize(cached), fields)
+        return self._backend.get(key, default, fields=fields)
+
+    def create_index(self, path):
+        self._backend.create_index(path)
+
+    def find(self, criteria=None, **kwargs):
+        return self._backend.find(criteria, **kwargs)
+
+
+class CachedBlobBucket(BaseCachedBucket, BaseBlobBucket):
+    bucket_type = 'blob'
+    manager_name = 'blobs'
+
+    def open_read(self, key):
+        cached = self.storage.cache.get(self._cache_key(key))
+        if cached is not _MISSING:
+            return io.BytesIO(cached)
+        return self._backend.open_read(key)
+
+    def open_write(self, key):
+        return CachedBlobWriter(self, key, self._backend.open_write(key))
+
+
+class CachedBlobWriter(object):
+    """Wrap a blob writer, dropping the cached copy once written"""
+
+    def __init__(self, bucket, key, fp):
+        self.bucket = bucket
+        self.key = key
+        self._fp = fp
+
+    @property
+    def closed(self):
+        return self._fp.closed
+
+    def write(self, data):
+        self._fp.write(data)
+
+    def close(self):
+        try:
+            self._fp.close()
+        finally:
+            self.bucket.storage.cache.discard(
+                self.bucket._cache_key(self.key))
+
+    def abort(self):
+        self._fp.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,197 @@
+"""
+Content-addressed blob storage.
+
+When the ``blob_store`` option is set on a storage, blob contents
+are kept in the ``sha256`` blob bucket of that (separate) storage,
+keyed by their SHA-256 hex digest; the storage's own blob buckets
+only contain small references to them::
+
+    '\\x00HVREF' + <hex digest>
+
+Identical payloads are therefore stored only once, even across
+different storages sharing the same ``blob_store`` (eg. harvest
+runs writing to a fresh storage each time).
+
+Blobs stored before enabling the option are returned as-is: only
+values made of the header followed by a SHA-256 hex digest are taken
+as references.
+Contents are never deleted when references are removed, as they
+might still be referenced by other storages.
+"""
+
+import hashlib
+
+from .base import BaseBlobBucket, BlobWriter
+
+
+REF_MAGIC = '\x00HVREF'
+REF_SIZE = len(REF_MAGIC) + hashlib.sha256().digest_size * 2
+CONTENTS_BUCKET = 'sha256'
+COPY_CHUNK_SIZE = 256 * 1024
+
+_HEX_DIGITS = '0123456789abcdef'
+
+
+def _make_ref(digest):
+    return REF_MAGIC + digest
+
+
+def _parse_ref(value):
+    """Return the digest from a reference, or None for plain values"""
+    if len(value) != REF_SIZE or not value.startswith(REF_MAGIC):
+        return None
+    digest = value[len(REF_MAGIC):]
+    if digest.strip(_HEX_DIGITS):
+        return None
+    return digest
+
+
+def get_blob_store(storage):
+    """Get the storage holding blob contents for ``storage``"""
+    if getattr(storage, '_cached_blob_store', None) is None:
+        from harvester.utils import get_storage_direct
+        storage._cached_blob_store = get_storage_direct(
+            storage.conf['blob_store'],
+            {'codec': storage.conf.get('codec')})
+    return storage._cached_blob_store
+
+
+class ContentAddressedBlobBucket(BaseBlobBucket):
+    """
+    Blob bucket storing references in the storage's native
+    blob bucket, and contents in the shared blob store.
+    """
+
+    def __init__(self, storage, name):
+        super(ContentAddressedBlobBucket, self).__init__(storage, name)
+        self._refs = storage.blob_bucket_class(storage, name)
+
+    @classmethod
+    def list_buckets(cls, storage):
+        return storage.blob_bucket_class.list_buckets(storage)
+
+    @property
+    def _contents(self):
+        return get_blob_store(self.storage).blobs[CONTENTS_BUCKET]
+
+    def _resolve(self, value):
+        digest = _parse_ref(value)
+        if digest is None:
+            return value
+        return self._contents[digest]
+
+    def _store_ref(self, key, digest):
+        self._refs[key] = _make_ref(digest)
+
+    def __iter__(self):
+        return iter(self._refs)
+
+    def __len__(self):
+        return len(self._refs)
+
+    def keys_page(self, after=None, limit=50):
+        return self._refs.keys_page(after=after, limit=limit)
+
+    def stats(self):
+        # Sizes are the ones of references: contents might be shared
+        return self._refs.stats()
+
+    def __contains__(self, key):
+        return key in self._refs
+
+    def __getitem__(self, key):
+        return self._resolve(self._refs[key])
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, basestring):
+            raise TypeError("Blob storage can only process strings")
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        digest = hashlib.sha256(value).hexdigest()
+        contents = self._contents
+        if digest not in contents:
+            contents[digest] = value
+        self._store_ref(key, digest)
+
+    def __delitem__(self, key):
+        del self._refs[key]
+
+    def iter_items(self, batch_size=500, fields=None):
+        projection = self._get_projection(fields)
+        for key, value in self._refs.iter_items(batch_size=batch_size):
+            yield key, self._project(self._resolve(value), projection)
+
+    def get_many(self, keys):
+        refs = self._refs.get_many(keys)
+        digests = dict((key, _parse_ref(value))
+                       for key, value in refs.iteritems())
+        contents = self._contents.get_many(
+            set(d for d in digests.itervalues() if d is not None))
+
+        result = {}
+        for key, digest in digests.iteritems():
+            if digest is None:
+                result[key] = refs[key]
+            elif digest in contents:
+                result[key] = contents[digest]
+        return result
+
+    def delete_many(self, keys):
+        self._refs.delete_many(keys)
+
+    def clear(self):
+        self._refs.clear()
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        storage.blob_bucket_class.replace_bucket(storage, name, source_name)
+
+    def iter_changed_since(self, seq=0):
+        return self._refs.iter_changed_since(seq)
+
+    def iter_hashes(self):
+        # References already hold the hash of the contents
+        for key, value in sorted(self._refs.iter_items()):
+            digest = _parse_ref(value)
+            if digest is None:
+                digest = self._hash_value(value)
+            yield key, digest
+
+    def open_read(self, key):
+        digest = _parse_ref(self._refs[key])
+        if digest is None:
+            return self._refs.open_read(key)
+        return self._contents.open_read(digest)
+
+    def open_write(self, key):
+        return ContentAddressedBlobWriter(self, key)
+
+
+class ContentAddressedBlobWriter(BlobWriter):
+    """
+    Spool written data to a temporary file while hashing it, then
+    copy it to the blob store (unless already there) on close.
+    """
+
+    def __init__(self, bucket, key):
+        super(ContentAddressedBlobWriter, self).__init__(bucket, key)
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self._hash.update(data)
+        super(ContentAddressedBlobWriter, self).write(data)
+
+    def _store(self, fileobj):
+        digest = self._hash.hexdigest()
+        contents = self.bucket._contents
+
+        if digest not in contents:
+            with contents.open_write(digest) as fp:
+                while True:
+                    chunk = fileobj.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    fp.write(chunk)
+
+        self.bucket._store_ref(self.key, digest)
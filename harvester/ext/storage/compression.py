@@ -0,0 +1,294 @@
+"""
+Transparent compression for stored values.
+
+Compressed values are tagged with a short header::
+
+    '\\x00HVC' + <one-byte codec tag> + <compressed payload>
+
+Values without the header are returned as-is, so data written
+before enabling compression (or with a different codec) stays
+readable whatever the currently configured codec is.
+
+Uncompressed values starting with ``'\\x00HV'`` (the prefix of all
+the headers used by storages, see also :py:mod:`.cas`) are tagged
+with the ``'-'`` (raw) codec tag, so that they're never mistaken for
+tagged ones.
+
+Available codecs:
+
+- ``zlib`` -- always available
+- ``lzma`` -- requires Python 3 or the ``backports.lzma`` package
+- ``zstd`` -- requires the ``zstandard`` package
+"""
+
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+PREFIX = '\x00HV'
+MAGIC = PREFIX + 'C'
+HEADER_SIZE = len(MAGIC) + 1
+RAW_TAG = '-'
+RAW_HEADER = MAGIC + RAW_TAG
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class Codec(object):
+    def __init__(self, name, tag, compress, decompress,
+                 compressobj, decompressobj):
+        self.name = name
+        self.tag = tag
+        self.compress = compress
+        self.decompress = decompress
+        self.compressobj = compressobj
+        self.decompressobj = decompressobj
+
+    def __repr__(self):
+        return 'Codec({0!r})'.format(self.name)
+
+
+CODECS = {}
+
+
+def _register(codec):
+    CODECS[codec.name] = codec
+
+
+_register(Codec(
+    'zlib', 'z', zlib.compress, zlib.decompress,
+    zlib.compressobj, zlib.decompressobj))
+
+if lzma is not None:
+    _register(Codec(
+        'lzma', 'x', lzma.compress, lzma.decompress,
+        lzma.LZMACompressor, lzma.LZMADecompressor))
+
+if zstandard is not None:
+    _register(Codec(
+        'zstd', 's',
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+        lambda: zstandard.ZstdCompressor().compressobj(),
+        lambda: zstandard.ZstdDecompressor().decompressobj()))
+
+_CODECS_BY_TAG = dict((c.tag, c) for c in CODECS.itervalues())
+
+
+def get_codec(name):
+    """
+    Get a codec by name.
+
+    :return: a :py:class:`Codec`, or None if ``name`` is empty / "none"
+    :raises ValueError: if the codec is unknown or not available
+    """
+    if not name or name == 'none':
+        return None
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(
+            "Unsupported codec: {0!r} (available: {1})"
+            .format(name, ', '.join(sorted(CODECS))))
+
+
+def encode(data, codec_name):
+    """Compress and tag some data, using the named codec"""
+    codec = get_codec(codec_name)
+    if codec is None:
+        if data.startswith(PREFIX):
+            return RAW_HEADER + data
+        return data
+    return ''.join((MAGIC, codec.tag, codec.compress(data)))
+
+
+def _parse_header(header):
+    """
+    Get the codec and header size of some data, from its first
+    ``HEADER_SIZE`` bytes (codec is None for uncompressed data).
+    """
+    if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+        return None, 0
+    tag = header[len(MAGIC)]
+    if tag == RAW_TAG:
+        return None, HEADER_SIZE
+    try:
+        return _CODECS_BY_TAG[tag], HEADER_SIZE
+    except KeyError:
+        raise ValueError("Data was compressed with an unsupported codec")
+
+
+def decode(data):
+    """Decompress some data, if it was tagged by :py:func:`encode`"""
+    codec, header_size = _parse_header(data[:HEADER_SIZE])
+    if codec is None:
+        return data[header_size:] if header_size else data
+    return codec.decompress(data[header_size:])
+
+
+def wrap_writer(fp, codec_name):
+    """Wrap a writable blob file, to compress data written to it"""
+    codec = get_codec(codec_name)
+    if codec is None:
+        return EscapingWriter(fp)
+    return EncodingWriter(fp, codec)
+
+
+class EscapingWriter(object):
+    """
+    Writable file-like object, passing data through as-is, but
+    tagging it as raw if it starts like a header.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._head = ''  # None once the beginning was written
+
+    @property
+    def closed(self):
+        return self._fp.closed
+
+    def _write_head(self):
+        head, self._head = self._head, None
+        if head.startswith(PREFIX):
+            self._fp.write(RAW_HEADER)
+        if head:
+            self._fp.write(head)
+
+    def write(self, data):
+        if self._head is None:
+            self._fp.write(data)
+            return
+        self._head += data
+        if len(self._head) >= len(PREFIX):
+            self._write_head()
+
+    def close(self):
+        if self.closed:
+            return
+        if self._head is not None:
+            self._write_head()
+        self._fp.close()
+
+    def abort(self):
+        self._fp.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class EncodingWriter(object):
+    """Writable file-like object, compressing data on the fly"""
+
+    def __init__(self, fp, codec):
+        self._fp = fp
+        self._compressor = codec.compressobj()
+        self._fp.write(MAGIC + codec.tag)
+
+    @property
+    def closed(self):
+        return self._fp.closed
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._fp.write(compressed)
+
+    def close(self):
+        if self.closed:
+            return
+        self._fp.write(self._compressor.flush())
+        self._fp.close()
+
+    def abort(self):
+        self._fp.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class DecodingReader(object):
+    """
+    Readable file-like object, decompressing data on the fly
+    if it was tagged by a codec; untagged data is passed through.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+
+        header = ''
+        while len(header) < HEADER_SIZE:
+            chunk = fp.read(HEADER_SIZE - len(header))
+            if not chunk:
+                break
+            header += chunk
+
+        codec, header_size = _parse_header(header)
+        if codec is None:
+            self._decompressor = None
+            self._buffer = header[header_size:]
+        else:
+            self._decompressor = codec.decompressobj()
+            self._buffer = ''
+
+    @property
+    def closed(self):
+        return getattr(self._fp, 'closed', False)
+
+    def _read_chunk(self):
+        chunk = self._fp.read(READ_CHUNK_SIZE)
+        if self._decompressor is not None and chunk:
+            return self._decompressor.decompress(chunk), True
+        return chunk, bool(chunk)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer]
+            while True:
+                data, more = self._read_chunk()
+                if not more:
+                    break
+                parts.append(data)
+            self._buffer = ''
+            return ''.join(parts)
+
+        while len(self._buffer) < size:
+            data, more = self._read_chunk()
+            if not more:
+                break
+            self._buffer += data
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
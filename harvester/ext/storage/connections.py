@@ -0,0 +1,248 @@
+"""
+Process-wide registry of connections to storage backends.
+
+Storage instances are cheap, and created liberally (eg. by
+``get_storage_direct()``, on every request of the storage explorer);
+connections are not: a ``MongoClient`` performs a handshake with the
+server, a SQLite connection opens the file and sets up its pragmas.
+Backends ask the registry for a connection, keyed by backend URL and
+connection options, instead of opening their own:
+
+- *Shared* connections (thread-safe ones, eg. ``MongoClient``) are
+  used by all the storages pointing to the same backend at once
+- *Exclusive* connections (eg. ``sqlite3`` ones) are used by one
+  storage at a time, and handed to the next one once it's done
+- Connections are given back when the storage using them is garbage
+  collected; the ones left unused for ``max_idle`` seconds are closed
+- Connections unused for ``check_interval`` seconds are checked (eg.
+  pinged) before being handed out again, and replaced if broken
+- Connections are never shared across processes: a forked process
+  starts with an empty registry (entries inherited from the parent
+  are dropped, not closed, as they belong to it)
+"""
+
+import os
+import threading
+import time
+import weakref
+
+
+DEFAULT_MAX_IDLE = 300
+DEFAULT_CHECK_INTERVAL = 30
+
+
+class _Entry(object):
+    __slots__ = ('key', 'connection', 'shared', 'check', 'reset', 'close',
+                 'users', 'last_used', 'last_checked', 'stale')
+
+    def __init__(self, key, connection, shared, check, reset, close):
+        self.key = key
+        self.connection = connection
+        self.shared = shared
+        self.check = check
+        self.reset = reset
+        self.close = close
+        self.users = 0
+        self.last_used = self.last_checked = time.time()
+        self.stale = False
+
+
+class ConnectionRegistry(object):
+    """
+    Registry of the connections opened by a process.
+
+    :param max_idle: seconds after which unused connections are closed
+    :param check_interval: seconds after which unused connections are
+        checked before being used again
+    """
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._shared = {}  # key -> entry
+        self._idle = {}  # key -> [entry], most recently used last
+        self._owners = {}  # id(weakref to owner) -> (weakref, entry)
+        self._released = []  # (weakref, time) of collected owners
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def acquire(self, owner, key, connect, check=None, reset=None,
+                close=None, shared=False):
+        """
+        Get a connection for ``owner`` to use until it gets garbage
+        collected.
+
+        The callbacks are kept in the registry: they must not
+        reference the owner, or it will never be collected.
+
+        :param owner: the object using the connection (eg. a storage)
+        :param key: hashable key identifying the backend (URL,
+            connection options, ...)
+        :param connect: function opening a new connection
+        :param check: function called with an unused connection before
+            handing it out again, returning False (or raising) if the
+            connection is broken
+        :param reset: function called with an exclusive connection
+            once its owner is done with it (eg. to roll back an
+            unfinished transaction)
+        :param close: function closing a connection
+        :param shared: whether the connection can be used by several
+            owners at once (ie. it's thread-safe)
+        """
+        self._check_pid()
+        now = time.time()
+        with self._lock:
+            self._process_released()
+            self._evict_idle(now)
+            entry = self._take(key, shared)
+
+        if entry is not None and check is not None \
+                and now - entry.last_checked >= self.check_interval:
+            if not _is_healthy(check, entry.connection):
+                with self._lock:
+                    self._discard(entry)
+                entry = None
+
+        if entry is None:
+            entry = _Entry(key, connect(), shared, check, reset, close)
+
+        with self._lock:
+            if shared:
+                # Another thread might have opened one meanwhile
+                existing = self._shared.setdefault(key, entry)
+                if existing is not entry:
+                    _close_quietly(entry)
+                    entry = existing
+            entry.users += 1
+            entry.last_used = entry.last_checked = now
+            # Keyed by id, as weakrefs to the same object compare equal
+            ref = weakref.ref(owner, self._on_owner_collected)
+            self._owners[id(ref)] = ref, entry
+        return entry.connection
+
+    def _on_owner_collected(self, ref):
+        # Might be called from any thread, at any time (even while
+        # holding the lock): just take note, see _process_released()
+        self._released.append((ref, time.time()))
+
+    def _take(self, key, shared):
+        if shared:
+            return self._shared.get(key)
+        idle = self._idle.get(key)
+        if not idle:
+            return None
+        entry = idle.pop()
+        if not idle:
+            del self._idle[key]
+        return entry
+
+    def _process_released(self):
+        while self._released:
+            ref, released_at = self._released.pop(0)
+            ref, entry = self._owners.pop(id(ref))
+            entry.users -= 1
+            entry.last_used = max(entry.last_used, released_at)
+            if entry.users > 0:
+                continue
+            if entry.stale:
+                _close_quietly(entry)
+            elif not entry.shared:
+                if entry.reset is not None \
+                        and not _is_healthy(entry.reset, entry.connection):
+                    _close_quietly(entry)
+                    continue
+                self._idle.setdefault(entry.key, []).append(entry)
+
+    def _evict_idle(self, now):
+        for key, entry in self._shared.items():
+            if entry.users == 0 and now - entry.last_used >= self.max_idle:
+                del self._shared[key]
+                _close_quietly(entry)
+        for key, entries in self._idle.items():
+            for entry in entries:
+                if now - entry.last_used >= self.max_idle:
+                    _close_quietly(entry)
+            entries[:] = [entry for entry in entries
+                          if now - entry.last_used < self.max_idle]
+            if not entries:
+                del self._idle[key]
+
+    def _discard(self, entry):
+        """Forget a broken connection, closing it if no longer used"""
+        if self._shared.get(entry.key) is entry:
+            del self._shared[entry.key]
+        if entry.users > 0:
+            entry.stale = True
+        else:
+            _close_quietly(entry)
+
+    def collect(self):
+        """
+        Take back the connections of garbage-collected owners, and
+        close the ones left unused for too long (this happens on
+        every ``acquire()`` anyway).
+        """
+        self._check_pid()
+        with self._lock:
+            self._process_released()
+            self._evict_idle(time.time())
+
+    def close_all(self):
+        """Close all the unused connections"""
+        self._check_pid()
+        with self._lock:
+            self._process_released()
+            for key, entry in self._shared.items():
+                if entry.users == 0:
+                    del self._shared[key]
+                    _close_quietly(entry)
+            for entries in self._idle.itervalues():
+                for entry in entries:
+                    _close_quietly(entry)
+            self._idle.clear()
+
+    def get_info(self):
+        """Get the number of ``(in use, idle)`` connections for each key"""
+        self._check_pid()
+        info = {}
+        with self._lock:
+            self._process_released()
+            for entry in set(e for ref, e in self._owners.itervalues()):
+                in_use, idle = info.get(entry.key, (0, 0))
+                info[entry.key] = (in_use + 1, idle)
+            for entry in self._shared.itervalues():
+                if entry.users == 0:
+                    in_use, idle = info.get(entry.key, (0, 0))
+                    info[entry.key] = (in_use, idle + 1)
+            for key, entries in self._idle.iteritems():
+                in_use, idle = info.get(key, (0, 0))
+                info[key] = (in_use, idle + len(entries))
+        return info
+
+
+def _is_healthy(func, connection):
+    try:
+        return func(connection) is not False
+    except Exception:
+        return False
+
+
+def _close_quietly(entry):
+    if entry.close is None:
+        return
+    try:
+        entry.close(entry.connection)
+    except Exception:
+        pass
+
+
+#: The registry used by storages
+registry = ConnectionRegistry()
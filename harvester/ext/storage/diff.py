@@ -0,0 +1,81 @@
+"""
+Compare the contents of two storages.
+
+Buckets provide their ``(key, hash)`` pairs sorted by key (see
+:py:meth:`BaseBucket.iter_hashes`), using hashes stored on write
+where the backend supports it; the two streams are then merged, so
+objects are never loaded (unless their hash is missing) and memory
+usage doesn't depend on the bucket size.
+
+Hashes are computed the same way by all the backends, so storages of
+different kinds can be compared (eg. a SQLite snapshot against the
+MongoDB database it was copied from).
+"""
+
+import collections
+
+from .base import BUCKET_MANAGERS
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+#: Differences between two buckets, as lists of keys
+BucketDiff = collections.namedtuple('BucketDiff', 'added removed changed')
+
+
+def iter_hash_diff(old_hashes, new_hashes):
+    """
+    Merge two iterables of ``(key, hash)``, sorted by key, yielding
+    ``(status, key)`` for keys added, removed or changed.
+    """
+    old_hashes, new_hashes = iter(old_hashes), iter(new_hashes)
+    old = next(old_hashes, None)
+    new = next(new_hashes, None)
+
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield REMOVED, old[0]
+            old = next(old_hashes, None)
+        elif old is None or new[0] < old[0]:
+            yield ADDED, new[0]
+            new = next(new_hashes, None)
+        else:
+            if old[1] != new[1]:
+                yield CHANGED, new[0]
+            old = next(old_hashes, None)
+            new = next(new_hashes, None)
+
+
+def iter_bucket_diff(old, new):
+    """Iterate ``(status, key)`` for the differences between buckets"""
+    return iter_hash_diff(old.iter_hashes(), new.iter_hashes())
+
+
+def diff_buckets(old, new):
+    """Get the differences between two buckets, as a :py:class:`BucketDiff`"""
+    result = BucketDiff([], [], [])
+    for status, key in iter_bucket_diff(old, new):
+        getattr(result, status).append(key)
+    return result
+
+
+def diff_storages(old, new, bucket_types=None):
+    """
+    Compare all the buckets of two storages.
+
+    :param bucket_types: bucket types to compare (default: all)
+    :return: a dict mapping ``(bucket_type, name)`` to the
+        :py:class:`BucketDiff` of each bucket found in either storage
+    """
+    result = {}
+    for bucket_type, manager_name in BUCKET_MANAGERS:
+        if bucket_types is not None and bucket_type not in bucket_types:
+            continue
+        old_manager = getattr(old, manager_name)
+        new_manager = getattr(new, manager_name)
+        for name in sorted(set(old_manager) | set(new_manager)):
+            result[bucket_type, name] = diff_buckets(
+                old_manager[name], new_manager[name])
+    return result
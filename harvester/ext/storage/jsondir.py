@@ -1,21 +1,562 @@
-from .base import BaseStorage
+"""
+Filesystem-based storage, keeping each object in its own file.
+
+Layout::
+
+    <basedir>/<bucket type>/<bucket name>/<xx>/<yy>/<quoted key>
+
+- Documents and keyvals are stored as json files, blobs as raw files
+  (both can be compressed, see the ``codec`` / ``document_codec`` options)
+- The ``xx/yy`` sub-directories are taken from the sha1 of the key,
+  in order to keep directories small even with millions of objects
+- Writes are atomic: data is written to a temporary file, which is
+  then renamed in place; readers will never see a partial object
+- Blobs are read through mmap
+- Changes are appended to a ``<bucket name>/.changes`` log, one json
+  line per write or deletion (with the content hash, when known); the
+  sequence number of a change is the position of the end of its line
+  in the log
+
+As no locking is needed, several processes can safely write to the
+same storage at the same time.
+
+``clear()`` and ``replace_bucket()`` move whole bucket directories
+(keeping the changes log of the bucket in place, as sequence numbers
+are positions in it); they are not meant to run while other processes
+write to the same buckets. Replacing a bucket takes two renames:
+readers might briefly see it empty.
+
+Storage URLs look like ``jsondir+file:///path/to/dir`` (or just
+``jsondir+/path/to/dir``).
+"""
+
+import errno
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import time
+import urllib
+import urlparse
+
+from harvester.utils import lazy_property
+from . import compression
+from .base import (BaseStorage, BaseDocumentBucket, BaseBlobBucket,
+                   BaseKeyvalBucket, BucketStats, Change, NotFound)
+
+
+BUCKET_TYPES = ('document', 'blob', 'keyval')
+
+# Keep some margin from the usual 255 bytes limit on file names
+MAX_FILENAME_LENGTH = 240
+
+
+def _makedirs(path):
+    """Create a directory, not failing if somebody else already did"""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _rename_if_exists(src, dst):
+    """Rename a file, returning False if it doesn't exist"""
+    try:
+        os.rename(src, dst)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def _unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _quote(name):
+    if not isinstance(name, basestring):
+        name = str(name)
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return urllib.quote(name, safe='')
+
+
+def _unquote(name):
+    return urllib.unquote(name).decode('utf-8')
+
+
+def _get_filename(name, what):
+    """
+    Quote a bucket name or key for use as a file name, making sure it
+    stays inside its directory.
+    """
+    filename = _quote(name)
+    if filename in ('', '.', '..'):
+        raise ValueError("Invalid {0}: {1!r}".format(what, name))
+    if len(filename) > MAX_FILENAME_LENGTH:
+        raise ValueError("{0} too long: {1!r}".format(what.capitalize(),
+                                                      name))
+    return filename
 
 
 class JsonDirStorage(BaseStorage):
-    def __init__(self, basedir):
-        self._basedir = basedir
+    options = [
+        ('fsync', 'bool', False,
+         'Call fsync() on each written file (safer, but much slower)'),
+        ('document_codec', 'str', None,
+         'Compression codec for documents and keyvals'),
+    ]
+
+    @lazy_property
+    def _basedir(self):
+        if not self.url:
+            raise ValueError("A base directory is required")
+
+        parsed = urlparse.urlparse(self.url)
+        if parsed.scheme not in ('', 'file'):
+            raise ValueError(
+                "Invalid jsondir url: {0!r} (invalid scheme)"
+                .format(self.url))
+
+        if parsed.netloc:
+            raise ValueError(
+                "Invalid jsondir url: {0!r} (cannot define netloc)"
+                .format(self.url))
+
+        return parsed.path
+
+    def _get_bucket_dir(self, bucket_type, name):
+        return os.path.join(self._basedir, bucket_type,
+                            _get_filename(name, 'bucket name'))
+
+    def _move_to_trash(self, path):
+        """
+        Move a directory out of the way, to be removed later;
+        return its new path, or None if it didn't exist.
+        """
+        trash = os.path.join(self._basedir, '.trash')
+        _makedirs(trash)
+        new_path = tempfile.mkdtemp(dir=trash)
+        try:
+            # Replaces the (empty) temporary directory
+            os.rename(path, new_path)
+        except OSError, e:
+            os.rmdir(new_path)
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return new_path
+
+    def flush_storage(self):
+        self._logged_hashes = None
+        for bucket_type in BUCKET_TYPES:
+            path = os.path.join(self._basedir, bucket_type)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+
+class BaseJsonDirBucket(object):
+    bucket_type = None  # to be overwritten in subclasses
+    _keeps_hashes = True
+
+    @classmethod
+    def list_buckets(cls, storage):
+        path = os.path.join(storage._basedir, cls.bucket_type)
+        try:
+            names = os.listdir(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+
+        for name in names:
+            yield _unquote(name)
+
+    @property
+    def _bucket_dir(self):
+        return self.storage._get_bucket_dir(self.bucket_type, self.name)
+
+    def _get_path(self, key):
+        filename = _get_filename(key, 'key')
+        keyhash = hashlib.sha1(filename).hexdigest()
+        return os.path.join(
+            self._bucket_dir, keyhash[:2], keyhash[2:4], filename)
+
+    def _iter_paths(self):
+        """Iterate ``(key, path)`` for all the objects in the bucket"""
+
+        for dirpath, dirnames, filenames in os.walk(self._bucket_dir):
+            if dirpath == self._bucket_dir:
+                # Skip the directory containing temporary files, and
+                # files (such as the changes log) in the bucket root
+                dirnames[:] = [x for x in dirnames if x != '.tmp']
+                continue
+            for filename in filenames:
+                yield _unquote(filename), os.path.join(dirpath, filename)
+
+    def _open_temp_file(self, key):
+        """Create a temporary file, on the same filesystem as the bucket"""
+        self._get_path(key)  # Fail early on invalid keys
+        tmpdir = os.path.join(self._bucket_dir, '.tmp')
+        _makedirs(tmpdir)
+        fd, tmpname = tempfile.mkstemp(dir=tmpdir)
+        return os.fdopen(fd, 'wb'), tmpname
+
+    def _commit_temp_file(self, fp, tmpname, key, hash=None):
+        """Close a temporary file and atomically move it in place"""
+        renamed = False
+        try:
+            if self.storage.conf.get('fsync', False):
+                fp.flush()
+                os.fsync(fp.fileno())
+            fp.close()
+
+            path = self._get_path(key)
+            _makedirs(os.path.dirname(path))
+            os.rename(tmpname, path)
+            renamed = True
+
+        finally:
+            if not renamed:
+                fp.close()
+                os.unlink(tmpname)
+
+        self._log_change(key, hash=hash)
+
+    @property
+    def _changes_path(self):
+        return os.path.join(self._bucket_dir, '.changes')
+
+    def _log_change(self, key, deleted=False, hash=None):
+        self._log_changes([(key, deleted, hash)])
+
+    def _log_changes(self, changes):
+        """Log many ``(key, deleted, hash)`` changes"""
+        # Lines are short, and appended with a single write() call:
+        # concurrent writers won't get their lines mixed up.
+        now = time.time()
+        lines = []
+        for key, deleted, hash in changes:
+            key = _unquote(_quote(key))  # The same type __iter__() returns
+            lines.append(json.dumps([key, now, deleted, hash]) + '\n')
+        if not lines:
+            return
+        with open(self._changes_path, 'ab') as fp:
+            fp.write(''.join(lines))
+
+    def _read_changes_log(self, seq=0):
+        """Iterate ``(seq, [key, timestamp, deleted, hash])`` from the log"""
+        try:
+            fp = open(self._changes_path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        with fp:
+            fp.seek(seq)
+            position = seq
+            for line in fp:
+                if not line.endswith('\n'):
+                    break  # Still being written
+                position += len(line)
+                record = json.loads(line)
+                if len(record) < 4:
+                    record.append(None)  # Written by an older version
+                yield position, record
+
+    def iter_changed_since(self, seq=0):
+        changes = {}
+        for position, record in self._read_changes_log(seq):
+            key, timestamp, deleted, hash = record
+            changes[key] = Change(key, position, timestamp, deleted)
+        return iter(sorted(changes.itervalues(), key=lambda c: c.seq))
+
+    def _get_logged_hashes(self):
+        """
+        Get a ``{key: hash}`` dict from the changes log; it is cached,
+        and only lines appended since the last call are read.
+        """
+        cached = getattr(self.storage, '_logged_hashes', None)
+        if cached is None:
+            cached = self.storage._logged_hashes = {}
+        position, hashes = cached.get(
+            (self.bucket_type, self.name), (0, {}))
+        try:
+            if os.path.getsize(self._changes_path) < position:
+                position, hashes = 0, {}  # Flushed meanwhile
+        except OSError:
+            position, hashes = 0, {}
+        for position, record in self._read_changes_log(position):
+            key, timestamp, deleted, hash = record
+            hashes[key] = hash
+        cached[self.bucket_type, self.name] = (position, hashes)
+        return hashes
+
+    def _get_stored_hash(self, key):
+        hash = self._get_logged_hashes().get(_unquote(_quote(key)))
+        if hash is not None and key in self:
+            return hash
+        return super(BaseJsonDirBucket, self)._get_stored_hash(key)
+
+    def iter_hashes(self):
+        hashes = self._get_logged_hashes()
+        for key in sorted(self):
+            # Hashes of streamed blobs are not logged: compute them
+            hash = hashes.get(key)
+            if hash is None:
+                hash = self._hash_value(self[key])
+            yield key, hash
+
+    def clear(self):
+        keys = list(self)
+        old_dir = self.storage._move_to_trash(self._bucket_dir)
+        if old_dir is None:
+            return
+        _makedirs(self._bucket_dir)
+        _rename_if_exists(os.path.join(old_dir, '.changes'),
+                          self._changes_path)
+        shutil.rmtree(old_dir)
+        self._log_changes([(key, True, None) for key in keys])
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        target, source = cls(storage, name), cls(storage, source_name)
+        old_keys, new_keys = set(target), set(source)
+        old_hashes = target._get_logged_hashes()
+        new_hashes = source._get_logged_hashes()
+
+        changes = [(key, True, None) for key in old_keys - new_keys]
+        for key in new_keys:
+            hash = new_hashes.get(key)
+            unchanged = hash is not None and hash == old_hashes.get(key)
+            if key in old_keys and unchanged:
+                continue
+            changes.append((key, False, hash))
+
+        # The log of the target bucket moves along with the new contents
+        _makedirs(source._bucket_dir)
+        if not _rename_if_exists(target._changes_path, source._changes_path):
+            _unlink_if_exists(source._changes_path)
+        source._log_changes(changes)
+
+        old_dir = storage._move_to_trash(target._bucket_dir)
+        os.rename(source._bucket_dir, target._bucket_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir)
+        if getattr(storage, '_logged_hashes', None) is not None:
+            storage._logged_hashes.pop((cls.bucket_type, name), None)
+            storage._logged_hashes.pop((cls.bucket_type, source_name), None)
+
+    def __iter__(self):
+        for key, path in self._iter_paths():
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self._iter_paths())
+
+    def stats(self):
+        # No metadata to rely on: a stat() call per file is needed
+        count, size, last_modified = 0, 0, None
+        for key, path in self._iter_paths():
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue  # Deleted meanwhile
+            count += 1
+            size += st.st_size
+            last_modified = max(last_modified, st.st_mtime)
+        try:
+            # Deletions are only found in the log
+            last_modified = max(last_modified,
+                                os.path.getmtime(self._changes_path))
+        except OSError:
+            pass
+        return BucketStats(count, size, last_modified)
+
+    def __contains__(self, key):
+        return os.path.exists(self._get_path(key))
+
+    def __getitem__(self, key):
+        try:
+            with open(self._get_path(key), 'rb') as fp:
+                return self._read(fp)
+
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise NotFound("Object not found: {0!r}/{1!r}/{2!r}"
+                               .format(self.bucket_type, self.name, key))
+            raise
+
+    def __setitem__(self, key, value):
+        hash = self._get_write_hash(value)
+        if self._skip_write(key, hash):
+            return
+        data = self._serialize(value)
+        fp, tmpname = self._open_temp_file(key)
+        written = False
+        try:
+            fp.write(data)
+            written = True
+        finally:
+            if not written:
+                fp.close()
+                os.unlink(tmpname)
+        self._commit_temp_file(fp, tmpname, key, hash)
+
+    def __delitem__(self, key):
+        try:
+            os.unlink(self._get_path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            self._log_change(key, deleted=True)
+
+    def _read(self, fp):
+        return self._deserialize(fp.read())
+
+    def _serialize(self, obj):
+        return compression.encode(
+            json.dumps(obj), self.storage.conf.get('document_codec'))
+
+    def _deserialize(self, data):
+        return json.loads(compression.decode(data))
+
+
+class JsonDirDocumentBucket(BaseJsonDirBucket, BaseDocumentBucket):
+    bucket_type = 'document'
+
+
+class JsonDirKeyvalBucket(BaseJsonDirBucket, BaseKeyvalBucket):
+    bucket_type = 'keyval'
+
+
+class JsonDirBlobBucket(BaseJsonDirBucket, BaseBlobBucket):
+    bucket_type = 'blob'
+
+    def _read(self, fp):
+        if os.fstat(fp.fileno()).st_size == 0:
+            return ''  # Empty files cannot be mmap'd
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return compression.decode(mm[:])
+        finally:
+            mm.close()
+
+    def _serialize(self, obj):
+        if not isinstance(obj, basestring):
+            raise TypeError("Blob storage can only process strings")
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        return compression.encode(obj, self.storage.conf.get('codec'))
+
+    def open_read(self, key):
+        try:
+            fp = open(self._get_path(key), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise NotFound("Object not found: {0!r}/{1!r}/{2!r}"
+                               .format(self.bucket_type, self.name, key))
+            raise
+        return compression.DecodingReader(MmapReader(fp))
+
+    def open_write(self, key):
+        return compression.wrap_writer(
+            JsonDirBlobWriter(self, key), self.storage.conf.get('codec'))
+
+
+class MmapReader(object):
+    """Read-only file-like object, reading from a mmap'd file"""
+
+    def __init__(self, fp):
+        self._fp = fp
+        if os.fstat(fp.fileno()).st_size == 0:
+            self._mmap = None  # Empty files cannot be mmap'd
+        else:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.closed = False
+
+    def read(self, size=-1):
+        if self._mmap is None:
+            return ''
+        if size is None or size < 0:
+            size = self._mmap.size() - self._mmap.tell()
+        return self._mmap.read(size)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if self._mmap is not None:
+            self._mmap.seek(pos, whence)
+
+    def tell(self):
+        if self._mmap is None:
+            return 0
+        return self._mmap.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._mmap is not None:
+            self._mmap.close()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class JsonDirBlobWriter(object):
+    """
+    File-like object writing a blob to a temporary file,
+    which is moved in place on close.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.closed = False
+        self._fp, self._tmpname = bucket._open_temp_file(key)
+
+    def write(self, data):
+        self._fp.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.bucket._commit_temp_file(self._fp, self._tmpname, self.key)
+        self.bucket.storage.write_stats['written'] += 1
 
-    def list_object_types(self):
-        raise NotImplementedError
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._fp.close()
+        os.unlink(self._tmpname)
 
-    def list_objects(self, obj_type):
-        raise NotImplementedError
+    def __enter__(self):
+        return self
 
-    def get_object(self, obj_type, obj_id):
-        raise NotImplementedError
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
-    def set_object(self, obj_type, obj_id, obj):
-        raise NotImplementedError
 
-    def del_object(self, obj_type, obj_id):
-        raise NotImplementedError
+JsonDirStorage.document_bucket_class = JsonDirDocumentBucket
+JsonDirStorage.blob_bucket_class = JsonDirBlobBucket
+JsonDirStorage.keyval_bucket_class = JsonDirKeyvalBucket
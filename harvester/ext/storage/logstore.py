@@ -0,0 +1,769 @@
+"""
+Append-only, log-structured storage, optimized for write throughput.
+
+Layout::
+
+    <basedir>/<bucket type>/<bucket name>/segment-<N>.log
+    <basedir>/<bucket type>/<bucket name>/index.json
+
+- Every write (or deletion) appends a record to the active segment
+  file, so writing is bound by sequential disk speed
+- A compact ``key -> position`` index is kept in memory, and saved
+  alongside the segments on ``flush()``. Records written after the
+  last save are replayed from the segment when opening the bucket,
+  so an out-of-date index is never a problem. A record left
+  half-written by a crash is truncated away when the writer takes
+  over the log.
+- Content hashes are kept in the index too (for replayed records,
+  they are computed when first needed)
+- Reads go through mmap; readers keep the mapping of the segment they
+  started reading from (eg. while iterating, or streaming a blob), so
+  that compaction never pulls data from under them: old segments go
+  away once the last reader is done with them
+- ``compact()`` rewrites the live records into a new segment, dropping
+  superseded versions (the last deletion record for each key is kept,
+  so that ``iter_changed_since()`` can report it); it can run in a
+  background thread, and will be started automatically on flush once
+  the ratio of garbage exceeds the ``compact_ratio`` option.
+
+Only one process at a time can write to a bucket (a lock file is
+used to make sure of that); other processes can read. Each process
+(including forked ones) opens the logs on its own.
+
+Storage URLs look like ``logstore+file:///path/to/dir`` (or just
+``logstore+/path/to/dir``).
+"""
+
+import errno
+import fcntl
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+from harvester.utils import lazy_property
+from . import compression
+from .base import (BaseStorage, BaseDocumentBucket, BaseBlobBucket,
+                   BaseKeyvalBucket, BucketStats, Change, NotFound,
+                   StorageError)
+
+
+BUCKET_TYPES = ('document', 'blob', 'keyval')
+
+# Record header: magic, flags, sequence, timestamp, crc32 of key+value,
+# key length, value length. Key (as json) and value follow.
+RECORD_MAGIC = 'HVL1'
+RECORD_HEADER = struct.Struct('>4sBQdIII')
+FLAG_DELETED = 0x01
+
+SEGMENT_RE = re.compile(r'^segment-(\d+)\.log$')
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _quote(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return urllib.quote(name, safe='')
+
+
+class IndexEntry(object):
+    __slots__ = ('offset', 'key_len', 'value_len', 'seq', 'timestamp',
+                 'deleted', 'hash')
+
+    def __init__(self, offset, key_len, value_len, seq, timestamp,
+                 deleted, hash=None):
+        self.offset = offset
+        self.key_len = key_len
+        self.value_len = value_len
+        self.seq = seq
+        self.timestamp = timestamp
+        self.deleted = deleted
+        self.hash = hash
+
+    @property
+    def value_offset(self):
+        return self.offset + RECORD_HEADER.size + self.key_len
+
+    @property
+    def record_len(self):
+        return RECORD_HEADER.size + self.key_len + self.value_len
+
+    def get_value(self, data):
+        """Get the value from a mapping of the segment holding it"""
+        return data[self.value_offset:self.value_offset + self.value_len]
+
+    def to_list(self):
+        return [self.offset, self.key_len, self.value_len, self.seq,
+                self.timestamp, self.deleted, self.hash]
+
+
+class SegmentLog(object):
+    """
+    Log of records for a single bucket.
+
+    All the operations are protected by a lock, so the log can be
+    compacted from a background thread while in use.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._lockfile = None
+        self._writer = None
+        self._mmap = None
+        self._mmap_size = 0
+        self._compacting = False
+        self._load()
+
+    # Files
+    # ------------------------------------------------------------
+
+    def _segment_path(self, segment):
+        return os.path.join(
+            self.path, 'segment-{0:06d}.log'.format(segment))
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index.json')
+
+    def _list_segments(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        found = (SEGMENT_RE.match(name) for name in names)
+        return sorted(int(m.group(1)) for m in found if m)
+
+    def _close_files(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._mmap is not None:
+            # Not closed, as readers might still be using it: it goes
+            # away along with the last reference
+            self._mmap = None
+            self._mmap_size = 0
+
+    # Index
+    # ------------------------------------------------------------
+
+    def _load(self):
+        """Load the index from disk, then replay the segment tail"""
+
+        self._close_files()
+        self.index = {}
+        self.seq = 0
+        self.live_bytes = 0
+        self.position = 0
+
+        segments = self._list_segments()
+        self.segment = segments[-1] if segments else 1
+
+        try:
+            with open(self._index_path(), 'rb') as fp:
+                data = json.load(fp)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = None
+
+        if data is not None and data['segment'] == self.segment:
+            self.seq = data['seq']
+            self.position = data['position']
+            for item in data['entries']:
+                key, entry = item[0], IndexEntry(*item[1:])
+                self.index[key] = entry
+                self.live_bytes += entry.record_len
+
+        self._replay()
+
+    def _replay(self):
+        """Apply records appended after ``self.position``"""
+
+        path = self._segment_path(self.segment)
+        try:
+            size = os.path.getsize(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        if size <= self.position:
+            return
+
+        with open(path, 'rb') as fp:
+            fp.seek(self.position)
+            while True:
+                offset = fp.tell()
+                header = fp.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (magic, flags, seq, timestamp, crc,
+                 key_len, value_len) = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    break
+                payload = fp.read(key_len + value_len)
+                if len(payload) < key_len + value_len:
+                    break  # Partially written record
+                if zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                key = json.loads(payload[:key_len])
+                self._apply(key, IndexEntry(
+                    offset, key_len, value_len, seq, timestamp,
+                    bool(flags & FLAG_DELETED)))
+                self.position = fp.tell()
+
+    def _apply(self, key, entry):
+        # Deletion records count as live, as they are kept on
+        # compaction in order to report deletions as changes
+        old = self.index.get(key)
+        if old is not None:
+            self.live_bytes -= old.record_len
+        self.live_bytes += entry.record_len
+        self.index[key] = entry
+        self.seq = max(self.seq, entry.seq)
+
+    def save_index(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush()
+                if self.fsync:
+                    os.fsync(self._writer.fileno())
+
+            data = {
+                'segment': self.segment,
+                'position': self.position,
+                'seq': self.seq,
+                'entries': [[key] + entry.to_list()
+                            for key, entry in self.index.iteritems()],
+            }
+
+            _makedirs(self.path)
+            fd, tmpname = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as fp:
+                json.dump(data, fp)
+            os.rename(tmpname, self._index_path())
+
+    def refresh(self):
+        """Pick up records written by another process"""
+        with self._lock:
+            if self._lockfile is not None:
+                return  # We are the writer: nothing new out there
+
+            segments = self._list_segments()
+            if segments and segments[-1] != self.segment:
+                self._load()  # The log was compacted meanwhile
+            else:
+                self._replay()
+
+    # Writing
+    # ------------------------------------------------------------
+
+    def _acquire_write_lock(self):
+        if self._lockfile is not None:
+            return
+        _makedirs(self.path)
+        lockfile = open(os.path.join(self.path, 'lock'), 'a')
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockfile.close()
+            raise StorageError(
+                "Log at {0} is being written by another process"
+                .format(self.path))
+        self._lockfile = lockfile
+
+        # Make sure we are up to date before starting to append
+        self._load()
+        self._truncate_tail()
+
+    def _truncate_tail(self):
+        """
+        Drop whatever follows the last valid record (eg. a record left
+        half-written by a crash), as new records are appended at
+        ``self.position``.
+        """
+        path = self._segment_path(self.segment)
+        try:
+            size = os.path.getsize(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        if size > self.position:
+            with open(path, 'r+b') as fp:
+                fp.truncate(self.position)
+
+    def _get_writer(self):
+        if self._writer is None:
+            self._writer = open(self._segment_path(self.segment), 'ab')
+            self._writer.seek(0, os.SEEK_END)
+        return self._writer
+
+    def append(self, key, value, deleted=False, flush=True, hash=None):
+        with self._lock:
+            self._acquire_write_lock()
+
+            key_data = json.dumps(key)
+            value = value or ''
+            payload = key_data + value
+
+            self.seq += 1
+            entry = IndexEntry(
+                self.position, len(key_data), len(value), self.seq,
+                time.time(), deleted, hash)
+            header = RECORD_HEADER.pack(
+                RECORD_MAGIC, FLAG_DELETED if deleted else 0, entry.seq,
+                entry.timestamp, zlib.crc32(payload) & 0xffffffff,
+                entry.key_len, entry.value_len)
+
+            writer = self._get_writer()
+            writer.write(header)
+            writer.write(payload)
+            if flush:
+                writer.flush()
+            self.position += entry.record_len
+            self._apply(key, entry)
+
+    def flush(self):
+        with self._lock:
+            if self._lockfile is None:
+                return
+            self.save_index()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._close_files()
+            if self._lockfile is not None:
+                self._lockfile.close()
+                self._lockfile = None
+
+    # Reading
+    # ------------------------------------------------------------
+
+    def _get_mmap(self, end):
+        """Get a mmap of the active segment, covering up to ``end``"""
+        if self._writer is not None:
+            self._writer.flush()
+        if self._mmap is None or self._mmap_size < end:
+            with open(self._segment_path(self.segment), 'rb') as fp:
+                self._mmap = mmap.mmap(
+                    fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmap_size = self._mmap.size()
+        return self._mmap
+
+    def get_entry(self, key):
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None or entry.deleted:
+                return None
+            return entry
+
+    def get_record(self, key):
+        """
+        Get the entry of a live record, along with a mapping of the
+        segment holding it, to read it with ``entry.get_value()``
+        (even if the log gets compacted meanwhile); ``(None, None)``
+        if there is no such record.
+        """
+        with self._lock:
+            entry = self.get_entry(key)
+            if entry is None:
+                return None, None
+            end = entry.value_offset + entry.value_len
+            return entry, self._get_mmap(end)
+
+    def snapshot(self):
+        """
+        Get the ``(key, entry)`` pairs of live records, along with a
+        mapping of the segment holding them (see ``get_record()``).
+        """
+        with self._lock:
+            items = [(k, e) for k, e in self.index.iteritems()
+                     if not e.deleted]
+            if not items:
+                return items, ''
+            return items, self._get_mmap(self.position)
+
+    def iter_changed_since(self, seq):
+        """Iterate ``(key, entry)`` written after ``seq``, by sequence"""
+        with self._lock:
+            items = [(k, e) for k, e in self.index.iteritems()
+                     if e.seq > seq]
+        return iter(sorted(items, key=lambda item: item[1].seq))
+
+    def get_stats(self):
+        """Get ``(count, size, last_modified)`` of live records"""
+        count, size, last_modified = 0, 0, None
+        with self._lock:
+            for entry in self.index.itervalues():
+                last_modified = max(last_modified, entry.timestamp)
+                if not entry.deleted:
+                    count += 1
+                    size += entry.value_len
+        return count, size, last_modified
+
+    def iter_live(self):
+        """Iterate ``(key, entry)`` of live records"""
+        with self._lock:
+            items = [(k, e) for k, e in self.index.iteritems()
+                     if not e.deleted]
+        return iter(items)
+
+    # Compaction
+    # ------------------------------------------------------------
+
+    @property
+    def garbage_ratio(self):
+        if not self.position:
+            return 0
+        return 1 - (float(self.live_bytes) / self.position)
+
+    def compact(self):
+        """
+        Rewrite live records into a new segment, then drop the old one.
+
+        The bulk of the copy happens without holding the lock; records
+        appended meanwhile are copied over at the end.
+        """
+
+        with self._lock:
+            if self._compacting:
+                return
+            self._acquire_write_lock()
+            if not self.position:
+                return  # Nothing written yet
+            self._compacting = True
+            old_segment = self.segment
+            start_position = self.position
+            snapshot = self.index.items()
+            self._get_writer().flush()
+
+            # Use a separate mapping, as the shared one might get
+            # replaced by readers while we are copying.
+            with open(self._segment_path(old_segment), 'rb') as fp:
+                source = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            new_segment = old_segment + 1
+            new_index = {}
+            with open(self._segment_path(new_segment), 'wb') as out:
+                for key, entry in snapshot:
+                    new_index[key] = IndexEntry(
+                        out.tell(), entry.key_len, entry.value_len,
+                        entry.seq, entry.timestamp, entry.deleted,
+                        entry.hash)
+                    out.write(source[entry.offset:
+                                     entry.offset + entry.record_len])
+
+                with self._lock:
+                    # Copy records appended while we were working
+                    self._get_mmap(self.position)
+                    tail = self._mmap[start_position:self.position]
+                    for key, entry in self.index.iteritems():
+                        if entry.offset < start_position:
+                            continue
+                        new_index[key] = IndexEntry(
+                            out.tell() + entry.offset - start_position,
+                            entry.key_len, entry.value_len, entry.seq,
+                            entry.timestamp, entry.deleted, entry.hash)
+                    out.write(tail)
+                    out.flush()
+                    if self.fsync:
+                        os.fsync(out.fileno())
+
+                    self._close_files()
+                    self.segment = new_segment
+                    self.position = out.tell()
+                    self.index = new_index
+                    self.live_bytes = sum(
+                        e.record_len for e in new_index.itervalues())
+                    self.save_index()
+                    os.unlink(self._segment_path(old_segment))
+
+        finally:
+            source.close()
+            with self._lock:
+                self._compacting = False
+
+    def compact_in_background(self):
+        thread = threading.Thread(target=self.compact)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class LogStorage(BaseStorage):
+    options = [
+        ('fsync', 'bool', False,
+         'Call fsync() when flushing (safer, but slower)'),
+        ('compact_ratio', 'int', 50,
+         'Compact a bucket in background on flush, once this percentage '
+         'of its log is made of superseded records (0 to disable)'),
+        ('document_codec', 'str', None,
+         'Compression codec for documents and keyvals'),
+    ]
+
+    @lazy_property
+    def _basedir(self):
+        if not self.url:
+            raise ValueError("A base directory is required")
+
+        parsed = urlparse.urlparse(self.url)
+        if parsed.scheme not in ('', 'file'):
+            raise ValueError(
+                "Invalid logstore url: {0!r} (invalid scheme)"
+                .format(self.url))
+
+        if parsed.netloc:
+            raise ValueError(
+                "Invalid logstore url: {0!r} (cannot define netloc)"
+                .format(self.url))
+
+        return parsed.path
+
+    @property
+    def _logs(self):
+        # Logs opened by a parent process are not ours to use (nor to
+        # close): their files, locks and mmaps are shared with it.
+        if getattr(self, '_logs_pid', None) != os.getpid():
+            self._cached_logs = None
+            self._logs_pid = os.getpid()
+        if self._cached_logs is None:
+            self._cached_logs = {}
+        return self._cached_logs
+
+    def _get_log(self, bucket_type, name):
+        key = (bucket_type, name)
+        if key not in self._logs:
+            path = os.path.join(self._basedir, bucket_type, _quote(name))
+            self._logs[key] = SegmentLog(
+                path, fsync=self.conf.get('fsync', False))
+        return self._logs[key]
+
+    def flush(self):
+        compact_ratio = self.conf.get('compact_ratio', 50)
+        for log in self._logs.itervalues():
+            log.flush()
+            if compact_ratio and log.garbage_ratio * 100 >= compact_ratio:
+                log.compact_in_background()
+
+    def reopen(self):
+        # Logs are thread-safe, and only one instance per process can
+        # hold the write lock: share this one
+        return self
+
+    def compact(self, background=False):
+        """Compact the logs of all the buckets used so far"""
+        threads = []
+        for log in self._logs.values():
+            if background:
+                threads.append(log.compact_in_background())
+            else:
+                log.compact()
+        return threads
+
+    def close(self):
+        for log in self._logs.itervalues():
+            log.close()
+        self._cached_logs = None
+
+    def flush_storage(self):
+        self.close()
+        for bucket_type in BUCKET_TYPES:
+            path = os.path.join(self._basedir, bucket_type)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+
+class BaseLogBucket(object):
+    bucket_type = None  # to be overwritten in subclasses
+    _keeps_hashes = True
+
+    @classmethod
+    def list_buckets(cls, storage):
+        path = os.path.join(storage._basedir, cls.bucket_type)
+        try:
+            names = os.listdir(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+
+        for name in names:
+            yield urllib.unquote(name).decode('utf-8')
+
+    @property
+    def _log(self):
+        return self.storage._get_log(self.bucket_type, self.name)
+
+    def _get_record(self, key):
+        log = self._log
+        log.refresh()
+        entry, data = log.get_record(key)
+        if entry is None:
+            raise NotFound("Object not found: {0!r}/{1!r}/{2!r}"
+                           .format(self.bucket_type, self.name, key))
+        return entry, data
+
+    def __iter__(self):
+        log = self._log
+        log.refresh()
+        for key, entry in log.iter_live():
+            yield key
+
+    def __len__(self):
+        log = self._log
+        log.refresh()
+        return sum(1 for _ in log.iter_live())
+
+    def __contains__(self, key):
+        log = self._log
+        log.refresh()
+        return log.get_entry(key) is not None
+
+    def stats(self):
+        log = self._log
+        log.refresh()
+        return BucketStats(*log.get_stats())
+
+    def __getitem__(self, key):
+        entry, data = self._get_record(key)
+        return self._deserialize(entry.get_value(data))
+
+    def __setitem__(self, key, value):
+        hash = self._get_write_hash(value)
+        if self._skip_write(key, hash):
+            return
+        self._log.append(key, self._serialize(value),
+                         flush=not self.storage.in_batch, hash=hash)
+
+    def __delitem__(self, key):
+        if key in self:
+            self._log.append(key, None, deleted=True,
+                             flush=not self.storage.in_batch)
+
+    def iter_items(self, batch_size=500, fields=None):
+        projection = self._get_projection(fields)
+        log = self._log
+        log.refresh()
+        items, data = log.snapshot()
+        for key, entry in items:
+            yield key, self._project(
+                self._deserialize(entry.get_value(data)), projection)
+
+    def iter_changed_since(self, seq=0):
+        log = self._log
+        log.refresh()
+        for key, entry in log.iter_changed_since(seq):
+            yield Change(key, entry.seq, entry.timestamp, entry.deleted)
+
+    def _get_entry_hash(self, entry, data):
+        if entry.hash is None:
+            # Replayed record: compute it once
+            entry.hash = self._hash_value(
+                self._deserialize(entry.get_value(data)))
+        return entry.hash
+
+    def _get_stored_hash(self, key):
+        log = self._log
+        log.refresh()
+        entry, data = log.get_record(key)
+        if entry is None:
+            return None
+        return self._get_entry_hash(entry, data)
+
+    def iter_hashes(self):
+        log = self._log
+        log.refresh()
+        items, data = log.snapshot()
+        for key, entry in sorted(items, key=lambda item: item[0]):
+            yield key, self._get_entry_hash(entry, data)
+
+    def _serialize(self, obj):
+        return compression.encode(
+            json.dumps(obj), self.storage.conf.get('document_codec'))
+
+    def _deserialize(self, data):
+        return json.loads(compression.decode(data))
+
+
+class LogDocumentBucket(BaseLogBucket, BaseDocumentBucket):
+    bucket_type = 'document'
+
+
+class LogKeyvalBucket(BaseLogBucket, BaseKeyvalBucket):
+    bucket_type = 'keyval'
+
+
+class LogBlobBucket(BaseLogBucket, BaseBlobBucket):
+    bucket_type = 'blob'
+
+    def _serialize(self, obj):
+        if not isinstance(obj, basestring):
+            raise TypeError("Blob storage can only process strings")
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        return compression.encode(obj, self.storage.conf.get('codec'))
+
+    def _deserialize(self, data):
+        return compression.decode(data)
+
+    def open_read(self, key):
+        entry, data = self._get_record(key)
+        return compression.DecodingReader(RecordReader(entry, data))
+
+
+class RecordReader(object):
+    """
+    Read-only file-like object, reading a value from a mapping of
+    the segment holding it (see ``SegmentLog.get_record()``).
+    """
+
+    def __init__(self, entry, data):
+        self._entry = entry
+        self._data = data
+        self._pos = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        remaining = self._entry.value_len - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        start = self._entry.value_offset + self._pos
+        data = self._data[start:start + size]
+        self._pos += size
+        return data
+
+    def close(self):
+        self.closed = True
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+LogStorage.document_bucket_class = LogDocumentBucket
+LogStorage.blob_bucket_class = LogBlobBucket
+LogStorage.keyval_bucket_class = LogKeyvalBucket
@@ -1,18 +1,128 @@
-"""In-memory database backed by dictionaries"""
+"""
+In-memory database backed by dictionaries.
 
+By default, documents are stored as json, so that callers never
+share mutable objects with the storage. With the ``zero_copy``
+option enabled, documents are instead stored as deeply frozen
+(read-only) copies, which are returned as-is by reads: no parsing
+or copying is involved. Use :py:func:`thaw` to get a mutable copy.
+"""
+
+import itertools
 import json
+import time
 
+from . import compression
 from .base import (BaseStorage, NotFound, BaseDocumentBucket,
-                   BaseBlobBucket, BaseKeyvalBucket)
+                   BaseBlobBucket, BaseKeyvalBucket, BucketStats, Change,
+                   get_field_values, index_key, match_criteria,
+                   prepare_criteria)
+
+
+JSON_SCALARS = (basestring, int, long, float, bool, type(None))
+
+
+def _frozen(self, *a, **kw):
+    raise TypeError("{0} objects are read-only (use thaw() to get a "
+                    "mutable copy)".format(type(self).__name__))
+
+
+class FrozenDict(dict):
+    """Read-only dict, as returned in ``zero_copy`` mode"""
+
+    __setitem__ = __delitem__ = _frozen
+    clear = pop = popitem = setdefault = update = _frozen
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class FrozenList(list):
+    """Read-only list, as returned in ``zero_copy`` mode"""
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _frozen
+    __iadd__ = __imul__ = _frozen
+    append = extend = insert = pop = remove = reverse = sort = _frozen
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(obj):
+    """
+    Get a deeply frozen copy of a json-serializable object.
+
+    :raises TypeError: for objects that cannot be serialized to json
+    """
+    type_ = type(obj)
+    if type_ in _FROZEN_TYPES:
+        return obj
+    if type_ is dict or isinstance(obj, dict):
+        frozen = {}
+        for key, value in obj.iteritems():
+            if type(key) not in _STRING_TYPES:
+                key = _freeze_key(key)
+            frozen[key] = freeze(value)
+        return FrozenDict(frozen)
+    if type_ in _SEQUENCE_TYPES or isinstance(obj, (list, tuple)):
+        return FrozenList([freeze(x) for x in obj])
+    if isinstance(obj, JSON_SCALARS):
+        return obj
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+def _freeze_key(key):
+    # Same as json: keys are always strings
+    if isinstance(key, basestring):
+        return key
+    if key is None or isinstance(key, bool):
+        return json.dumps(key)
+    if isinstance(key, JSON_SCALARS):
+        return unicode(key)
+    raise TypeError("key {0!r} is not a string".format(key))
+
+
+_STRING_TYPES = frozenset((str, unicode))
+_SEQUENCE_TYPES = frozenset((list, tuple))
+_FROZEN_TYPES = frozenset((
+    str, unicode, int, long, float, bool, type(None),
+    FrozenDict, FrozenList))
+
+
+def thaw(obj):
+    """Get a mutable (deep) copy of an object returned by the storage"""
+    if isinstance(obj, dict):
+        return dict((k, thaw(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [thaw(x) for x in obj]
+    return obj
 
 
 class BaseMemoryBucket(object):
     bucket_type = None  # to be overwritten in subclasses
+    _keeps_hashes = True
 
     def __init__(self, *a, **kw):
         super(BaseMemoryBucket, self).__init__(*a, **kw)
         if getattr(self.storage, '_data', None) is None:
             self.storage._data = {}
+        if getattr(self.storage, '_changes', None) is None:
+            self.storage._changes = {}
+            self.storage._seq = itertools.count(1)
+        if getattr(self.storage, '_hashes', None) is None:
+            self.storage._hashes = {}
 
     def _ensure_bucket_storage(self):
         if self.bucket_type not in self.storage._data:
@@ -31,6 +141,12 @@ class BaseMemoryBucket(object):
         for name in bucket_names:
             yield name
 
+    def __contains__(self, name):
+        try:
+            return name in self.storage._data[self.bucket_type][self.name]
+        except KeyError:
+            return False
+
     def __getitem__(self, name):
         try:
             raw = self.storage._data[self.bucket_type][self.name][name]
@@ -40,15 +156,77 @@ class BaseMemoryBucket(object):
         return self._deserialize(raw)
 
     def __setitem__(self, name, value):
+        hash = self._get_write_hash(value)
+        if self._skip_write(name, hash):
+            return
         self._ensure_bucket_storage()
         serialized = self._serialize(value)
         self.storage._data[self.bucket_type][self.name][name] = serialized
+        self._hashes[name] = hash
+        self._record_change(name)
 
     def __delitem__(self, name):
         try:
             del self.storage._data[self.bucket_type][self.name][name]
         except KeyError:
             pass
+        else:
+            self._hashes.pop(name, None)
+            self._record_change(name, deleted=True)
+
+    def clear(self):
+        try:
+            data = self.storage._data[self.bucket_type].pop(self.name)
+        except KeyError:
+            return
+        self._hashes.clear()
+        for name in data:
+            self._record_change(name, deleted=True)
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        target, source = cls(storage, name), cls(storage, source_name)
+        buckets = storage._data.setdefault(cls.bucket_type, {})
+        old_keys = set(buckets.get(name, ()))
+        old_hashes = target._hashes
+        new_hashes = storage._hashes[cls.bucket_type, name] = source._hashes
+
+        # A single assignment: readers see either bucket as a whole
+        buckets[name] = buckets.pop(source_name, {})
+        storage._hashes[cls.bucket_type, source_name] = {}
+        storage._changes.pop((cls.bucket_type, source_name), None)
+
+        for key in old_keys:
+            if key not in buckets[name]:
+                target._record_change(key, deleted=True)
+        for key in buckets[name]:
+            if key not in old_keys or old_hashes.get(key) != new_hashes[key]:
+                target._record_change(key)
+
+    @property
+    def _hashes(self):
+        return self.storage._hashes.setdefault(
+            (self.bucket_type, self.name), {})
+
+    def _get_stored_hash(self, name):
+        return self._hashes.get(name)
+
+    def iter_hashes(self):
+        hashes = self._hashes
+        return iter(sorted((key, hashes[key]) for key in self))
+
+    @property
+    def _changes(self):
+        return self.storage._changes.setdefault(
+            (self.bucket_type, self.name), {})
+
+    def _record_change(self, name, deleted=False):
+        self._changes[name] = Change(
+            name, next(self.storage._seq), time.time(), deleted)
+
+    def iter_changed_since(self, seq=0):
+        changes = [c for c in self._changes.itervalues() if c.seq > seq]
+        return iter(sorted(changes, key=lambda c: c.seq))
 
     def __iter__(self):
         try:
@@ -56,29 +234,128 @@ class BaseMemoryBucket(object):
         except KeyError:
             return iter([])
 
+    def iter_items(self, batch_size=500, fields=None):
+        try:
+            data = self.storage._data[self.bucket_type][self.name]
+        except KeyError:
+            return
+
+        # Take a snapshot, to allow changing the bucket while iterating
+        projection = self._get_projection(fields)
+        for key, raw in data.items():
+            yield key, self._project(self._deserialize(raw), projection)
+
     def __len__(self):
         try:
             return len(self.storage._data[self.bucket_type][self.name])
         except KeyError:
             return 0
 
+    def stats(self):
+        try:
+            data = self.storage._data[self.bucket_type][self.name]
+        except KeyError:
+            data = {}
+        # Documents stored as frozen objects (see zero_copy) have no size
+        sizes = [len(raw) for raw in data.itervalues()
+                 if isinstance(raw, basestring)]
+        size = sum(sizes) if len(sizes) == len(data) else None
+        last_modified = max(
+            [c.timestamp for c in self._changes.itervalues()] or [None])
+        return BucketStats(len(data), size, last_modified)
+
     def _serialize(self, obj):
+        if self.storage.conf.get('zero_copy', False):
+            return freeze(obj)
+
         # We store values as json by default, in order to make sure
         # 1. they are json-serializable objects, suitable for other
         #    storages too
         # 2. no references to mutable objects are kept around, causing
         #    misbehaviors..
-        return json.dumps(obj)
+        return compression.encode(
+            json.dumps(obj), self.storage.conf.get('document_codec'))
 
     def _deserialize(self, obj):
+        if self.storage.conf.get('zero_copy', False):
+            return obj  # Frozen, so safe to share
+
         # By deserializing from json each time we make sure we return
         # fresh objects each time, w/o worrying about mutating objects
-        return json.loads(obj)
+        return json.loads(compression.decode(obj))
 
 
 class MemoryDocumentBucket(BaseMemoryBucket, BaseDocumentBucket):
     bucket_type = 'document'
 
+    @property
+    def _indexes(self):
+        """Hash indexes for this bucket: ``{path: FieldIndex}``"""
+        if getattr(self.storage, '_indexes', None) is None:
+            self.storage._indexes = {}
+        return self.storage._indexes.setdefault(self.name, {})
+
+    def create_index(self, path):
+        if path in self._indexes:
+            return
+        index = FieldIndex(path)
+        for key, doc in self.iter_items():
+            index.add(key, doc)
+        self._indexes[path] = index
+
+    def find(self, criteria=None, **kwargs):
+        criteria = prepare_criteria(criteria, kwargs)
+        indexes = self._indexes
+
+        keys = None
+        for path, value in criteria.iteritems():
+            if path in indexes:
+                found = indexes[path].lookup(value)
+                keys = found if keys is None else keys & found
+
+        if keys is None:
+            # No usable index: scan the whole bucket
+            for item in super(MemoryDocumentBucket, self).find(criteria):
+                yield item
+            return
+
+        for key in keys:
+            try:
+                doc = self[key]
+            except NotFound:
+                continue
+            if match_criteria(doc, criteria):
+                yield key, doc
+
+    def __setitem__(self, name, value):
+        super(MemoryDocumentBucket, self).__setitem__(name, value)
+        for index in self._indexes.itervalues():
+            index.add(name, value)
+
+    def __delitem__(self, name):
+        super(MemoryDocumentBucket, self).__delitem__(name)
+        for index in self._indexes.itervalues():
+            index.discard(name)
+
+    def clear(self):
+        super(MemoryDocumentBucket, self).clear()
+        indexes = self._indexes
+        for path in indexes:
+            indexes[path] = FieldIndex(path)
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        target, source = cls(storage, name), cls(storage, source_name)
+        paths = set(target._indexes) | set(source._indexes)
+        super(MemoryDocumentBucket, cls).replace_bucket(
+            storage, name, source_name)
+
+        # Rebuild indexes from scratch
+        storage._indexes[name] = {}
+        storage._indexes[source_name] = {}
+        for path in paths:
+            target.create_index(path)
+
 
 class MemoryKeyvalBucket(BaseMemoryBucket, BaseKeyvalBucket):
     bucket_type = 'keyval'
@@ -96,10 +373,36 @@ class MemoryBlobBucket(BaseMemoryBucket, BaseBlobBucket):
         if isinstance(obj, unicode):
             obj = obj.encode('utf-8')
 
-        return obj
+        return compression.encode(obj, self.storage.conf.get('codec'))
 
     def _deserialize(self, obj):
-        return obj
+        return compression.decode(obj)
+
+
+class FieldIndex(object):
+    """In-process hash index, mapping field values to document keys"""
+
+    def __init__(self, path):
+        self.path = path
+        self._keys_by_value = {}
+        self._values_by_key = {}
+
+    def add(self, key, doc):
+        self.discard(key)
+        values = set(index_key(v) for v in get_field_values(doc, self.path))
+        for value in values:
+            self._keys_by_value.setdefault(value, set()).add(key)
+        self._values_by_key[key] = values
+
+    def discard(self, key):
+        for value in self._values_by_key.pop(key, ()):
+            keys = self._keys_by_value[value]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_value[value]
+
+    def lookup(self, value):
+        return set(self._keys_by_value.get(index_key(value), ()))
 
 
 class MemoryStorage(BaseStorage):
@@ -107,9 +410,27 @@ class MemoryStorage(BaseStorage):
     blob_bucket_class = MemoryBlobBucket
     keyval_bucket_class = MemoryKeyvalBucket
 
+    options = [
+        ('document_codec', 'str', None,
+         'Compression codec for documents and keyvals'),
+        ('zero_copy', 'bool', False,
+         'Store documents and keyvals as read-only objects, returned '
+         'without copying (ignores document_codec)'),
+    ]
+
     def __init__(self, *a, **kw):
         super(MemoryStorage, self).__init__(*a, **kw)
         self._data = {}  # Initialize storage space..
+        self._changes = {}
+        self._seq = itertools.count(1)
+        self._hashes = {}
 
     def flush_storage(self):
         self._data = {}
+        self._indexes = None
+        self._changes = {}
+        self._hashes = {}
+
+    def reopen(self):
+        # Data only lives in this instance
+        return self
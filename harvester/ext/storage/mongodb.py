@@ -1,14 +1,69 @@
+"""
+MongoDB-based storage.
+
+- Documents are stored in a collection per bucket
+- Blobs are stored in GridFS, and can be streamed in chunks using
+  ``open_read()`` / ``open_write()``; they can be compressed, see the
+  ``codec`` option
+- Keyvals are stored in a collection per bucket, as ``{"value": ...}``
+- Changes are recorded in the ``_changes`` collection, one document per
+  key holding its last write sequence, timestamp, deleted flag and
+  content hash. Sequence numbers come from a counter in the
+  ``_counters`` collection, incremented once for each batch of
+  changes (ie. once per flush, when in batch mode).
+- ``clear()`` drops the bucket collection(s); ``replace_bucket()``
+  renames the source collection over the target one, which is atomic
+  for documents and keyvals. Blob buckets live in two collections
+  (``.files`` and ``.chunks``), renamed one after the other: readers
+  might briefly see the bucket empty.
+
+Each process opens its own connection (MongoClient instances cannot be
+shared with forked processes), so storages can be passed to worker
+processes. Within a process, storages pointing to the same server
+share a single client (see :py:mod:`.connections`).
+
+When running inside a ``storage.batch()`` block, document and keyval
+writes are buffered and sent to the server as unordered bulk
+operations, every ``batch_size`` operations or ``batch_interval``
+seconds, whichever comes first. Reading from a bucket flushes its
+pending writes first.
+"""
+
+import copy
+import os
+import time
 import urlparse
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient
 from gridfs import GridFS
+from gridfs.errors import NoFile
 
 from harvester.utils import lazy_property
+from . import compression, connections
 from .base import (BaseStorage, BaseDocumentBucket, BaseBlobBucket,
-                   BaseKeyvalBucket, NotFound)
+                   BaseKeyvalBucket, BucketStats, Change, NotFound,
+                   iter_chunks, prepare_criteria)
+
+
+# Maximum number of keys in a single ``$in`` query
+MAX_QUERY_KEYS = 1000
+
+
+def _check_client(client):
+    client.admin.command('ping')
+
+
+def _close_client(client):
+    client.close()
 
 
 class MongodbStorage(BaseStorage):
+    options = [
+        ('batch_size', 'int', 1000,
+         'When in batch mode, send writes in bulks of N operations'),
+        ('batch_interval', 'int', 5,
+         'When in batch mode, send pending writes at least every N seconds'),
+    ]
 
     @lazy_property
     def _mongo_config(self):
@@ -44,10 +99,23 @@ class MongodbStorage(BaseStorage):
     def _mongo_prefix(self):
         return self._mongo_config['prefix']
 
+    def _check_pid(self):
+        """Drop connections and buffers inherited from a parent process"""
+        if getattr(self, '_owner_pid', None) != os.getpid():
+            self._cached_connection = None
+            self._cached_pending_writes = None
+            self._pending_count = 0
+            self._changes_index_ensured = False
+            self._owner_pid = os.getpid()
+
     @property
     def _connection(self):
-        if getattr(self, '_cached_connection', None) is None:
-            self._cached_connection = MongoClient(self._mongo_url)
+        self._check_pid()
+        if self._cached_connection is None:
+            self._cached_connection = connections.registry.acquire(
+                self, ('mongodb', self._mongo_url),
+                lambda: MongoClient(self._mongo_url),
+                check=_check_client, close=_close_client, shared=True)
         return self._cached_connection
 
     @property
@@ -112,7 +180,177 @@ class MongodbStorage(BaseStorage):
     def _list_buckets(self, bucket_type):
         return self._list_sub_collections(bucket_type)
 
+    @property
+    def _pending_writes(self):
+        # Mapping of {collection_name: {key: (document or None, hash)}};
+        # writes to the same key are coalesced, as the order of
+        # operations in an unordered bulk is not guaranteed.
+        self._check_pid()
+        if self._cached_pending_writes is None:
+            self._cached_pending_writes = {}
+        return self._cached_pending_writes
+
+    def _buffer_write(self, coll_name, key, doc, hash=None):
+        """
+        Add a write to the buffer; ``doc`` is None for deletions.
+        """
+        self._pending_writes.setdefault(coll_name, {})[key] = (doc, hash)
+        self._pending_count = getattr(self, '_pending_count', 0) + 1
+        if self._pending_count == 1:
+            self._pending_since = time.time()
+
+        if self._pending_count >= self.conf.get('batch_size', 1000):
+            self.flush()
+            return
+
+        _elapsed = time.time() - self._pending_since
+        if _elapsed >= self.conf.get('batch_interval', 5):
+            self.flush()
+
+    def _flush_collection(self, coll_name):
+        """Send pending writes for a collection, as unordered bulk"""
+        pending = self._pending_writes.pop(coll_name, None)
+        if not pending:
+            return
+
+        bulk = self._database[coll_name].initialize_unordered_bulk_op()
+        for key, (doc, hash) in pending.iteritems():
+            if doc is None:
+                bulk.find({'_id': key}).remove_one()
+            else:
+                bulk.find({'_id': key}).upsert().replace_one(doc)
+        bulk.execute()
+
+        self._record_changes(coll_name, [
+            (key, doc is None, hash)
+            for key, (doc, hash) in pending.iteritems()])
+
+    @property
+    def _changes_collection(self):
+        coll = self._get_collection('_changes')
+        if not getattr(self, '_changes_index_ensured', False):
+            coll.ensure_index([('c', ASCENDING), ('seq', ASCENDING)])
+            coll.ensure_index([('c', ASCENDING), ('k', ASCENDING)])
+            self._changes_index_ensured = True
+        return coll
+
+    def _allocate_seq(self, count):
+        """Allocate ``count`` sequence numbers, returning the first one"""
+        counter = self._get_collection('_counters').find_and_modify(
+            {'_id': 'changes'}, {'$inc': {'seq': count}},
+            upsert=True, new=True)
+        return counter['seq'] - count + 1
+
+    def _record_changes(self, coll_name, changes):
+        """
+        Record changes to a collection.
+
+        :param changes: list of ``(key, deleted, hash)`` tuples
+        """
+        if not changes:
+            return
+
+        seq = self._allocate_seq(len(changes))
+        now = time.time()
+        bulk = self._changes_collection.initialize_unordered_bulk_op()
+        for i, (key, deleted, hash) in enumerate(changes):
+            change = {'c': coll_name, 'k': key, 'seq': seq + i,
+                      'timestamp': now, 'deleted': deleted, 'hash': hash}
+            selector = {'_id': {'c': coll_name, 'k': key}}
+            bulk.find(selector).upsert().replace_one(change)
+        bulk.execute()
+
+    def _record_replaced(self, coll_name, source_name, old_keys, new_keys):
+        """
+        Record the changes made by replacing a collection with another
+        one, whose changes are forgotten; objects with the same hash in
+        both are left alone.
+        """
+        coll = self._changes_collection
+        old_hashes = dict(
+            (obj['k'], obj.get('hash')) for obj in coll.find(
+                {'c': coll_name, 'deleted': False}, fields=['k', 'hash']))
+        new_hashes = dict(
+            (obj['k'], obj.get('hash')) for obj in coll.find(
+                {'c': source_name, 'deleted': False}, fields=['k', 'hash']))
+
+        changes = [(key, True, None) for key in old_keys - new_keys]
+        for key in new_keys:
+            hash = new_hashes.get(key)
+            unchanged = hash is not None and hash == old_hashes.get(key)
+            if key in old_keys and unchanged:
+                continue
+            changes.append((key, False, hash))
+
+        self._record_changes(coll_name, changes)
+        coll.remove({'c': source_name})
+
+    def _get_collection_stats(self, coll_name):
+        """
+        Get ``(count, size)`` of a collection, from the server metadata
+        (``collStats``), without scanning it.
+        """
+        if coll_name not in self._database.collection_names():
+            return 0, 0
+        stats = self._database.command('collstats', coll_name)
+        return stats['count'], stats['size']
+
+    def _get_last_modified(self, coll_name):
+        """Get the timestamp of the last change to a collection"""
+        change = self._changes_collection.find_one(
+            {'c': coll_name}, fields=['timestamp'],
+            sort=[('seq', DESCENDING)])
+        if change is None:
+            return None
+        return change['timestamp']
+
+    def _iter_changes(self, coll_name, seq):
+        query = {'c': coll_name, 'seq': {'$gt': seq}}
+        for obj in self._changes_collection.find(query).sort('seq'):
+            yield Change(obj['k'], obj['seq'], obj['timestamp'],
+                         obj['deleted'])
+
+    def _get_recorded_hash(self, coll_name, key):
+        """Get the hash recorded for an object, or None"""
+        pending = self._pending_writes.get(coll_name, {})
+        if key in pending:
+            doc, hash = pending[key]
+            return hash
+        change = self._changes_collection.find_one(
+            {'c': coll_name, 'k': key, 'deleted': False}, fields=['hash'])
+        if change is None:
+            return None
+        return change.get('hash')
+
+    def _iter_hashes(self, coll_name, keys, get_hash):
+        """
+        Merge sorted keys with the hashes recorded in the changes
+        collection; hashes missing there (eg. for objects written by
+        older versions) are computed by ``get_hash(key)``.
+        """
+        query = {'c': coll_name, 'deleted': False}
+        changes = self._changes_collection.find(
+            query, fields=['k', 'hash']).sort('k')
+        change = next(changes, None)
+        for key in keys:
+            while change is not None and change['k'] < key:
+                change = next(changes, None)
+            hash = None
+            if change is not None and change['k'] == key:
+                hash = change.get('hash')
+            if hash is None:
+                hash = get_hash(key)
+            yield key, hash
+
+    def flush(self):
+        for coll_name in list(self._pending_writes):
+            self._flush_collection(coll_name)
+        self._pending_count = 0
+
     def flush_storage(self):
+        self._cached_pending_writes = None
+        self._pending_count = 0
+
         # If no prefix was configured, we can just drop the whole
         # database. Otherwise, we need to drop our collections one-by-one.
         if self._mongo_prefix is None:
@@ -124,6 +362,7 @@ class MongodbStorage(BaseStorage):
 
 class BaseMongoBucket(object):
     bucket_type = None  # to be overwritten by subclasses
+    _keeps_hashes = True
 
     @classmethod
     def list_buckets(cls, storage):
@@ -141,17 +380,59 @@ class BaseMongoBucket(object):
     def _get_collection(self):
         return self.storage._get_collection([self.bucket_type, self.name])
 
-    def __iter__(self):
+    def _get_collection_for_read(self):
+        """Get the collection, after sending any pending write to it"""
         coll = self._get_collection()
+        self.storage._flush_collection(coll.name)
+        return coll
+
+    def __iter__(self):
+        coll = self._get_collection_for_read()
         for obj in coll.find(fields=['_id']):
             yield obj['_id']
 
     def __len__(self):
-        coll = self._get_collection()
+        coll = self._get_collection_for_read()
         return coll.count()
 
+    def stats(self):
+        coll = self._get_collection_for_read()
+        count, size = self.storage._get_collection_stats(coll.name)
+        return BucketStats(count, size,
+                           self.storage._get_last_modified(coll.name))
+
+    def keys_page(self, after=None, limit=50):
+        coll = self._get_collection_for_read()
+        return self._keys_page(coll, after, limit)
+
+    def _keys_page(self, coll, after, limit):
+        spec = {} if after is None else {'_id': {'$gt': after}}
+        cursor = coll.find(spec, fields=['_id']).sort('_id').limit(limit)
+        return [obj['_id'] for obj in cursor]
+
+    def iter_items(self, batch_size=500, fields=None):
+        coll = self._get_collection_for_read()
+        cursor = coll.find(fields=self._get_mongo_fields(fields))
+        for obj in cursor.batch_size(batch_size):
+            key = obj.pop('_id')
+            yield key, self._deserialize(obj)
+
+    def _get_mongo_fields(self, fields):
+        """
+        Get the fields to be returned by MongoDB (None for all), which
+        projects documents the same way as :py:class:`Projection`
+        """
+        projection = self._get_projection(fields)
+        if projection is None:
+            return None
+        return projection.fields
+
+    def __contains__(self, name):
+        coll = self._get_collection_for_read()
+        return coll.find_one(name, fields=['_id']) is not None
+
     def __getitem__(self, name):
-        coll = self._get_collection()
+        coll = self._get_collection_for_read()
         obj = coll.find_one(name)
         if obj is None:
             raise NotFound('Object not found')
@@ -159,14 +440,93 @@ class BaseMongoBucket(object):
         return self._deserialize(obj)
 
     def __setitem__(self, name, value):
+        hash = self._get_write_hash(value)
+        if self._skip_write(name, hash):
+            return
+
         coll = self._get_collection()
         value = self._serialize(value)
+
+        if self.storage.in_batch:
+            # Take a copy, as the caller might change the object
+            # before the buffered write is actually sent
+            value = copy.deepcopy(value)
+            value['_id'] = name
+            self.storage._buffer_write(coll.name, name, value, hash)
+            return
+
         value['_id'] = name
         coll.update({'_id': value['_id']}, value, upsert=True)
+        self.storage._record_changes(coll.name, [(name, False, hash)])
 
     def __delitem__(self, name):
         coll = self._get_collection()
+        if self.storage.in_batch:
+            self.storage._buffer_write(coll.name, name, None)
+            return
         coll.remove({'_id': name})
+        self.storage._record_changes(coll.name, [(name, True, None)])
+
+    def get_many(self, keys):
+        coll = self._get_collection_for_read()
+        result = {}
+        for chunk in iter_chunks(keys, MAX_QUERY_KEYS):
+            for obj in coll.find({'_id': {'$in': chunk}}):
+                key = obj.pop('_id')
+                result[key] = self._deserialize(obj)
+        return result
+
+    def delete_many(self, keys):
+        coll = self._get_collection()
+        if self.storage.in_batch:
+            for key in keys:
+                self.storage._buffer_write(coll.name, key, None)
+            return
+        for chunk in iter_chunks(keys, MAX_QUERY_KEYS):
+            spec = {'_id': {'$in': chunk}}
+            found = [obj['_id'] for obj in coll.find(spec, fields=['_id'])]
+            coll.remove(spec)
+            self.storage._record_changes(
+                coll.name, [(key, True, None) for key in found])
+
+    def clear(self):
+        coll = self._get_collection_for_read()
+        keys = [obj['_id'] for obj in coll.find(fields=['_id'])]
+        coll.drop()
+        self.storage._record_changes(
+            coll.name, [(key, True, None) for key in keys])
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        target, source = cls(storage, name), cls(storage, source_name)
+        coll = target._get_collection_for_read()
+        source_coll = source._get_collection_for_read()
+        old_keys = set(target)
+        new_keys = set(source)
+
+        if new_keys:
+            source_coll.rename(coll.name, dropTarget=True)
+        else:
+            coll.drop()  # Renaming a missing collection would fail
+        storage._record_replaced(coll.name, source_coll.name,
+                                 old_keys, new_keys)
+
+    def iter_changed_since(self, seq=0):
+        coll = self._get_collection_for_read()
+        return self.storage._iter_changes(coll.name, seq)
+
+    def _get_stored_hash(self, name):
+        hash = self.storage._get_recorded_hash(
+            self._get_collection().name, name)
+        if hash is not None:
+            return hash
+        return super(BaseMongoBucket, self)._get_stored_hash(name)
+
+    def iter_hashes(self):
+        coll = self._get_collection_for_read()
+        keys = (obj['_id'] for obj in coll.find(fields=['_id']).sort('_id'))
+        return self.storage._iter_hashes(
+            coll.name, keys, lambda key: self._hash_value(self[key]))
 
     def _serialize(self, obj):
         return obj
@@ -178,6 +538,26 @@ class BaseMongoBucket(object):
 class MongoDocumentBucket(BaseMongoBucket, BaseDocumentBucket):
     bucket_type = 'document'
 
+    def get(self, key, default=None, fields=None):
+        if fields is None:
+            return super(MongoDocumentBucket, self).get(key, default)
+        coll = self._get_collection_for_read()
+        obj = coll.find_one(key, fields=self._get_mongo_fields(fields))
+        if obj is None:
+            return default
+        obj.pop('_id', None)
+        return self._deserialize(obj)
+
+    def create_index(self, path):
+        self._get_collection().ensure_index(path)
+
+    def find(self, criteria=None, **kwargs):
+        # MongoDB criteria already have the semantics we want
+        coll = self._get_collection_for_read()
+        for obj in coll.find(prepare_criteria(criteria, kwargs)):
+            key = obj.pop('_id')
+            yield key, self._deserialize(obj)
+
 
 class MongoBlobBucket(BaseMongoBucket, BaseBlobBucket):
     """MongoDB "blob" bucket uses GridFS to store binary data"""
@@ -214,21 +594,201 @@ class MongoBlobBucket(BaseMongoBucket, BaseBlobBucket):
             yield g._id
 
     def __len__(self):
+        files = self.storage._database[self._get_changes_name() + '.files']
+        return files.count()
+
+    def stats(self):
+        # Files hold blob metadata (eg. lengths), chunks their contents
+        coll_name = self._get_changes_name()
+        get_stats = self.storage._get_collection_stats
+        count = get_stats(coll_name + '.files')[0]
+        size = get_stats(coll_name + '.chunks')[1]
+        return BucketStats(count, size,
+                           self.storage._get_last_modified(coll_name))
+
+    def keys_page(self, after=None, limit=50):
+        files = self.storage._database[self._get_changes_name() + '.files']
+        return self._keys_page(files, after, limit)
+
+    def iter_items(self, batch_size=500, fields=None):
+        self._get_projection(fields)  # Blobs have no fields
         grid = self._get_gridfs()
-        return len(list(grid.find()))  # todo: improve this!
+        for g in grid.find().batch_size(batch_size):
+            yield g._id, compression.decode(g.read())
+
+    def __contains__(self, name):
+        return self._get_gridfs().exists(name)
 
     def __getitem__(self, name):
-        grid = self._get_gridfs()
-        return grid.get(name).read()
+        return self.open_read(name).read()
 
     def __setitem__(self, name, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        hash = self._get_write_hash(value)
+        if self._skip_write(name, hash):
+            return
+        value = compression.encode(value, self.storage.conf.get('codec'))
+        with GridFSBlobWriter(self, name) as fp:
+            fp.write(value)
+        self._record_change(name, hash=hash)
+
+    def open_read(self, name):
         grid = self._get_gridfs()
-        grid.delete(name)
-        grid.put(value, _id=name)
+        try:
+            return compression.DecodingReader(grid.get(name))
+        except NoFile:
+            raise NotFound('Object not found')
+
+    def open_write(self, name):
+        return compression.wrap_writer(
+            GridFSBlobWriter(self, name,
+                             on_close=lambda: self._on_stream_written(name)),
+            self.storage.conf.get('codec'))
+
+    def _move_file(self, file_id, name):
+        """
+        Give a GridFS file a new id, replacing the file with that id
+        (if any); ids can't be changed, so the files entry is copied.
+        """
+        coll_name = self._get_changes_name()
+        files = self.storage._database[coll_name + '.files']
+        chunks = self.storage._database[coll_name + '.chunks']
+        obj = files.find_one({'_id': file_id})
+        obj['_id'] = name
+
+        # Same as GridFS.delete(), then chunks go first, as readers
+        # look files up first
+        files.remove({'_id': name})
+        chunks.remove({'files_id': name})
+        chunks.update({'files_id': file_id}, {'$set': {'files_id': name}},
+                      multi=True)
+        files.insert(obj)
+        files.remove({'_id': file_id})
 
     def __delitem__(self, name):
         grid = self._get_gridfs()
         grid.delete(name)
+        self._record_change(name, deleted=True)
+
+    def get_many(self, keys):
+        # Files are looked up in batches; their contents still need
+        # a query each, as they are stored as separate chunks.
+        grid = self._get_gridfs()
+        result = {}
+        for chunk in iter_chunks(keys, MAX_QUERY_KEYS):
+            for g in grid.find({'_id': {'$in': chunk}}):
+                result[g._id] = compression.decode(g.read())
+        return result
+
+    def delete_many(self, keys):
+        coll_name = self._get_changes_name()
+        files = self.storage._database[coll_name + '.files']
+        chunks = self.storage._database[coll_name + '.chunks']
+        for chunk in iter_chunks(keys, MAX_QUERY_KEYS):
+            spec = {'_id': {'$in': chunk}}
+            found = [obj['_id'] for obj in files.find(spec, fields=['_id'])]
+
+            # Same as GridFS.delete(), for many files at once
+            files.remove(spec)
+            chunks.remove({'files_id': {'$in': chunk}})
+            self.storage._record_changes(
+                coll_name, [(key, True, None) for key in found])
+
+    def clear(self):
+        coll_name = self._get_changes_name()
+        keys = list(self)
+        for suffix in ('.files', '.chunks'):
+            self.storage._database.drop_collection(coll_name + suffix)
+        self.storage._record_changes(
+            coll_name, [(key, True, None) for key in keys])
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        target, source = cls(storage, name), cls(storage, source_name)
+        coll_name = target._get_changes_name()
+        source_coll_name = source._get_changes_name()
+        old_keys, new_keys = set(target), set(source)
+
+        # Files go last, as readers look them up first
+        database = storage._database
+        existing = set(database.collection_names())
+        database.drop_collection(coll_name + '.files')
+        for suffix in ('.chunks', '.files'):
+            if source_coll_name + suffix in existing:
+                database[source_coll_name + suffix].rename(
+                    coll_name + suffix, dropTarget=True)
+            else:
+                database.drop_collection(coll_name + suffix)
+        storage._record_replaced(
+            coll_name, source_coll_name, old_keys, new_keys)
+
+    def _get_changes_name(self):
+        return self.storage._get_collection_name(
+            [self.bucket_type, self.name])
+
+    def _record_change(self, name, deleted=False, hash=None):
+        # Hashes of streamed blobs are computed when first needed
+        self.storage._record_changes(
+            self._get_changes_name(), [(name, deleted, hash)])
+
+    def _on_stream_written(self, name):
+        self.storage.write_stats['written'] += 1
+        self._record_change(name)
+
+    def iter_changed_since(self, seq=0):
+        return self.storage._iter_changes(self._get_changes_name(), seq)
+
+    def iter_hashes(self):
+        grid = self._get_gridfs()
+        keys = (g._id for g in grid.find().sort('_id'))
+        return self.storage._iter_hashes(
+            self._get_changes_name(), keys,
+            lambda key: self._hash_value(self[key]))
+
+
+class GridFSBlobWriter(object):
+    """
+    Wrapper around a ``GridIn`` file, writing a blob under a temporary
+    id and moving it in place on close; the partially written file is
+    discarded (leaving the existing blob untouched) if the ``with``
+    block exits with an exception.
+    """
+
+    def __init__(self, bucket, name, on_close=None):
+        self._bucket = bucket
+        self._name = name
+        self._grid = bucket._get_gridfs()
+        self._gridin = self._grid.new_file()
+        self._on_close = on_close
+
+    @property
+    def closed(self):
+        return self._gridin.closed
+
+    def write(self, data):
+        self._gridin.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._gridin.close()
+        self._bucket._move_file(self._gridin._id, self._name)
+        if self._on_close is not None:
+            self._on_close()
+
+    def abort(self):
+        self._gridin.close()
+        self._grid.delete(self._gridin._id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
 
 class MongoKeyvalBucket(BaseMongoBucket, BaseKeyvalBucket):
@@ -0,0 +1,292 @@
+"""
+Full-text search over document buckets.
+
+Indexes are kept in a "sidecar" SQLite file, separate from the
+storage (which can be of any kind), using the FTS5 extension. Each
+document bucket gets its own full-text table, holding all the string
+and number values found in documents, updated incrementally from the
+change stream of the bucket (see ``iter_changed_since()``): the first
+search builds the whole index, the following ones only process the
+objects changed meanwhile. Storages not tracking changes (eg.
+sharded ones) cannot be indexed.
+
+The last indexed change is checked to be still there (or superseded
+by a later one) on each update: if it isn't, the storage was
+recreated (eg. its file replaced, or flushed) since, restarting
+sequence numbers, and the index of the bucket is built again. Changes
+are requested again starting from the one before the last indexed
+change, as sequence numbers are opaque (eg. byte offsets, for
+``jsondir`` storages): no arithmetic is ever done on them.
+
+Queries are lists of words, all of which must be found in matching
+documents; words ending with ``*`` match as prefixes.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+
+from .base import iter_chunks
+
+
+# Number of documents fetched, and indexed, at once
+INDEX_BATCH_SIZE = 500
+
+#: Default delimiters of matching words in snippets
+SNIPPET_MARKERS = ('[', ']')
+
+
+def get_index_path(basedir, storage_url):
+    """Get the path of the index file for a storage, in ``basedir``"""
+    if isinstance(storage_url, unicode):
+        storage_url = storage_url.encode('utf-8')
+    name = hashlib.sha1(storage_url).hexdigest()
+    return os.path.join(basedir, name + '.sqlite')
+
+
+def extract_text(obj):
+    """Get the text to be indexed for a document: its values, one per line"""
+    values = []
+
+    def _extract(value):
+        if isinstance(value, dict):
+            for item in value.itervalues():
+                _extract(item)
+        elif isinstance(value, list):
+            for item in value:
+                _extract(item)
+        elif isinstance(value, bool) or value is None:
+            pass
+        elif isinstance(value, (int, long, float)):
+            values.append(unicode(value))
+        elif isinstance(value, basestring):
+            values.append(value)
+
+    _extract(obj)
+    return u'\n'.join(values)
+
+
+def prepare_query(text):
+    """
+    Convert a user query to a FTS5 one, quoting words so that
+    punctuation is never taken for operators.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if not word:
+            continue
+        term = u'"{0}"'.format(word.replace('"', '""'))
+        if prefix:
+            term += u'*'
+        terms.append(term)
+    return u' '.join(terms)
+
+
+class SearchIndex(object):
+    """
+    Full-text index of the document buckets of a storage.
+
+    :param path: path of the index file (created if missing)
+    :param timeout: seconds to wait for other processes updating it
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            # We manage transactions ourselves, see update()
+            conn.isolation_level = None
+            conn.execute('PRAGMA journal_mode=wal;')
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS buckets
+            ( id INTEGER PRIMARY KEY, name TEXT UNIQUE, seq INTEGER,
+              last_key, last_timestamp REAL, prev_seq INTEGER );
+            """)
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(buckets);')]
+            if 'last_key' not in columns:
+                # Created by an older version: buckets get rebuilt
+                conn.execute('ALTER TABLE buckets ADD COLUMN last_key;')
+                conn.execute('ALTER TABLE buckets '
+                             'ADD COLUMN last_timestamp REAL;')
+            if 'prev_seq' not in columns:
+                conn.execute('ALTER TABLE buckets '
+                             'ADD COLUMN prev_seq INTEGER;')
+            self._connection = conn
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _get_bucket_id(self, name, create=False):
+        row = self.connection.execute(
+            'SELECT id FROM buckets WHERE name = ?;', (name,)).fetchone()
+        if row is not None:
+            return row[0]
+        if not create:
+            return None
+
+        bucket_id = self.connection.execute(
+            'INSERT INTO buckets (name, seq) VALUES (?, 0);',
+            (name,)).lastrowid
+        try:
+            self.connection.execute(
+                'CREATE VIRTUAL TABLE text_{0} USING fts5(text);'
+                .format(bucket_id))
+        except sqlite3.OperationalError, e:
+            if 'fts5' in e.message:
+                raise RuntimeError(
+                    "Full-text search requires the SQLite FTS5 extension")
+            raise
+        self.connection.execute(
+            # No type for keys, as they might be numbers (eg. in MongoDB)
+            'CREATE TABLE keys_{0} ( id INTEGER PRIMARY KEY, key UNIQUE );'
+            .format(bucket_id))
+        return bucket_id
+
+    def update(self, bucket):
+        """
+        Index the documents of a bucket changed since the last update
+        (or all of them, if the storage was recreated meanwhile).
+
+        :return: the number of documents (re)indexed or removed
+        """
+        count = self._update(bucket)
+        if count is None:
+            return self.rebuild(bucket)
+        return count
+
+    def _update(self, bucket):
+        """Same as ``update()``, returning None if a rebuild is needed"""
+        conn = self.connection
+
+        # Take the write lock first, so that concurrent updates
+        # don't process the same changes
+        conn.execute('BEGIN IMMEDIATE;')
+        committed = False
+        try:
+            bucket_id = self._get_bucket_id(bucket.name, create=True)
+            row = conn.execute(
+                'SELECT seq, last_key, last_timestamp, prev_seq '
+                'FROM buckets WHERE id = ?;', (bucket_id,)).fetchone()
+            indexed, prev_seq = tuple(row[:3]), row[3] or 0
+            seq, last_key, last_timestamp = indexed
+
+            # The last indexed change is requested again (along with
+            # the following ones), to check it
+            found = seq == 0
+            last, count = indexed, 0
+            for changes in iter_chunks(
+                    bucket.iter_changed_since(prev_seq), INDEX_BATCH_SIZE):
+                if not found and changes[0].seq <= seq:
+                    change = changes.pop(0)
+                    if (change.seq, change.key, change.timestamp) != indexed:
+                        return None
+                    found = True
+                elif not found:
+                    # Superseded by a later change of the same object
+                    found = any(
+                        c.key == last_key and c.timestamp >= last_timestamp
+                        for c in changes)
+
+                keys = [c.key for c in changes if not c.deleted]
+                docs = bucket.get_many(keys) if keys else {}
+                for change in changes:
+                    self._index(bucket_id, change.key, docs.get(change.key))
+                if len(changes) > 1:
+                    prev_seq = changes[-2].seq
+                elif changes:
+                    prev_seq = last[0]
+                if changes:
+                    change = changes[-1]
+                    last = change.seq, change.key, change.timestamp
+                count += len(changes)
+
+            if not found:
+                return None
+            conn.execute(
+                'UPDATE buckets SET seq = ?, last_key = ?, '
+                'last_timestamp = ?, prev_seq = ? WHERE id = ?;',
+                tuple(last) + (prev_seq, bucket_id))
+            conn.execute('COMMIT;')
+            committed = True
+        finally:
+            if not committed:
+                conn.execute('ROLLBACK;')
+        return count
+
+    def _index(self, bucket_id, key, doc):
+        """Index a document (or remove it from the index, if None)"""
+        conn = self.connection
+        row = conn.execute(
+            'SELECT id FROM keys_{0} WHERE key = ?;'.format(bucket_id),
+            (key,)).fetchone()
+        if row is not None:
+            conn.execute('DELETE FROM text_{0} WHERE rowid = ?;'
+                         .format(bucket_id), (row[0],))
+        if doc is None:
+            # Deleted (or deleted again, after the change was recorded)
+            conn.execute('DELETE FROM keys_{0} WHERE key = ?;'
+                         .format(bucket_id), (key,))
+            return
+
+        if row is None:
+            rowid = conn.execute(
+                'INSERT INTO keys_{0} (key) VALUES (?);'.format(bucket_id),
+                (key,)).lastrowid
+        else:
+            rowid = row[0]
+        conn.execute(
+            'INSERT INTO text_{0} (rowid, text) VALUES (?, ?);'
+            .format(bucket_id), (rowid, extract_text(doc)))
+
+    def rebuild(self, bucket):
+        """Drop the index of a bucket, then build it again from scratch"""
+        bucket_id = self._get_bucket_id(bucket.name)
+        if bucket_id is not None:
+            conn = self.connection
+            conn.execute('BEGIN IMMEDIATE;')
+            conn.execute('DROP TABLE text_{0};'.format(bucket_id))
+            conn.execute('DROP TABLE keys_{0};'.format(bucket_id))
+            conn.execute('DELETE FROM buckets WHERE id = ?;', (bucket_id,))
+            conn.execute('COMMIT;')
+        return self.update(bucket)
+
+    def search(self, bucket, query, limit=50, markers=SNIPPET_MARKERS):
+        """
+        Search documents in a bucket, updating its index first.
+
+        :param query: words to look for (see module docs)
+        :param markers: strings to put around matching words in snippets
+        :return: a list of ``(key, snippet)``, best matches first
+        """
+        self.update(bucket)
+        query = prepare_query(query)
+        if not query:
+            return []
+
+        bucket_id = self._get_bucket_id(bucket.name)
+        rows = self.connection.execute(
+            'SELECT k.key, snippet(text_{0}, 0, ?, ?, ?, 12) '
+            'FROM text_{0} t JOIN keys_{0} k ON k.id = t.rowid '
+            'WHERE text_{0} MATCH ? ORDER BY rank LIMIT ?;'
+            .format(bucket_id),
+            (markers[0], markers[1], u'\u2026', query, limit))
+        return [(key, _squash_whitespace(snippet)) for key, snippet in rows]
+
+
+def _squash_whitespace(text):
+    return re.sub(r'\s+', ' ', text).strip()
@@ -0,0 +1,336 @@
+"""
+Storage spreading objects across several child storages ("shards").
+
+Storage URLs look like ``sharded+<url>|<url>|...``, eg.
+``sharded+sqlite+file:///tmp/a.sqlite|sqlite+file:///tmp/b.sqlite``;
+options other than ``jobs`` and ``replicas`` are passed to all the
+shards.
+
+- Each key is routed to a shard by consistent hashing: the shards own
+  ``replicas`` points each on a hash ring, and a key belongs to the
+  first point following its hash. Points are computed from the shard
+  URLs (not from their position in the list), so adding a shard only
+  moves about ``1/N`` of the keys.
+- Iteration, ``len()``, ``find()`` etc. merge the results of all the
+  shards; ``iter_hashes()`` and ``keys_page()`` keep them sorted by key
+- Bulk operations (``update_many()``, ``get_many()`` and
+  ``delete_many()``) are split by shard, and sent to all the shards
+  in parallel, from threads using their own instance of each shard
+  (see :py:meth:`BaseStorage.reopen`); so are ``clear()`` and
+  ``replace_bucket()``, which are atomic on each shard but not across
+  shards
+
+This way, writers never contend for the same lock (eg. of a SQLite
+file); the layout is fixed though: changing the list of shards
+requires moving data around, eg. using ``storage_copy``.
+
+Change tracking is not supported, as sequence numbers of different
+shards cannot be compared.
+"""
+
+import bisect
+import contextlib
+import hashlib
+import heapq
+import itertools
+from multiprocessing.pool import ThreadPool
+
+from harvester.utils import get_storage_direct, lazy_property
+from .base import (BaseStorage, BaseBucketManager, BaseBucket, BucketStats,
+                   BaseDocumentBucket, BaseBlobBucket, BaseKeyvalBucket)
+
+
+URL_SEPARATOR = '|'
+DEFAULT_REPLICAS = 64
+
+
+def _ring_hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring, mapping keys to node names"""
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        points = []
+        for node in nodes:
+            for i in xrange(replicas):
+                points.append((_ring_hash('{0}#{1}'.format(node, i)), node))
+        points.sort()
+        self._hashes = [h for h, node in points]
+        self._nodes = [node for h, node in points]
+
+    def get_node(self, key):
+        pos = bisect.bisect(self._hashes, _ring_hash(key))
+        return self._nodes[pos % len(self._nodes)]
+
+
+class ShardedStorage(BaseStorage):
+    options = [
+        ('jobs', 'int', None,
+         'Number of shards accessed in parallel by bulk operations '
+         '(default: all of them)'),
+        ('replicas', 'int', DEFAULT_REPLICAS,
+         'Number of points on the hash ring for each shard'),
+    ]
+
+    @lazy_property
+    def shard_urls(self):
+        if not self.url:
+            raise ValueError("The urls of the shards are required")
+        return [url for url in self.url.split(URL_SEPARATOR) if url]
+
+    @lazy_property
+    def shards(self):
+        """The child storages, in the same order as ``shard_urls``"""
+        conf = self._shard_conf()
+        return [get_storage_direct(url, conf) for url in self.shard_urls]
+
+    def _shard_conf(self):
+        conf = dict(self.conf)
+        conf.pop('jobs', None)
+        conf.pop('replicas', None)
+        conf.pop('clean_first', None)  # Already taken care of
+        return conf
+
+    @lazy_property
+    def _ring(self):
+        return HashRing(self.shard_urls,
+                        self.conf.get('replicas', DEFAULT_REPLICAS))
+
+    def get_shard_index(self, key):
+        """Get the index of the shard a key belongs to"""
+        return self._shard_indexes[self._ring.get_node(key)]
+
+    @lazy_property
+    def _shard_indexes(self):
+        return dict((url, i) for i, url in enumerate(self.shard_urls))
+
+    @property
+    def documents(self):
+        return BaseBucketManager(self, ShardedDocumentBucket)
+
+    @property
+    def blobs(self):
+        return BaseBucketManager(self, ShardedBlobBucket)
+
+    @property
+    def keyvals(self):
+        return BaseBucketManager(self, ShardedKeyvalBucket)
+
+    @property
+    def write_stats(self):
+        stats = dict(super(ShardedStorage, self).write_stats)
+        for shard in self.shards:
+            for key, value in shard.write_stats.iteritems():
+                stats[key] += value
+        return stats
+
+    def run_on_shards(self, func, args_by_shard):
+        """
+        Call ``func(shard, *args)`` for each ``(index, args)`` in
+        ``args_by_shard``, in parallel threads, each using its own
+        instance of the shard storage.
+
+        :return: a list of results, in the same order
+        """
+        # Make sure pending writes from this thread won't lock out
+        # (or be overwritten by) the workers
+        self.flush()
+
+        args_by_shard = list(args_by_shard)
+        if not args_by_shard:
+            return []
+        jobs = self.conf.get('jobs') or len(args_by_shard)
+
+        def _run(item):
+            index, args = item
+            shard = self.shards[index].reopen()
+            try:
+                result = func(shard, *args)
+            finally:
+                shard.flush()
+            if shard is self.shards[index]:
+                return result, None  # Already counted
+            return result, shard.write_stats
+
+        pool = ThreadPool(min(jobs, len(args_by_shard)))
+        try:
+            outcome = pool.map(_run, args_by_shard, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = []
+        own_stats = super(ShardedStorage, self).write_stats
+        for result, stats in outcome:
+            results.append(result)
+            for key, value in (stats or {}).iteritems():
+                own_stats[key] += value
+        return results
+
+    @contextlib.contextmanager
+    def batch(self):
+        with contextlib.nested(*[shard.batch() for shard in self.shards]):
+            with super(ShardedStorage, self).batch():
+                yield self
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def flush_storage(self):
+        for shard in self.shards:
+            shard.flush_storage()
+
+
+class BaseShardedBucket(BaseBucket):
+    manager_name = None  # to be overwritten in subclasses
+
+    @classmethod
+    def list_buckets(cls, storage):
+        names = set()
+        for shard in storage.shards:
+            names.update(getattr(shard, cls.manager_name))
+        return iter(sorted(names))
+
+    def _get_shard_bucket(self, shard):
+        return getattr(shard, self.manager_name)[self.name]
+
+    @property
+    def _shard_buckets(self):
+        return [self._get_shard_bucket(shard)
+                for shard in self.storage.shards]
+
+    def _route(self, key):
+        """Get the bucket of the shard a key belongs to"""
+        shard = self.storage.shards[self.storage.get_shard_index(key)]
+        return self._get_shard_bucket(shard)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._shard_buckets)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._shard_buckets)
+
+    def __contains__(self, key):
+        return key in self._route(key)
+
+    def stats(self):
+        count, size, last_modified = 0, 0, None
+        for bucket in self._shard_buckets:
+            stats = bucket.stats()
+            count += stats.count
+            if size is not None:
+                size = None if stats.size is None else size + stats.size
+            last_modified = max(last_modified, stats.last_modified)
+        return BucketStats(count, size, last_modified)
+
+    def __getitem__(self, key):
+        return self._route(key)[key]
+
+    def __setitem__(self, key, value):
+        self._route(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._route(key)[key]
+
+    def keys_page(self, after=None, limit=50):
+        return list(itertools.islice(heapq.merge(*[
+            bucket.keys_page(after=after, limit=limit)
+            for bucket in self._shard_buckets]), limit))
+
+    def iter_items(self, batch_size=500, fields=None):
+        for bucket in self._shard_buckets:
+            for item in bucket.iter_items(batch_size=batch_size,
+                                          fields=fields):
+                yield item
+
+    def clear(self):
+        def _clear(shard):
+            self._get_shard_bucket(shard).clear()
+
+        self.storage.run_on_shards(
+            _clear, [(i, ()) for i in xrange(len(self.storage.shards))])
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        def _replace(shard):
+            getattr(shard, cls.manager_name).replace(name, source_name)
+
+        storage.run_on_shards(
+            _replace, [(i, ()) for i in xrange(len(storage.shards))])
+
+    def iter_hashes(self):
+        return heapq.merge(*[bucket.iter_hashes()
+                             for bucket in self._shard_buckets])
+
+    def _group_by_shard(self, items, get_key):
+        """Get a list of ``(shard index, [items])`` tuples"""
+        by_shard = {}
+        for item in items:
+            by_shard.setdefault(
+                self.storage.get_shard_index(get_key(item)), []).append(item)
+        return by_shard.items()
+
+    def update_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+
+        def _update(shard, items):
+            self._get_shard_bucket(shard).update_many(items)
+
+        self.storage.run_on_shards(
+            _update, [(index, (shard_items,)) for index, shard_items
+                      in self._group_by_shard(items, lambda x: x[0])])
+
+    def get_many(self, keys):
+        def _get(shard, keys):
+            return self._get_shard_bucket(shard).get_many(keys)
+
+        result = {}
+        for found in self.storage.run_on_shards(
+                _get, [(index, (shard_keys,)) for index, shard_keys
+                       in self._group_by_shard(keys, lambda x: x)]):
+            result.update(found)
+        return result
+
+    def delete_many(self, keys):
+        def _delete(shard, keys):
+            self._get_shard_bucket(shard).delete_many(keys)
+
+        self.storage.run_on_shards(
+            _delete, [(index, (shard_keys,)) for index, shard_keys
+                      in self._group_by_shard(keys, lambda x: x)])
+
+
+class ShardedDocumentBucket(BaseShardedBucket, BaseDocumentBucket):
+    manager_name = 'documents'
+
+    def get(self, key, default=None, fields=None):
+        return self._route(key).get(key, default, fields=fields)
+
+    def create_index(self, path):
+        for bucket in self._shard_buckets:
+            bucket.create_index(path)
+
+    def find(self, criteria=None, **kwargs):
+        for bucket in self._shard_buckets:
+            for item in bucket.find(criteria, **kwargs):
+                yield item
+
+
+class ShardedBlobBucket(BaseShardedBucket, BaseBlobBucket):
+    manager_name = 'blobs'
+
+    def open_read(self, key):
+        return self._route(key).open_read(key)
+
+    def open_write(self, key):
+        return self._route(key).open_write(key)
+
+
+class ShardedKeyvalBucket(BaseShardedBucket, BaseKeyvalBucket):
+    manager_name = 'keyvals'
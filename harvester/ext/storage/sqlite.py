@@ -2,30 +2,131 @@
 SQLite-based storage.
 
 - Documents are stored in a key/value table, as serialized json (TEXT field)
-- Blobs are stored in a key/value table (BLOB field)
+- Blobs are stored in a key/value table (BLOB field). The sqlite3 module
+  offers no incremental blob I/O, so ``open_read()`` / ``open_write()``
+  load / store whole values at once (writes are spooled to disk first).
 - Keyvals are stored in a key/value table, as serialized json (TEXT field)
+- Blobs / documents can be compressed, see the ``codec`` and
+  ``document_codec`` options; compressed documents are stored as BLOB
+- Changes are recorded in the ``_changes`` table, holding the last
+  write sequence (autoincrement), timestamp, deleted flag and content
+  hash per key
+- Document field indexes (see ``create_index()``) are kept in a
+  ``_index_<table>`` side table of ``(path, value, id)`` rows, updated
+  on write; this allows indexing each item of list fields (eg. tags)
+- Reading selected fields (``get(key, fields=...)``, ``iter_items(
+  fields=...)``) extracts the top-level ones with ``json_extract()``,
+  so the rest of the document is never decoded by Python (unless
+  compressed)
+- ``clear()`` empties a table with a single ``DELETE`` (that SQLite
+  runs as a truncate); ``replace_bucket()`` swaps the tables by
+  renaming them, in a single transaction. Tables are never dropped.
+
+Each write is committed immediately, unless running inside a
+``storage.batch()`` block: in that case, writes are grouped in
+transactions, committed every ``batch_size`` rows or ``batch_interval``
+seconds, whichever comes first.
+
+Database files are opened in WAL mode by default, and writers wait
+for locks held by others (up to ``busy_timeout`` seconds), so several
+processes can use the same database at the same time (eg. the storage
+explorer reading while a crawler writes); each process opens its own
+connections. Storages pointing to the same file, with the same
+options, take turns using them (see :py:mod:`.connections`) rather
+than opening new ones each time. Connections are tuned through
+options, mapped to the corresponding pragmas:
+
+- ``journal_mode`` (default: ``wal``): readers don't block the writer
+  and vice versa
+- ``synchronous`` (default: ``normal``): with WAL, the database can't
+  get corrupted on power loss; only the last transactions might be
+  lost. Use ``full`` if they must be durable.
+- ``cache_size`` (default: 65536 KiB): page cache of each connection
+- ``mmap_size`` (default: 256 MiB): read pages through mmap, instead
+  of copying them in the page cache
+- ``read_only``: refuse writes (``PRAGMA query_only``); the journal
+  mode is left as-is, as changing it requires writing
+
+See ``scripts/benchmark-sqlite-storage.py`` for the figures behind
+the defaults.
 """
 
+import contextlib
+import os
 import sqlite3
 import re
 import json
+import time
 import urlparse
 
+from harvester.utils import lazy_property
+from . import compression, connections
 from .base import (BaseStorage, BaseDocumentBucket, BaseBlobBucket,
-                   BaseKeyvalBucket, NotFound)
+                   BaseKeyvalBucket, BucketStats, Change, NotFound,
+                   get_field_values, index_key, iter_chunks, match_criteria,
+                   prepare_criteria)
+
+
+# Keep well below SQLITE_MAX_VARIABLE_NUMBER (999 on older versions)
+MAX_QUERY_PARAMS = 500
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+
+
+def _check_connection(conn):
+    conn.execute('SELECT 1;').fetchall()
+
+
+def _reset_connection(conn):
+    # Writes left pending by a storage are lost, as they would be
+    # when closing its connection
+    conn.rollback()
+
+
+def _close_connection(conn):
+    conn.close()
 
 
 class SQLiteStorage(BaseStorage):
+    options = [
+        ('batch_size', 'int', 1000,
+         'When in batch mode, commit every N written rows'),
+        ('batch_interval', 'int', 5,
+         'When in batch mode, commit at least every N seconds'),
+        ('document_codec', 'str', None,
+         'Compression codec for documents and keyvals'),
+        ('journal_mode', 'str', 'wal',
+         'Journal mode: ' + ', '.join(JOURNAL_MODES)),
+        ('synchronous', 'str', 'normal',
+         'When to sync to disk: ' + ', '.join(SYNCHRONOUS_MODES)),
+        ('cache_size', 'int', 65536,
+         'Size of the page cache of each connection, in KiB'),
+        ('mmap_size', 'int', 256 * 2 ** 20,
+         'Size of the database to access through mmap, in bytes '
+         '(0 to disable)'),
+        ('busy_timeout', 'int', 30,
+         'Seconds to wait for locks held by other connections'),
+        ('read_only', 'bool', False,
+         'Open the database for reading only'),
+    ]
+
+    # Caches, filled on first use (instances unpickled in worker
+    # processes don't go through __init__)
+    _existing_tables = None
+
     def __init__(self, *a, **kw):
         super(SQLiteStorage, self).__init__(*a, **kw)
+        self._filename  # Validate the URL early
+        self._get_pragmas()
 
+    @lazy_property
+    def _filename(self):
         # Extract destination filename from URL
         # Storage URLs might be like:
         #     sqlite:///path/to/db.sqlite
         #     sqlite+file:///path/to/db.sqlite
-
-        self._filename = self._get_file_name(self.url)
-        self._existing_tables = None
+        return self._get_file_name(self.url)
 
     def _get_file_name(self, url):
         if not url:
@@ -81,11 +182,78 @@ class SQLiteStorage(BaseStorage):
 
     @property
     def _connection(self):
-        if getattr(self, '_cached_connection', None) is None:
-            self._cached_connection = sqlite3.connect(self._filename)
-            self._cached_connection.row_factory = sqlite3.Row
+        # Connections must not be shared with forked processes:
+        # a new one is opened when used from another process.
+        if getattr(self, '_connection_pid', None) != os.getpid():
+            self._cached_connection = None
+            self._connection_pid = os.getpid()
+        if self._cached_connection is None:
+            self._cached_connection = self._connect()
         return self._cached_connection
 
+    def _get_pragmas(self):
+        """Get the ``(name, value)`` pragmas to be set on connections"""
+        conf = self.conf
+        journal_mode = conf.get('journal_mode', 'wal').lower()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError("Invalid journal mode: {0!r}"
+                             .format(journal_mode))
+        synchronous = conf.get('synchronous', 'normal').lower()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError("Invalid synchronous mode: {0!r}"
+                             .format(synchronous))
+
+        pragmas = []
+        if conf.get('read_only', False):
+            pragmas.append(('query_only', 'ON'))
+        elif self._filename != ':memory:':
+            # The setting is persistent, so this is a no-op most times
+            pragmas.append(('journal_mode', journal_mode))
+        pragmas.extend([
+            ('synchronous', synchronous),
+            # Negative values are in KiB, rather than in pages
+            ('cache_size', -int(conf.get('cache_size', 65536))),
+            ('mmap_size', int(conf.get('mmap_size', 256 * 2 ** 20))),
+        ])
+        return pragmas
+
+    def _connect(self):
+        if self._filename == ':memory:':
+            # Each instance gets its own database
+            return self._open_connection()
+        key = ('sqlite', self._filename, tuple(self._get_pragmas()),
+               self.conf.get('busy_timeout', 30))
+        return connections.registry.acquire(
+            self, key, self._open_connection, check=_check_connection,
+            reset=_reset_connection, close=_close_connection)
+
+    def _open_connection(self):
+        # Pooled connections are handed to storages in other threads
+        conn = sqlite3.connect(
+            self._filename, timeout=self.conf.get('busy_timeout', 30),
+            check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self._get_pragmas():
+            conn.execute('PRAGMA {0}={1};'.format(name, value))
+        return conn
+
+    def _has_json_functions(self):
+        """Whether SQLite was built with the JSON1 extension"""
+        if getattr(self, '_cached_has_json_functions', None) is None:
+            try:
+                self._query_one("SELECT json('{}');")
+            except sqlite3.OperationalError:
+                self._cached_has_json_functions = False
+            else:
+                self._cached_has_json_functions = True
+        return self._cached_has_json_functions
+
+    def _has_connection(self):
+        """Whether a connection was opened, in the current process"""
+        if getattr(self, '_cached_connection', None) is None:
+            return False
+        return self._connection_pid == os.getpid()
+
     def _cursor(self, *a, **kw):
         return self._connection.cursor(*a, **kw)
 
@@ -104,6 +272,33 @@ class SQLiteStorage(BaseStorage):
 
     def _commit(self):
         self._connection.commit()
+        self._pending_writes = 0
+
+    def _write_done(self):
+        """
+        To be called after each write: commit immediately, unless
+        we are in batch mode, in which case we commit only once
+        enough rows were written / enough time passed.
+        """
+        if not self.in_batch:
+            self._commit()
+            return
+
+        self._pending_writes = getattr(self, '_pending_writes', 0) + 1
+        if self._pending_writes == 1:
+            self._pending_since = time.time()
+
+        if self._pending_writes >= self.conf.get('batch_size', 1000):
+            self._commit()
+            return
+
+        _elapsed = time.time() - self._pending_since
+        if _elapsed >= self.conf.get('batch_interval', 5):
+            self._commit()
+
+    def flush(self):
+        if self._has_connection():
+            self._commit()
 
     def _list_tables(self):
         query = 'SELECT name FROM "sqlite_master" where type=\'table\';'
@@ -120,7 +315,13 @@ class SQLiteStorage(BaseStorage):
         if self._existing_tables is None:
             self._existing_tables = set(self._list_tables())
 
-        if name in self._existing_tables:
+        if bucket_type == 'document' \
+                and '_indexes' not in self._existing_tables:
+            # Looked up on each document write, see _get_indexed_paths()
+            self._create_indexes_table()
+            self._existing_tables.add('_indexes')
+
+        if table_name in self._existing_tables:
             # We assume the table is there..
             return
 
@@ -149,6 +350,111 @@ class SQLiteStorage(BaseStorage):
         c.execute(query.format(table_name))
         self._commit()
 
+    def _create_changes_table(self):
+        c = self._cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS "_changes"
+        ( seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT,
+          id VARCHAR(256), timestamp REAL, deleted INTEGER, hash TEXT,
+          UNIQUE (tbl, id) );
+        """)
+        c.execute('CREATE INDEX IF NOT EXISTS "_changes_tbl_seq" '
+                  'ON "_changes" (tbl, seq);')
+        self._commit()
+
+    def _has_change_hashes(self):
+        """Whether the ``_changes`` table is there, with hashes"""
+        if getattr(self, '_cached_has_change_hashes', None) is None:
+            columns = [row['name'] for row in
+                       self._query('PRAGMA table_info("_changes");')]
+            if columns and 'hash' not in columns:
+                # Table created by an older version
+                self._execute('ALTER TABLE "_changes" ADD COLUMN hash TEXT;')
+                self._commit()
+                columns.append('hash')
+            self._cached_has_change_hashes = 'hash' in columns
+        return self._cached_has_change_hashes
+
+    def _ensure_changes_table(self):
+        if self._existing_tables is None:
+            self._existing_tables = set(self._list_tables())
+        if '_changes' not in self._existing_tables:
+            # Databases created by older versions lack this table
+            self._create_changes_table()
+            self._existing_tables.add('_changes')
+            self._cached_has_change_hashes = True
+        self._has_change_hashes()
+
+    def _record_change(self, table_name, objid, deleted=False, hash=None):
+        self._ensure_changes_table()
+
+        # Replacing the row assigns a new sequence number to the key
+        self._execute(
+            'INSERT OR REPLACE INTO "_changes" '
+            '(tbl, id, timestamp, deleted, hash) VALUES (?, ?, ?, ?, ?);',
+            (table_name, objid, time.time(), deleted, hash))
+
+    def _get_indexed_paths(self, table_name):
+        """Get the document field paths indexed for a table"""
+
+        # Not cached, as other storages (or processes) might add
+        # indexes at any time: when called on write, the lookup runs in
+        # the same transaction, so no document is left out of an index
+        try:
+            rows = self._query(
+                'SELECT path FROM "_indexes" WHERE tbl=?;', (table_name,))
+        except sqlite3.OperationalError, e:
+            if not e.message.startswith('no such table'):
+                raise
+            return []
+        return [row['path'] for row in rows]
+
+    def _create_indexes_table(self):
+        self._execute("""
+        CREATE TABLE IF NOT EXISTS "_indexes"
+        ( tbl TEXT, path TEXT, PRIMARY KEY (tbl, path) );
+        """)
+
+    def _create_index_table(self, table_name):
+        index_table = '_index_' + table_name
+        self._check_table_name(index_table)
+
+        self._create_indexes_table()
+        c = self._cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS "{0}"
+        ( path TEXT, value TEXT, id VARCHAR(256) );
+        """.format(index_table))
+        c.execute('CREATE INDEX IF NOT EXISTS "{0}_value" '
+                  'ON "{0}" (path, value);'.format(index_table))
+        c.execute('CREATE INDEX IF NOT EXISTS "{0}_id" '
+                  'ON "{0}" (id);'.format(index_table))
+        return index_table
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Run the statements issued inside the block in a single
+        transaction; unlike the default, DDL statements don't
+        commit the pending ones.
+        """
+        self._commit()
+        conn = self._connection
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None  # We manage transactions
+        try:
+            conn.execute('BEGIN IMMEDIATE;')
+            committed = False
+            try:
+                yield
+                conn.execute('COMMIT;')
+                committed = True
+            finally:
+                if not committed:
+                    conn.execute('ROLLBACK;')
+        finally:
+            conn.isolation_level = isolation_level
+
     def _check_table_name(self, name):
         if not re.match(r'^[A-Za-z0-9_]+$', name):
             raise ValueError("Invalid table name")
@@ -156,6 +462,7 @@ class SQLiteStorage(BaseStorage):
 
 class BaseSQLiteBucket(object):
     bucket_type = None
+    _keeps_hashes = True
 
     @classmethod
     def list_buckets(cls, storage):
@@ -186,6 +493,57 @@ class BaseSQLiteBucket(object):
         for row in result:
             yield row['id']
 
+    def keys_page(self, after=None, limit=50):
+        # A range scan on the primary key index
+        tbl = self._get_table_name()
+        if after is None:
+            query = 'SELECT id FROM "{0}" ORDER BY id LIMIT ?;'
+            params = (limit,)
+        else:
+            query = 'SELECT id FROM "{0}" WHERE id > ? ORDER BY id LIMIT ?;'
+            params = (after, limit)
+        try:
+            rows = self.storage._query(query.format(tbl), params)
+        except sqlite3.OperationalError, e:
+            if e.message.startswith('no such table'):
+                return []
+            raise
+        return [row['id'] for row in rows]
+
+    def iter_items(self, batch_size=500, fields=None):
+        # We retrieve objects in pages, ordered by id: this is
+        # more robust than keeping a cursor open, as in Python 2
+        # cursors get reset by a commit on the same connection.
+        tbl = self._get_table_name()
+        columns, params, load = self._get_value_columns(
+            self._get_projection(fields))
+        query = ('SELECT id, {1} FROM "{0}" WHERE id > ? '
+                 'ORDER BY id LIMIT ?;'.format(tbl, columns))
+        first_query = ('SELECT id, {1} FROM "{0}" '
+                       'ORDER BY id LIMIT ?;'.format(tbl, columns))
+
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    rows = self.storage._query(
+                        first_query, params + (batch_size,))
+                else:
+                    rows = self.storage._query(
+                        query, params + (last_id, batch_size))
+
+            except sqlite3.OperationalError, e:
+                if e.message.startswith('no such table'):
+                    return
+                raise
+
+            for row in rows:
+                yield row['id'], load(row)
+
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1]['id']
+
     def __len__(self):
         tbl = self._get_table_name()
         query = 'SELECT count(*) FROM "{0}";'.format(tbl)
@@ -196,6 +554,38 @@ class BaseSQLiteBucket(object):
                 return 0
             raise
 
+    def stats(self):
+        tbl = self._get_table_name()
+        # The length of blobs is known without reading them
+        query = ('SELECT count(*), sum(length(CAST(value AS BLOB))) '
+                 'FROM "{0}";'.format(tbl))
+        try:
+            count, size = self.storage._query_one(query)
+        except sqlite3.OperationalError, e:
+            if e.message.startswith('no such table'):
+                return BucketStats(0, 0, None)
+            raise
+
+        last_modified = None
+        if '_changes' in self.storage._list_tables():
+            # The last change has the largest sequence number
+            row = self.storage._query_one(
+                'SELECT timestamp FROM "_changes" WHERE tbl=? '
+                'ORDER BY seq DESC LIMIT 1;', (tbl,))
+            if row is not None:
+                last_modified = row['timestamp']
+        return BucketStats(count, size or 0, last_modified)
+
+    def __contains__(self, name):
+        tbl = self._get_table_name()
+        query = 'SELECT 1 FROM "{0}" WHERE id=?;'.format(tbl)
+        try:
+            return self.storage._query_one(query, (name,)) is not None
+        except sqlite3.OperationalError, e:
+            if e.message.startswith('no such table'):
+                return False
+            raise
+
     def __getitem__(self, name):
         tbl = self._get_table_name()
         query = 'SELECT * FROM "{0}" WHERE id=?;'.format(tbl)
@@ -215,50 +605,423 @@ class BaseSQLiteBucket(object):
         return self._deserialize(obj['value'])
 
     def __setitem__(self, objid, obj):
+        hash = self._get_write_hash(obj)
+        if self._skip_write(objid, hash):
+            return
+
         self.storage._ensure_table(self.bucket_type, self.name)
         tbl = self._get_table_name()
 
-        # Make sure it isn't in our way..
-        self.__delitem__(objid)
-        # query = 'DELETE FROM "{0}" WHERE id=?;'.format(tbl)
-        # self.storage._execute(query, (objid,))
-
-        # Insert the updated version
-        query = ('INSERT INTO "{0}" (id, value) VALUES (?, ?);' .format(tbl))
+        # Insert the object, replacing any existing version
+        query = ('INSERT OR REPLACE INTO "{0}" (id, value) VALUES (?, ?);'
+                 .format(tbl))
 
         self.storage._execute(query, (objid, self._serialize(obj)))
-        self.storage._commit()
+        self.storage._record_change(tbl, objid, hash=hash)
+        self._on_write(objid, obj)
+        self.storage._write_done()
 
     def __delitem__(self, objid):
         tbl = self._get_table_name()
         query = 'DELETE FROM "{0}" WHERE id=?;'.format(tbl)
 
         try:
-            self.storage._execute(query, (objid,))
+            cursor = self.storage._execute(query, (objid,))
 
         except sqlite3.OperationalError, e:
             if not e.message.startswith('no such table'):
                 raise
 
+        else:
+            if cursor.rowcount > 0:
+                self.storage._record_change(tbl, objid, deleted=True)
+            self._on_write(objid, None)
+            self.storage._write_done()
+
+    def get_many(self, keys):
+        tbl = self._get_table_name()
+        result = {}
+        for chunk in iter_chunks(keys, MAX_QUERY_PARAMS):
+            query = ('SELECT id, value FROM "{0}" WHERE id IN ({1});'
+                     .format(tbl, ', '.join('?' * len(chunk))))
+            try:
+                rows = self.storage._query(query, chunk)
+            except sqlite3.OperationalError, e:
+                if e.message.startswith('no such table'):
+                    return result
+                raise
+            for row in rows:
+                result[row['id']] = self._deserialize(row['value'])
+        return result
+
+    def delete_many(self, keys):
+        tbl = self._get_table_name()
+        for chunk in iter_chunks(keys, MAX_QUERY_PARAMS):
+            placeholders = ', '.join('?' * len(chunk))
+            try:
+                # Only changes to existing objects are to be recorded
+                rows = self.storage._query(
+                    'SELECT id FROM "{0}" WHERE id IN ({1});'
+                    .format(tbl, placeholders), chunk)
+            except sqlite3.OperationalError, e:
+                if e.message.startswith('no such table'):
+                    return
+                raise
+
+            self.storage._execute(
+                'DELETE FROM "{0}" WHERE id IN ({1});'
+                .format(tbl, placeholders), chunk)
+            for row in rows:
+                self.storage._record_change(tbl, row['id'], deleted=True)
+                self._on_write(row['id'], None)
+            self.storage._write_done()
+
+    def clear(self):
+        tbl = self._get_table_name()
+        if tbl not in self.storage._list_tables():
+            return
+
+        self.storage._ensure_changes_table()
+        self.storage._execute(
+            'INSERT OR REPLACE INTO "_changes" '
+            '(tbl, id, timestamp, deleted, hash) '
+            'SELECT ?, id, ?, 1, NULL FROM "{0}";'.format(tbl),
+            (tbl, time.time()))
+        # Without a WHERE clause, SQLite drops all the rows at once
+        self.storage._execute('DELETE FROM "{0}";'.format(tbl))
+        self._on_clear()
+        self.storage._write_done()
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        target, source = cls(storage, name), cls(storage, source_name)
+        tbl, source_tbl = target._get_table_name(), source._get_table_name()
+        tmp_tbl = '_swap_' + tbl
+        storage._check_table_name(tmp_tbl)
+
+        storage._ensure_table(cls.bucket_type, name)
+        storage._ensure_table(cls.bucket_type, source_name)
+        storage._ensure_changes_table()
+        now = time.time()
+
+        with storage._transaction():
+            # Record changes, leaving alone the objects having the same
+            # hash in both tables
+            storage._execute(
+                'INSERT OR REPLACE INTO "_changes" '
+                '(tbl, id, timestamp, deleted, hash) '
+                'SELECT ?, id, ?, 1, NULL FROM "{0}" '
+                'WHERE id NOT IN (SELECT id FROM "{1}");'
+                .format(tbl, source_tbl), (tbl, now))
+            storage._execute(
+                'INSERT OR REPLACE INTO "_changes" '
+                '(tbl, id, timestamp, deleted, hash) '
+                'SELECT ?, s.id, ?, 0, c.hash FROM "{1}" s '
+                'LEFT JOIN "_changes" c ON c.tbl = ? AND c.id = s.id '
+                'WHERE NOT EXISTS ('
+                ' SELECT 1 FROM "{0}" t JOIN "_changes" o '
+                ' ON o.tbl = ? AND o.id = t.id '
+                ' WHERE t.id = s.id AND o.hash = c.hash);'
+                .format(tbl, source_tbl), (tbl, now, source_tbl, tbl))
+            storage._execute(
+                'DELETE FROM "_changes" WHERE tbl = ?;', (source_tbl,))
+
+            # Swap tables (and index tables), then empty the source one
+            target._swap_tables(tbl, source_tbl, tmp_tbl)
+            storage._execute('DELETE FROM "{0}";'.format(source_tbl))
+            source._on_clear()
+
+    def _swap_tables(self, tbl, other_tbl, tmp_tbl):
+        """Swap the names of two tables (inside a transaction)"""
+        for old, new in ((tbl, tmp_tbl), (other_tbl, tbl),
+                         (tmp_tbl, other_tbl)):
+            self.storage._execute(
+                'ALTER TABLE "{0}" RENAME TO "{1}";'.format(old, new))
+
+    def _on_clear(self):
+        """Hook called after the table was emptied"""
+        pass
+
+    def _get_stored_hash(self, objid):
+        tbl = self._get_table_name()
+        if self.storage._has_change_hashes():
+            query = ('SELECT c.hash AS hash FROM "_changes" c '
+                     'JOIN "{0}" t ON t.id = c.id '
+                     'WHERE c.tbl = ? AND c.id = ?;'.format(tbl))
+            try:
+                row = self.storage._query_one(query, (tbl, objid))
+            except sqlite3.OperationalError, e:
+                if e.message.startswith('no such table'):
+                    return None
+                raise
+            if row is not None and row['hash'] is not None:
+                return row['hash']
+        return super(BaseSQLiteBucket, self)._get_stored_hash(objid)
+
+    def iter_hashes(self):
+        tbl = self._get_table_name()
+        if self.storage._has_change_hashes():
+            # Values are only loaded for objects written by older
+            # versions, lacking a stored hash
+            query = ('SELECT t.id AS id, c.hash AS hash, '
+                     'CASE WHEN c.hash IS NULL THEN t.value END AS value '
+                     'FROM "{0}" t LEFT JOIN "_changes" c '
+                     'ON c.tbl = ? AND c.id = t.id '
+                     'WHERE t.id > ? ORDER BY t.id LIMIT ?;'.format(tbl))
+        else:
+            query = ('SELECT id, NULL AS hash, value FROM "{0}" '
+                     'WHERE ? IS NOT NULL AND id > ? ORDER BY id LIMIT ?;'
+                     .format(tbl))
+
+        # Paged, for the same reasons as iter_items(); ids sort before
+        # any string, so we can start with an empty one.
+        last_id, page_size = '', 500
+        while True:
+            try:
+                rows = self.storage._query(query, (tbl, last_id, page_size))
+            except sqlite3.OperationalError, e:
+                if e.message.startswith('no such table'):
+                    return
+                raise
+
+            for row in rows:
+                hash = row['hash']
+                if hash is None:
+                    hash = self._hash_value(self._deserialize(row['value']))
+                yield row['id'], hash
+
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1]['id']
+
+    def iter_changed_since(self, seq=0):
+        tbl = self._get_table_name()
+        query = ('SELECT id, seq, timestamp, deleted FROM "_changes" '
+                 'WHERE tbl=? AND seq > ? ORDER BY seq LIMIT ?;')
+        page_size = 500
+
+        # Paged, for the same reasons as iter_items()
+        while True:
+            try:
+                rows = self.storage._query(query, (tbl, seq, page_size))
+            except sqlite3.OperationalError, e:
+                if e.message.startswith('no such table'):
+                    return
+                raise
+
+            for row in rows:
+                yield Change(row['id'], row['seq'], row['timestamp'],
+                             bool(row['deleted']))
+
+            if len(rows) < page_size:
+                return
+            seq = rows[-1]['seq']
+
+    def _on_write(self, objid, obj):
+        """
+        Hook called after an object was written (or deleted, in which
+        case ``obj`` is None), in the same transaction.
+        """
+        pass
+
+    def _get_value_columns(self, projection):
+        """
+        Get the SQL expressions selecting the value of objects (only
+        the projected fields, if possible), their query parameters,
+        and a function getting the value out of a selected row.
+        """
+        def _load(row):
+            return self._project(self._deserialize(row['value']), projection)
+        return 'value', (), _load
+
     def _serialize(self, val):
-        return json.dumps(val)
+        data = json.dumps(val)
+        codec = self.storage.conf.get('document_codec')
+        if codec:
+            return buffer(compression.encode(data, codec))
+        return data
 
     def _deserialize(self, val):
+        if isinstance(val, buffer):
+            val = compression.decode(str(val))
         return json.loads(val)
 
 
 class SQLiteDocumentBucket(BaseSQLiteBucket, BaseDocumentBucket):
     bucket_type = 'document'
 
+    def get(self, key, default=None, fields=None):
+        if fields is None:
+            return super(SQLiteDocumentBucket, self).get(key, default)
+        columns, params, load = self._get_value_columns(
+            self._get_projection(fields))
+        query = 'SELECT {1} FROM "{0}" WHERE id=?;'.format(
+            self._get_table_name(), columns)
+        try:
+            row = self.storage._query_one(query, params + (key,))
+        except sqlite3.OperationalError, e:
+            if e.message.startswith('no such table'):
+                return default
+            raise
+        if row is None:
+            return default
+        return load(row)
+
+    def _get_value_columns(self, projection):
+        whole = super(SQLiteDocumentBucket, self)._get_value_columns(
+            projection)
+        if projection is None or not self.storage._has_json_functions() \
+                or any('"' in name for name in projection.names):
+            return whole
+        load_whole = whole[2]
+
+        # Only the projected fields are decoded: SQLite extracts them
+        # (as a json array, alternating values and types, so that
+        # missing fields can be told from null ones). Compressed
+        # values are opaque to SQLite, and are returned whole.
+        names = projection.names
+        params = []
+        for name in names:
+            path = u'$."{0}"'.format(name)
+            params.extend((path, path))
+        extracted = ', '.join(
+            ['json_extract(value, ?), json_type(value, ?)'] * len(names))
+        columns = ("CASE typeof(value) WHEN 'text' THEN json_array({0}) "
+                   "END AS projection, "
+                   "CASE typeof(value) WHEN 'text' THEN NULL ELSE value "
+                   "END AS value".format(extracted))
+
+        def _load(row):
+            if row['projection'] is None:
+                return load_whole(row)
+            values = json.loads(row['projection'])
+            doc = {}
+            for i, name in enumerate(names):
+                value, value_type = values[i * 2], values[i * 2 + 1]
+                if value_type is None:
+                    continue  # Missing field
+                if value_type in ('true', 'false'):
+                    value = value_type == 'true'  # Extracted as 1 / 0
+                doc[name] = value
+            return projection(doc)
+
+        return columns, tuple(params), _load
+
+    def _get_index_rows(self, objid, obj, paths):
+        for path in paths:
+            values = set(index_key(v) for v in get_field_values(obj, path))
+            for value in values:
+                yield path, value, objid
+
+    def _on_write(self, objid, obj):
+        tbl = self._get_table_name()
+        paths = self.storage._get_indexed_paths(tbl)
+        if not paths:
+            return
+
+        index_table = '_index_' + tbl
+        self.storage._execute(
+            'DELETE FROM "{0}" WHERE id=?;'.format(index_table), (objid,))
+        if obj is not None:
+            self.storage._cursor().executemany(
+                'INSERT INTO "{0}" (path, value, id) VALUES (?, ?, ?);'
+                .format(index_table),
+                self._get_index_rows(objid, obj, paths))
+
+    @classmethod
+    def replace_bucket(cls, storage, name, source_name):
+        target = cls(storage, name)
+        paths = list(storage._get_indexed_paths(target._get_table_name()))
+        super(SQLiteDocumentBucket, cls).replace_bucket(
+            storage, name, source_name)
+
+        # Keep the indexes the bucket had (unless the source had them too)
+        for path in paths:
+            target.create_index(path)
+
+    def _on_clear(self):
+        tbl = self._get_table_name()
+        if self.storage._get_indexed_paths(tbl):
+            self.storage._execute('DELETE FROM "_index_{0}";'.format(tbl))
+
+    def _swap_tables(self, tbl, other_tbl, tmp_tbl):
+        super(SQLiteDocumentBucket, self)._swap_tables(
+            tbl, other_tbl, tmp_tbl)
+
+        # Indexes follow their documents
+        storage = self.storage
+        if any(storage._get_indexed_paths(x) for x in (tbl, other_tbl)):
+            for name in (tbl, other_tbl):
+                storage._create_index_table(name)
+            super(SQLiteDocumentBucket, self)._swap_tables(
+                '_index_' + tbl, '_index_' + other_tbl, '_index_' + tmp_tbl)
+            storage._execute(
+                'UPDATE "_indexes" SET tbl = CASE tbl WHEN ? THEN ? '
+                'ELSE ? END WHERE tbl IN (?, ?);',
+                (tbl, other_tbl, tbl, tbl, other_tbl))
+
+    def create_index(self, path):
+        tbl = self._get_table_name()
+        if path in self.storage._get_indexed_paths(tbl):
+            return
+
+        index_table = self.storage._create_index_table(tbl)
+        self.storage._execute(
+            'INSERT INTO "_indexes" (tbl, path) VALUES (?, ?);', (tbl, path))
+        for key, doc in self.iter_items():
+            self.storage._cursor().executemany(
+                'INSERT INTO "{0}" (path, value, id) VALUES (?, ?, ?);'
+                .format(index_table),
+                self._get_index_rows(key, doc, [path]))
+        self.storage._commit()
+
+    def find(self, criteria=None, **kwargs):
+        criteria = prepare_criteria(criteria, kwargs)
+        tbl = self._get_table_name()
+        paths = self.storage._get_indexed_paths(tbl)
+        indexed = [(path, value) for path, value in criteria.iteritems()
+                   if path in paths]
+
+        if not indexed:
+            # No usable index: scan the whole bucket
+            for item in super(SQLiteDocumentBucket, self).find(criteria):
+                yield item
+            return
+
+        subquery = ' INTERSECT '.join(
+            'SELECT id FROM "_index_{0}" WHERE path=? AND value=?'
+            .format(tbl) for _ in indexed)
+        query = ('SELECT id, value FROM "{0}" WHERE id IN ({1});'
+                 .format(tbl, subquery))
+        params = []
+        for path, value in indexed:
+            params.extend((path, index_key(value)))
+
+        for row in self.storage._query(query, params):
+            doc = self._deserialize(row['value'])
+            if match_criteria(doc, criteria):
+                yield row['id'], doc
+
 
 class SQLiteBlobBucket(BaseSQLiteBucket, BaseBlobBucket):
     bucket_type = 'blob'
 
     def _serialize(self, val):
-        return val
+        if not isinstance(val, basestring):
+            raise TypeError("Blob storage can only process strings")
+        if isinstance(val, unicode):
+            val = val.encode('utf-8')
+
+        # Wrapping in a buffer makes sqlite3 store a BLOB
+        # (instead of TEXT, which would choke on binary data)
+        return buffer(compression.encode(
+            val, self.storage.conf.get('codec')))
 
     def _deserialize(self, val):
-        return val
+        if isinstance(val, unicode):
+            # Blobs stored by older versions ended up as TEXT
+            return val.encode('utf-8')
+        return compression.decode(str(val))
 
 
 class SQLiteKeyvalBucket(BaseSQLiteBucket, BaseKeyvalBucket):
@@ -0,0 +1,190 @@
+"""
+Bulk copy of all the data in a storage to another one.
+
+Buckets are read in parallel, each from a separate instance of the
+source storage (see :py:meth:`BaseStorage.reopen`), while all the
+writes happen from the calling thread, inside a single ``batch()``
+block: this way the destination doesn't need to support concurrent
+writers (SQLite doesn't, for example).
+
+Copied buckets are recorded in the ``storage_copy`` keyval bucket of
+the destination storage, so that an interrupted copy can be resumed,
+skipping the buckets (and objects) already copied.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from harvester.utils import report_progress
+
+from .base import BUCKET_MANAGERS
+
+
+logger = logging.getLogger(__name__)
+
+STATE_BUCKET = 'storage_copy'
+DEFAULT_JOBS = 4
+BATCH_SIZE = 500
+COPY_CHUNK_SIZE = 256 * 1024
+
+
+class _Aborted(Exception):
+    pass
+
+
+def _get_bucket(storage, bucket_type, name):
+    return getattr(storage, dict(BUCKET_MANAGERS)[bucket_type])[name]
+
+
+def _state_key(bucket_type, name):
+    return u'{0}/{1}'.format(bucket_type, name)
+
+
+def _read_bucket(source, bucket_type, name, skip_keys, queue, stop):
+    """
+    Read all the objects from a bucket, sending them to ``queue``
+    as ``(kind, bucket_type, name, payload)`` messages.
+    """
+
+    def _put(kind, payload=None):
+        while True:
+            if stop.is_set():
+                raise _Aborted()
+            try:
+                queue.put((kind, bucket_type, name, payload), timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    if stop.is_set():
+        return
+
+    try:
+        bucket = _get_bucket(source.reopen(), bucket_type, name)
+        _put('start', len(bucket))
+
+        if bucket_type == 'blob':
+            for key in bucket:
+                if key not in skip_keys:
+                    _put('blob', (key, bucket.open_read(key)))
+
+        else:
+            chunk = []
+            for key, value in bucket.iter_items(batch_size=BATCH_SIZE):
+                if key in skip_keys:
+                    continue
+                chunk.append((key, value))
+                if len(chunk) >= BATCH_SIZE:
+                    _put('items', chunk)
+                    chunk = []
+            if chunk:
+                _put('items', chunk)
+
+        _put('done')
+
+    except _Aborted:
+        pass
+
+    except Exception:
+        try:
+            _put('error', sys.exc_info())
+        except _Aborted:
+            pass
+
+
+def _copy_blob(reader, writer):
+    with reader, writer:
+        while True:
+            chunk = reader.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+
+
+def copy_storage(source, dest, jobs=DEFAULT_JOBS, resume=False):
+    """
+    Copy all the documents, keyvals and blobs from a storage to another.
+
+    :param source: the storage to read from
+    :param dest: the storage to write to
+    :param jobs: number of buckets to be read in parallel
+    :param resume: skip buckets (and objects) copied by
+        a previous, interrupted, run
+    :return: a list of ``(bucket_type, name, count)`` tuples,
+        with the number of objects copied for each bucket
+    """
+
+    state = dest.keyvals[STATE_BUCKET]
+    if not resume:
+        state.delete_many(list(state))
+
+    tasks = []
+    for bucket_type, manager in BUCKET_MANAGERS:
+        for name in getattr(source, manager):
+            if bucket_type == 'keyval' and name == STATE_BUCKET:
+                continue
+            if _state_key(bucket_type, name) in state:
+                logger.info('Skipping {0} bucket {1!r} (already copied)'
+                            .format(bucket_type, name))
+                continue
+            tasks.append((bucket_type, name))
+
+    queue = Queue.Queue(maxsize=jobs * 4)
+    stop = threading.Event()
+    pool = ThreadPool(jobs)
+    for bucket_type, name in tasks:
+        skip_keys = set()
+        if resume:
+            skip_keys = set(_get_bucket(dest, bucket_type, name))
+        pool.apply_async(_read_bucket, (
+            source, bucket_type, name, skip_keys, queue, stop))
+    pool.close()
+
+    totals, counts = {}, {}
+    pending = len(tasks)
+
+    try:
+        with dest.batch():
+            while pending:
+                kind, bucket_type, name, payload = queue.get()
+                task = (bucket_type, name)
+
+                if kind == 'error':
+                    raise payload[0], payload[1], payload[2]
+
+                if kind == 'start':
+                    totals[task] = payload
+                    counts[task] = 0
+                    continue
+
+                bucket = _get_bucket(dest, bucket_type, name)
+
+                if kind == 'items':
+                    bucket.update_many(payload)
+                    counts[task] += len(payload)
+
+                elif kind == 'blob':
+                    key, reader = payload
+                    _copy_blob(reader, bucket.open_write(key))
+                    counts[task] += 1
+
+                elif kind == 'done':
+                    # Make sure data reached the destination before
+                    # marking the bucket as copied
+                    dest.flush()
+                    state[_state_key(bucket_type, name)] = True
+                    pending -= 1
+                    logger.info('Copied {0} objects to {1} bucket {2!r}'
+                                .format(counts[task], bucket_type, name))
+
+                report_progress(('copy', bucket_type, name),
+                                counts[task], totals[task])
+
+    finally:
+        stop.set()
+        pool.join()
+
+    return [t + (counts.get(t, 0),) for t in tasks]
@@ -1,10 +1,12 @@
 from werkzeug.routing import BaseConverter
 
 import json
+import os
 import urllib
 import flask
 # from flask import request, session, abort
 
+from harvester.utils import format_size, format_timestamp
 from .views_html import html_views
 # from jobcontrol.utils.web import generate_csrf_token
 # from jobcontrol.web.template_filters import filters
@@ -68,6 +70,11 @@ app.register_blueprint(html_views, url_prefix='')
 # IMPORTANT: This *must*  be set to something random
 app.secret_key = "This is no secret"
 
+# Where full-text search indexes are kept (one file per storage)
+app.config['SEARCH_INDEX_DIR'] = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'harvester', 'search')
+
 
 # @app.before_request
 # def csrf_protect():
@@ -100,3 +107,5 @@ def format_blob_filter(obj):
     return obj
 
 app.jinja_env.filters['format_blob'] = format_blob_filter
+app.jinja_env.filters['format_size'] = format_size
+app.jinja_env.filters['format_timestamp'] = format_timestamp
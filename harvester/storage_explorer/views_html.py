@@ -1,10 +1,9 @@
-from __future__ import division
+import time
 
-from math import ceil
-
-from flask import (Blueprint, render_template, redirect, url_for,
-                   flash, request, session)
+from flask import (Blueprint, Markup, Response, render_template, redirect,
+                   url_for, flash, request, session, jsonify, escape)
 
+from harvester.ext.storage.search import SearchIndex, get_index_path
 from harvester.utils import get_storage_direct
 import json
 
@@ -13,6 +12,11 @@ html_views = Blueprint('webui', __name__)
 
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+SEARCH_RESULTS = 50
+
+# Around matching words in search snippets, replaced by <mark> tags
+_MARK_START, _MARK_END = u'\x02', u'\x03'
 
 
 def get_jc():
@@ -20,53 +24,74 @@ def get_jc():
     return current_app.config['JOBCONTROL']
 
 
-class Paged(object):
-    def __init__(self, data, page=1, per_page=10):
+class KeysetPager(object):
+    """
+    Paginate the keys of a bucket, using keyset pagination: pages
+    are identified by the last key of the previous one, so all the
+    pages cost the same to load (see ``BaseBucket.keys_page()``).
+    """
+
+    def __init__(self, bucket, after=None, per_page=10):
         """
-        :param data: A dict-like to paginate
-        :param page: The page number (one-based)
+        :param bucket: the bucket to paginate
+        :param after: the last key of the previous page
         """
-        self._data = data
-        self._page = page
-        self._per_page = per_page
+        self._after = after
+        keys = bucket.keys_page(after=after, limit=per_page + 1)
+        self._items = keys[:per_page]
+        self.has_next = len(keys) > per_page
 
     @property
-    def pages(self):
-        return int(ceil(len(self._data) / float(self._per_page)))
+    def is_first(self):
+        return self._after is None
 
     @property
-    def current_page(self):
-        return self._page
+    def next_after(self):
+        """The ``after`` value for the next page"""
+        if not self.has_next:
+            return None
+        return self._items[-1]
 
-    @property
-    def has_prev(self):
-        return self._page > 1
+    def get_items(self):
+        return self._items
 
-    @property
-    def has_next(self):
-        return self._page < self.pages
 
-    def get_items(self):
-        start = (self._page - 1) * self._per_page
-        end = start + self._per_page
-        return self._data[start:end]
+def get_titles(bucket, keys):
+    """Get the titles of some documents, reading just that field"""
+    titles = {}
+    for key in keys:
+        doc = bucket.get(key, fields=['title'])
+        titles[key] = (doc or {}).get('title')
+    return titles
 
-    def get_pager_links(self):
-        page_ids = set()
-        page_ids.add(1)
-        page_ids.add(self.pages)
 
-        range_start = max(1, self.current_page - 3)
-        range_end = min(self.pages, self.current_page + 3)
-        for i in xrange(range_start, range_end + 1):
-            page_ids.add(i)
+def get_search_index(storage_url):
+    from flask import current_app
+    basedir = current_app.config['SEARCH_INDEX_DIR']
+    return SearchIndex(get_index_path(basedir, storage_url))
+
 
-        _previtem = None
-        for x in sorted(page_ids):
-            if _previtem is not None and _previtem < x - 1:
-                yield ('...', None)
-            yield (str(x), x)
-            _previtem = x
+def search_documents(storage_url, bucket_name, query, markers):
+    """
+    Search a documents bucket.
+
+    :return: a ``(results, elapsed seconds)`` tuple
+    """
+    storage = get_storage_direct(storage_url)
+    index = get_search_index(storage_url)
+    start = time.time()
+    try:
+        results = index.search(storage.documents[bucket_name], query,
+                               limit=SEARCH_RESULTS, markers=markers)
+    finally:
+        index.close()
+    return results, time.time() - start
+
+
+def _highlight(snippet):
+    return Markup(escape(snippet)
+                  .replace(_MARK_START, Markup('<mark>'))
+                  .replace(_MARK_END, Markup('</mark>')))
 
 
 @html_views.route('/', methods=['GET'])
@@ -106,7 +131,8 @@ def bookmark_remove():
 @html_views.route('/storage/<quotedstring:storage_url>', methods=['GET'])
 def storage_index(storage_url):
     storage = get_storage_direct(storage_url)
-    return render_template('storage-index.jinja', storage=storage)
+    return render_template('storage-index.jinja', storage=storage,
+                           stats=storage.stats())
 
 
 @html_views.route(
@@ -115,15 +141,55 @@ def storage_index(storage_url):
 def storage_documents_index(storage_url, bucket_name):
     storage = get_storage_direct(storage_url)
     bucket = storage.documents[bucket_name]
+    pager = KeysetPager(bucket, after=request.args.get('after'), per_page=50)
     return render_template(
         'storage-documents-index.jinja',
         storage=storage,
         bucket_name=bucket_name,
         bucket=bucket,
-        paged_ids=Paged(
-            bucket.keys(),
-            page=int(request.args.get('page', 1)),
-            per_page=50))
+        pager=pager,
+        titles=get_titles(bucket, pager.get_items()))
+
+
+@html_views.route(
+    '/storage/<quotedstring:storage_url>/documents/<quotedstring:bucket_name>'
+    '/search',
+    methods=['GET'])
+def storage_documents_search(storage_url, bucket_name):
+    storage = get_storage_direct(storage_url)
+    query = request.args.get('q', '')
+    results, elapsed = [], None
+    if query.strip():
+        try:
+            results, elapsed = search_documents(
+                storage_url, bucket_name, query, (_MARK_START, _MARK_END))
+        except (NotImplementedError, RuntimeError), e:
+            flash('Search not available: {0}'.format(e), 'danger')
+    return render_template(
+        'storage-documents-search.jinja',
+        storage=storage,
+        bucket_name=bucket_name,
+        query=query,
+        results=[(key, _highlight(snippet)) for key, snippet in results],
+        elapsed=elapsed)
+
+
+@html_views.route(
+    '/storage/<quotedstring:storage_url>/documents/<quotedstring:bucket_name>'
+    '/search.json',
+    methods=['GET'])
+def storage_documents_search_json(storage_url, bucket_name):
+    query = request.args.get('q', '')
+    try:
+        results, elapsed = search_documents(
+            storage_url, bucket_name, query, ('<mark>', '</mark>'))
+    except (NotImplementedError, RuntimeError), e:
+        return jsonify(error=str(e)), 400
+    return jsonify(
+        query=query,
+        elapsed=elapsed,
+        results=[{'key': key, 'snippet': snippet}
+                 for key, snippet in results])
 
 
 @html_views.route(
@@ -137,10 +203,8 @@ def storage_blobs_index(storage_url, bucket_name):
         storage=storage,
         bucket_name=bucket_name,
         bucket=bucket,
-        paged_ids=Paged(
-            bucket.keys(),
-            page=int(request.args.get('page', 1)),
-            per_page=50))
+        pager=KeysetPager(
+            bucket, after=request.args.get('after'), per_page=50))
 
 
 @html_views.route(
@@ -154,10 +218,8 @@ def storage_keyvals_index(storage_url, bucket_name):
         storage=storage,
         bucket_name=bucket_name,
         bucket=bucket,
-        paged_ids=Paged(
-            bucket.keys(),
-            page=int(request.args.get('page', 1)),
-            per_page=50))
+        pager=KeysetPager(
+            bucket, after=request.args.get('after'), per_page=50))
 
 
 @html_views.route(
@@ -219,11 +281,23 @@ def storage_document_download(storage_url, bucket_name, object_id):
     methods=['GET'])
 def storage_blob_download(storage_url, bucket_name, object_id):
     storage = get_storage_direct(storage_url)
-    obj = storage.blobs[bucket_name][object_id]
-    headers = {'Content-type': 'application/octet-stream',
-               'Content-disposition': 'attachment; filename="blob-{0}-{1}"'
+    fp = storage.blobs[bucket_name].open_read(object_id)
+
+    def _stream():
+        # Send the blob in chunks, as it might be very large
+        try:
+            while True:
+                chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            fp.close()
+
+    headers = {'Content-disposition': 'attachment; filename="blob-{0}-{1}"'
                .format(bucket_name, object_id)}
-    return obj, 200, headers
+    return Response(_stream(), 200, headers,
+                    mimetype='application/octet-stream')
 
 
 @html_views.route(
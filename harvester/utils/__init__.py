@@ -16,6 +16,7 @@ import logging
 import re
 import socket
 import sys
+import time
 import warnings
 
 from stevedore.extension import ExtensionManager
@@ -335,6 +336,33 @@ def to_ordinal(number):
     return sr + 'th'
 
 
+def format_size(size):
+    """
+    Format a size in bytes in a human-readable way
+
+    >>> format_size(123456)
+    '120.6 KiB'
+    """
+    if size is None:
+        return '-'
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    if unit == 'bytes':
+        return '{0} bytes'.format(size)
+    return '{0:.1f} {1}'.format(size, unit)
+
+
+def format_timestamp(timestamp):
+    """Format a unix timestamp as local date and time"""
+    if timestamp is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
 def decode_faulty_json(text):
     """
     Attempt to decode json containing newlines inside strings,
@@ -406,6 +434,10 @@ def check_tcp_port(host, port, timeout=3):
 def get_storage_direct(url, options=None):
     """
     Get storage directly, trusting the passed-in options.
+
+    Storages are cheap to create: connections to the backends are kept
+    in a process-wide registry (see :py:mod:`harvester.ext.storage.
+    connections`), shared with other storages pointing to the same one.
     """
     name, url = parse_plugin_url(url)
     plugin_class = get_plugin_class('storage', name)
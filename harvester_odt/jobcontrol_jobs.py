@@ -52,7 +52,8 @@ def crawl_statistica(storage):
     storage = get_storage_from_arg(storage)
 
     with jobcontrol_integration():
-        harvester_odt.pat_statistica.crawler.crawl_statistica(storage)
+        with storage.batch():
+            harvester_odt.pat_statistica.crawler.crawl_statistica(storage)
 
     return storage
 
@@ -60,10 +61,11 @@ def crawl_statistica(storage):
 def crawl_statistica_subpro(storage):
     """Run crawler for statistica - subprovinciale"""
 
-    import harvester_odt.pat_statistica.crawler
+    from harvester_odt.pat_statistica.crawler import crawl_statistica_subpro
     storage = get_storage_from_arg(storage)
     with jobcontrol_integration():
-        harvester_odt.pat_statistica.crawler.crawl_statistica_subpro(storage)
+        with storage.batch():
+            crawl_statistica_subpro(storage)
     return storage
 
 
@@ -74,7 +76,8 @@ def crawl_geocatalogo(storage):
     crawler = Geocatalogo('', {'with_resources': False})
     storage = get_storage_from_arg(storage)
     with jobcontrol_integration():
-        crawler.fetch_data(storage)
+        with storage.batch():
+            crawler.fetch_data(storage)
     return storage
 
 
@@ -89,7 +92,8 @@ def crawl_comunweb(storage, url):
     crawler = ComunWebCrawler(url)
     storage = get_storage_from_arg(storage)
     with jobcontrol_integration():
-        crawler.fetch_data(storage)
+        with storage.batch():
+            crawler.fetch_data(storage)
     return storage
 
 
@@ -102,7 +106,8 @@ def convert_statistica_to_ckan(input_storage, storage):
     storage = get_storage_from_arg(storage)
 
     with jobcontrol_integration():
-        convert_statistica_to_ckan(input_storage, storage)
+        with storage.batch():
+            convert_statistica_to_ckan(input_storage, storage)
     return storage
 
 
@@ -115,7 +120,8 @@ def convert_statistica_subpro_to_ckan(input_storage, storage):
     storage = get_storage_from_arg(storage)
 
     with jobcontrol_integration():
-        convert_statistica_subpro_to_ckan(input_storage, storage)
+        with storage.batch():
+            convert_statistica_subpro_to_ckan(input_storage, storage)
     return storage
 
 
@@ -129,7 +135,8 @@ def convert_geocatalogo_to_ckan(input_storage, storage):
     converter = GeoCatalogoToCkan('', {})
 
     with jobcontrol_integration():
-        converter.convert(input_storage, storage)
+        with storage.batch():
+            converter.convert(input_storage, storage)
     return storage
 
 
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 
 import lxml
@@ -13,6 +14,7 @@ logger = logging.getLogger(__name__)
 
 
 DOWNLOAD_FORMATS = ('rdf', 'xml')
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
 
 
 class Geocatalogo(CrawlerPluginBase):
@@ -108,21 +110,28 @@ class Geocatalogo(CrawlerPluginBase):
 
                 logger.info(u"Downloading resource of type {0} (from {1})"
                             .format(fmt, url))
-                response = requests.get(url)
-                if response.ok:
-                    data = response.content
+                response = requests.get(url, stream=True)
+                with contextlib.closing(response):
+                    if not response.ok:
+                        logger.error(u'Failed downloading {0} (code: {1})'
+                                     .format(url, response.status_code))
+                        continue
+
+                    # Stream the resource to the storage in chunks,
+                    # as it might be a multi-hundred-MB file.
+                    bucket_id = 'resource_{0}'.format(fmt)
+                    bucket = storage.blobs[bucket_id]
+                    size = 0
+                    with bucket.open_write(dataset_id) as fp:
+                        chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+                        for chunk in chunks:
+                            fp.write(chunk)
+                            size += len(chunk)
+
                     logger.debug(u'Got {0} response, type {1!r}, size {2}'
                                  .format(response.status_code,
                                          response.headers.get(
                                              'content-type', 'unknown'),
-                                         len(data)))
-                    # blob_id = '{0}_{1}'.format(dataset_id, fmt)
-                    # storage.blobs['resource'][blob_id] = data
-                    bucket_id = 'resource_{0}'.format(fmt)
-                    storage.blobs[bucket_id][dataset_id] = data
-
-                else:
-                    logger.error(u'Failed downloading {0} (code: {1})'
-                                 .format(url, response.status_code))
+                                         size))
 
             report_progress(('datasets',), i + 1, progress_total)
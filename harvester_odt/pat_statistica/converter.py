@@ -27,8 +27,7 @@ class StatisticaSubProToCkan(ConverterPluginBase):
 
     def convert(self, storage_in, storage_out):
         self.logger.debug('Converting datasets')
-        for dataset_id in storage_in.documents['dataset']:
-            dataset = storage_in.documents['dataset'][dataset_id]
+        for dataset_id, dataset in storage_in.documents['dataset'].iteritems():
             clean_dataset = dataset_statistica_subpro_to_ckan(dataset)
             _dsid = clean_dataset['id']
             storage_out.documents['dataset'][_dsid] = clean_dataset
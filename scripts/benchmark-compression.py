@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the storage compression codecs on a real harvest snapshot.
+
+Usage::
+
+    benchmark-compression.py <storage-url> [<max-objects-per-bucket>]
+
+Eg::
+
+    benchmark-compression.py mongodb://database.local/harvester/geocatalogo
+
+For each available codec, reports the compression ratio and the
+encode / decode throughput, separately for documents and blobs.
+"""
+
+from __future__ import division, print_function
+
+import itertools
+import json
+import sys
+import time
+
+from harvester.ext.storage import compression
+from harvester.utils import get_storage_direct
+
+
+def load_samples(storage, limit=None):
+    documents, blobs = [], []
+
+    for name in storage.documents:
+        items = storage.documents[name].itervalues()
+        documents.extend(json.dumps(obj) for obj in
+                         itertools.islice(items, limit))
+
+    for name in storage.blobs:
+        items = storage.blobs[name].itervalues()
+        blobs.extend(itertools.islice(items, limit))
+
+    return documents, blobs
+
+
+def benchmark(codec_name, samples):
+    raw_size = sum(len(x) for x in samples)
+
+    start = time.time()
+    encoded = [compression.encode(x, codec_name) for x in samples]
+    encode_time = time.time() - start
+
+    start = time.time()
+    for x in encoded:
+        compression.decode(x)
+    decode_time = time.time() - start
+
+    encoded_size = sum(len(x) for x in encoded)
+    return {
+        'raw': raw_size,
+        'ratio': raw_size / encoded_size if encoded_size else 0,
+        'encode': raw_size / encode_time / 2 ** 20 if encode_time else 0,
+        'decode': raw_size / decode_time / 2 ** 20 if decode_time else 0,
+    }
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    storage = get_storage_direct(sys.argv[1])
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    documents, blobs = load_samples(storage, limit)
+
+    print('{0:10s} {1:6s} {2:>12s} {3:>7s} {4:>12s} {5:>12s}'.format(
+        'Type', 'Codec', 'Raw bytes', 'Ratio', 'Enc. MB/s', 'Dec. MB/s'))
+
+    for label, samples in (('documents', documents), ('blobs', blobs)):
+        if not samples:
+            continue
+        for codec_name in sorted(compression.CODECS):
+            res = benchmark(codec_name, samples)
+            print('{0:10s} {1:6s} {2:12d} {3:7.2f} {4:12.1f} {5:12.1f}'
+                  .format(label, codec_name, res['raw'], res['ratio'],
+                          res['encode'], res['decode']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the in-memory storage, with and without ``zero_copy``.
+
+Usage::
+
+    benchmark-memory-storage.py [<number-of-documents>]
+
+Writes a bucket of (by default) 50k documents, shaped like the ones
+produced by converters, then reads them back by key and by iterating
+over the whole bucket.
+"""
+
+from __future__ import division, print_function
+
+import gc
+import sys
+import time
+
+from harvester.ext.storage.memory import MemoryStorage
+
+
+def make_document(i):
+    return {
+        'id': 'dataset-{0}'.format(i),
+        'title': 'Dataset number {0}'.format(i),
+        'notes': 'Lorem ipsum dolor sit amet ' * 10,
+        'tags': [{'name': 'tag-{0}'.format(x)} for x in xrange(5)],
+        'resources': [
+            {'url': 'http://example.com/{0}/{1}.csv'.format(i, x),
+             'format': 'CSV', 'size': i * x}
+            for x in xrange(3)],
+        'extras': {'year': 2000 + i % 20, 'license': 'cc-by'},
+    }
+
+
+def _timed(func):
+    # Like timeit, keep the garbage collector out of measurements
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        func()
+        return time.time() - start
+    finally:
+        gc.enable()
+
+
+def benchmark(documents, zero_copy):
+    storage = MemoryStorage(conf={'zero_copy': zero_copy})
+    bucket = storage.documents['dataset']
+
+    def write():
+        for i, doc in enumerate(documents):
+            bucket[i] = doc
+
+    def read():
+        for i in xrange(len(documents)):
+            bucket[i]
+
+    def iterate():
+        for key, value in bucket.iteritems():
+            pass
+
+    return _timed(write), _timed(read), _timed(iterate)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    documents = [make_document(i) for i in xrange(count)]
+
+    print('{0:10s} {1:>10s} {2:>10s} {3:>10s}'.format(
+        'Mode', 'Write (s)', 'Read (s)', 'Iter (s)'))
+
+    results = {}
+    for label, zero_copy in (('json', False), ('zero_copy', True)):
+        results[label] = benchmark(documents, zero_copy)
+        print('{0:10s} {1:10.3f} {2:10.3f} {3:10.3f}'.format(
+            label, *results[label]))
+
+    print('{0:10s} {1:>9.1f}x {2:>9.1f}x {3:>9.1f}x'.format(
+        'speedup', *[a / b if b else 0 for a, b in
+                     zip(results['json'], results['zero_copy'])]))
+
+
+if __name__ == '__main__':
+    main()
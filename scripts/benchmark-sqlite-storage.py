@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the SQLite storage with different connection settings.
+
+Usage::
+
+    benchmark-sqlite-storage.py [<number-of-documents>] [<directory>]
+
+For each configuration, writes (by default) 20k documents, shaped
+like the ones produced by converters, in a batch, plus 500 more
+committed one by one; then reads them back by key and by iterating
+over the whole bucket. Databases are created in a temporary
+directory, unless one is given (use it to benchmark a specific disk).
+"""
+
+from __future__ import division, print_function
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from harvester.ext.storage.sqlite import SQLiteStorage
+
+
+CONFIGURATIONS = [
+    ('sqlite defaults', {'journal_mode': 'delete', 'synchronous': 'full',
+                         'cache_size': 2000, 'mmap_size': 0}),
+    ('wal', {'journal_mode': 'wal', 'synchronous': 'full',
+             'cache_size': 2000, 'mmap_size': 0}),
+    ('wal+normal', {'journal_mode': 'wal', 'synchronous': 'normal',
+                    'cache_size': 2000, 'mmap_size': 0}),
+    ('storage defaults', {}),
+]
+
+SINGLE_WRITES = 500
+
+
+def make_document(i):
+    return {
+        'id': 'dataset-{0}'.format(i),
+        'title': 'Dataset number {0}'.format(i),
+        'notes': 'Lorem ipsum dolor sit amet ' * 10,
+        'tags': [{'name': 'tag-{0}'.format(x)} for x in xrange(5)],
+        'resources': [
+            {'url': 'http://example.com/{0}/{1}.csv'.format(i, x),
+             'format': 'CSV', 'size': i * x}
+            for x in xrange(3)],
+        'extras': {'year': 2000 + i % 20, 'license': 'cc-by'},
+    }
+
+
+def _timed(func):
+    # Like timeit, keep the garbage collector out of measurements
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        func()
+        return time.time() - start
+    finally:
+        gc.enable()
+
+
+def benchmark(path, documents, conf):
+    storage = SQLiteStorage('file://' + path, conf=conf)
+    bucket = storage.documents['dataset']
+    count = len(documents)
+
+    def write_batch():
+        with storage.batch():
+            for i, doc in enumerate(documents):
+                bucket[str(i)] = doc
+
+    def write_single():
+        for i in xrange(SINGLE_WRITES):
+            bucket['single-{0}'.format(i)] = documents[i % count]
+
+    def read():
+        # Use a fresh connection, with a cold page cache
+        other = SQLiteStorage('file://' + path, conf=conf)
+        other_bucket = other.documents['dataset']
+        for i in xrange(count):
+            other_bucket[str(i)]
+
+    def iterate():
+        for key, value in bucket.iteritems():
+            pass
+
+    return (count / _timed(write_batch),
+            SINGLE_WRITES / _timed(write_single),
+            count / _timed(read),
+            (count + SINGLE_WRITES) / _timed(iterate))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    documents = [make_document(i) for i in xrange(count)]
+
+    if len(sys.argv) > 2:
+        basedir, cleanup = sys.argv[2], False
+    else:
+        basedir, cleanup = tempfile.mkdtemp(), True
+
+    print('{0:18s} {1:>12s} {2:>12s} {3:>12s} {4:>12s}'.format(
+        'Objects/second', 'Batch write', 'Single write', 'Read by key',
+        'Iterate'))
+
+    try:
+        for i, (label, conf) in enumerate(CONFIGURATIONS):
+            path = os.path.join(basedir, 'benchmark-{0}.sqlite'.format(i))
+            print('{0:18s} {1:12.0f} {2:12.0f} {3:12.0f} {4:12.0f}'.format(
+                label, *benchmark(path, documents, conf)))
+    finally:
+        if cleanup:
+            shutil.rmtree(basedir)
+
+
+if __name__ == '__main__':
+    main()
@@ -82,10 +82,13 @@ resources = {}
 conn = pymongo.MongoClient('database.local')
 db = conn['harvester_data']
 
+# Only fetch the fields we need, not whole datasets
+RESOURCE_FIELDS = ['resources.url', 'resources.format']
+
 resources['statistica'] = split_resources(
-    db['statistica_clean.dataset'].find())
+    db['statistica_clean.dataset'].find(fields=RESOURCE_FIELDS))
 resources['statistica_subpro'] = split_resources(
-    db['statistica_subpro_clean.dataset'].find())
+    db['statistica_subpro_clean.dataset'].find(fields=RESOURCE_FIELDS))
 
 # --- print summary
 for k1 in sorted(resources.keys()):
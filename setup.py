@@ -27,9 +27,12 @@ entry_points = {
     ],
 
     'harvester.ext.storage': [
+        'cached = harvester.ext.storage.cached:CachedStorage',
         'jsondir = harvester.ext.storage.jsondir:JsonDirStorage',
+        'logstore = harvester.ext.storage.logstore:LogStorage',
         'memory = harvester.ext.storage.memory:MemoryStorage',
         'mongodb = harvester.ext.storage.mongodb:MongodbStorage',
+        'sharded = harvester.ext.storage.sharded:ShardedStorage',
         'sqlite = harvester.ext.storage.sqlite:SQLiteStorage',
     ],
 
@@ -53,6 +56,8 @@ entry_points = {
         'convert = harvester.commands:Convert',
         'import = harvester.commands:Import',
         'storage_inspect = harvester.commands:StorageInspect',
+        'storage_copy = harvester.commands:StorageCopy',
+        'storage_diff = harvester.commands:StorageDiff',
     ],
 
     'harvester.director.commands': [
@@ -3,7 +3,8 @@ import os
 import pytest
 
 
-@pytest.fixture(params=['sqlite', 'memory', 'jsondir', 'mongodb'])
+@pytest.fixture(params=['sqlite', 'memory', 'jsondir', 'logstore',
+                        'mongodb'])
 def storage(request, tmpdir):
     if request.param == 'sqlite':
         from harvester.ext.storage.sqlite import SQLiteStorage
@@ -15,9 +16,12 @@ def storage(request, tmpdir):
         return MemoryStorage()
 
     elif request.param == 'jsondir':
-        # from harvester.ext.storage.jsondir import JsonDirStorage
-        pytest.skip('Not implemented yet')
-        pass
+        from harvester.ext.storage.jsondir import JsonDirStorage
+        return JsonDirStorage('file://' + str(tmpdir.join('jsondir')))
+
+    elif request.param == 'logstore':
+        from harvester.ext.storage.logstore import LogStorage
+        return LogStorage('file://' + str(tmpdir.join('logstore')))
 
     elif request.param == 'mongodb':
         from harvester.ext.storage.mongodb import MongodbStorage
@@ -2,6 +2,9 @@
 Tests for the SQLite storage
 """
 
+import sqlite3
+import time
+
 import pytest
 
 from harvester.ext.storage.base import NotFound
@@ -39,3 +42,660 @@ def test_storages(storage):
 
     with pytest.raises(NotFound):
         storage.documents['dataset']['1']
+
+
+def test_storage_batch_writes(storage):
+    bucket = storage.documents['dataset']
+
+    with storage.batch():
+        for i in xrange(10):
+            bucket[str(i)] = {'title': 'Dataset {0}'.format(i)}
+        assert storage.in_batch
+
+    assert not storage.in_batch
+    assert len(bucket) == 10
+    assert bucket['3'] == {'title': 'Dataset 3'}
+
+    bucket.update_many((str(i), {'id': i}) for i in xrange(5, 15))
+    assert len(bucket) == 15
+    assert bucket['3'] == {'title': 'Dataset 3'}
+    assert bucket['7'] == {'id': 7}
+
+
+def test_sqlite_batch_commits(tmpdir):
+    from harvester.ext.storage.sqlite import SQLiteStorage
+
+    url = 'file://' + str(tmpdir.join('example.sqlite'))
+    storage = SQLiteStorage(url, conf={'batch_size': 3})
+    bucket = storage.documents['dataset']
+    bucket['0'] = {}  # Make sure the table exists
+
+    with bucket.batch():
+        for i in xrange(1, 5):
+            bucket[str(i)] = {}
+
+        # The fourth row is still waiting in the open transaction
+        other = SQLiteStorage(url)
+        assert len(other.documents['dataset']) == 4
+
+    assert len(other.documents['dataset']) == 5
+
+
+def test_sqlite_connection_options(tmpdir):
+    from harvester.ext.storage.sqlite import SQLiteStorage
+
+    url = 'file://' + str(tmpdir.join('example.sqlite'))
+    storage = SQLiteStorage(url, conf={'synchronous': 'FULL',
+                                       'cache_size': 1024})
+    assert storage._query_one('PRAGMA journal_mode;')[0] == 'wal'
+    assert storage._query_one('PRAGMA synchronous;')[0] == 2
+    assert storage._query_one('PRAGMA cache_size;')[0] == -1024
+
+    with pytest.raises(ValueError):
+        SQLiteStorage(url, conf={'journal_mode': 'invalid'})
+
+    # Readers are not blocked by an open write transaction
+    storage.documents['dataset']['0'] = {'id': 0}
+    reader = SQLiteStorage(url, conf={'read_only': True})
+    with storage.batch():
+        storage.documents['dataset']['1'] = {'id': 1}
+        assert len(reader.documents['dataset']) == 1
+    assert reader.documents['dataset']['1'] == {'id': 1}
+
+    with pytest.raises(sqlite3.OperationalError):
+        reader.documents['dataset']['2'] = {'id': 2}
+
+
+def test_storage_iter_items(storage):
+    bucket = storage.documents['dataset']
+    assert list(bucket.iter_items()) == []
+
+    bucket.update_many((str(i), {'id': i}) for i in xrange(25))
+
+    items = list(bucket.iter_items(batch_size=10))
+    assert len(items) == 25
+    assert dict(items) == dict((str(i), {'id': i}) for i in xrange(25))
+    assert dict(bucket.iteritems()) == dict(items)
+    assert sorted(x['id'] for x in bucket.itervalues()) == range(25)
+
+
+def test_storage_blob_streaming(storage):
+    bucket = storage.blobs['resource']
+
+    with bucket.open_write('1') as fp:
+        for i in xrange(100):
+            fp.write('chunk {0:03d}\n'.format(i))
+            fp.write('\x00\xff')
+
+    expected = ''.join('chunk {0:03d}\n\x00\xff'.format(i)
+                       for i in xrange(100))
+    assert bucket['1'] == expected
+
+    with bucket.open_read('1') as fp:
+        assert fp.read(10) == expected[:10]
+        assert fp.read() == expected[10:]
+
+    # Writes are discarded in case of exceptions
+    with pytest.raises(ValueError):
+        with bucket.open_write('2') as fp:
+            fp.write('Some data')
+            raise ValueError('Something went wrong')
+
+    assert list(bucket) == ['1']
+
+    with pytest.raises(NotFound):
+        bucket.open_read('2')
+
+    # ..leaving existing blobs untouched
+    with pytest.raises(ValueError):
+        with bucket.open_write('1') as fp:
+            fp.write('Some data')
+            raise ValueError('Something went wrong')
+
+    assert bucket['1'] == expected
+    assert list(bucket) == ['1']
+
+
+def test_jsondir_storage_layout(tmpdir):
+    from harvester.ext.storage.jsondir import JsonDirStorage
+
+    storage = JsonDirStorage('file://' + str(tmpdir))
+    storage.documents['dataset'][u'caff\xe8/1'] = {'title': 'Coffee'}
+    storage.blobs['resource']['1'] = 'Hello'
+
+    # Objects are stored in sharded sub-directories
+    files = [x for x in tmpdir.join('document').visit()
+             if x.isfile() and x.basename != '.changes']
+    assert len(files) == 1
+    assert files[0].basename == 'caff%C3%A8%2F1'
+    assert len(files[0].relto(tmpdir).split('/')) == 5
+
+    # No leftover temporary files
+    assert tmpdir.join('document', 'dataset', '.tmp').listdir() == []
+
+    assert list(storage.documents['dataset']) == [u'caff\xe8/1']
+    assert list(storage.blobs) == ['resource']
+
+    storage.flush_storage()
+    assert list(storage.documents) == []
+
+
+def test_jsondir_storage_names(tmpdir):
+    from harvester.ext.storage.jsondir import JsonDirStorage
+
+    storage = JsonDirStorage('file://' + str(tmpdir.join('data')))
+    for name in ('', '.', '..', 'x' * 250):
+        with pytest.raises(ValueError):
+            storage.documents[name]['1'] = {'id': 1}
+        with pytest.raises(ValueError):
+            storage.documents['dataset'][name] = {'id': 1}
+
+    # Separators are quoted, so names can't point outside the storage
+    storage.documents['../..']['1'] = {'id': 1}
+    storage.documents['/tmp']['1'] = {'id': 1}
+    assert tmpdir.listdir() == [tmpdir.join('data')]
+    assert sorted(storage.documents) == ['../..', '/tmp']
+
+
+def test_logstore_storage(tmpdir):
+    from harvester.ext.storage.base import StorageError
+    from harvester.ext.storage.logstore import LogStorage
+
+    url = 'file://' + str(tmpdir)
+    storage = LogStorage(url, {'compact_ratio': 0})
+    bucket = storage.documents['dataset']
+    for i in xrange(10):
+        bucket[i] = {'id': i, 'version': 1}
+    bucket[3] = {'id': 3, 'version': 2}
+    del bucket[4]
+    storage.flush()
+
+    # Records written after the index was saved are replayed
+    bucket[5] = {'id': 5, 'version': 2}
+
+    # Only one process at a time can write
+    other = LogStorage(url)
+    with pytest.raises(StorageError):
+        other.documents['dataset'][1] = {}
+
+    # ..but others can read, seeing the latest data
+    assert len(other.documents['dataset']) == 9
+    assert other.documents['dataset'][5] == {'id': 5, 'version': 2}
+    assert 4 not in other.documents['dataset']
+
+    # Compaction drops superseded records
+    log = storage._get_log('document', 'dataset')
+    size = log.position
+    storage.compact()
+    assert log.position < size
+    assert log.garbage_ratio == 0
+    assert sorted(bucket) == [0, 1, 2, 3, 5, 6, 7, 8, 9]
+    assert bucket[3] == {'id': 3, 'version': 2}
+    assert len(tmpdir.join('document', 'dataset')
+               .listdir('segment-*.log')) == 1
+
+    # Readers pick up the compacted segment
+    assert other.documents['dataset'][3] == {'id': 3, 'version': 2}
+
+    storage.close()
+    storage = LogStorage(url)
+    assert sorted(storage.documents['dataset'].iteritems()) == \
+        sorted(bucket.iteritems())
+
+
+def test_logstore_background_compaction(tmpdir):
+    from harvester.ext.storage.logstore import LogStorage
+
+    storage = LogStorage('file://' + str(tmpdir))
+    bucket = storage.blobs['resource']
+    for i in xrange(100):
+        bucket['key'] = 'Version {0}'.format(i)
+
+    threads = storage.compact(background=True)
+    for i in xrange(100):
+        bucket['other-{0}'.format(i)] = 'Hello'
+    for thread in threads:
+        thread.join()
+
+    assert bucket['key'] == 'Version 99'
+    assert len(bucket) == 101
+    assert bucket.open_read('other-1').read() == 'Hello'
+
+
+def test_logstore_compaction_while_reading(tmpdir):
+    from harvester.ext.storage.logstore import LogStorage
+
+    storage = LogStorage('file://' + str(tmpdir), {'compact_ratio': 0})
+    bucket = storage.documents['dataset']
+    for version in xrange(3):
+        for i in xrange(50):
+            bucket[str(i)] = {'id': i, 'version': version}
+    blobs = storage.blobs['resource']
+    for version in xrange(3):
+        blobs['1'] = ''.join('{0:04d} v{1}\n'.format(i, version)
+                             for i in xrange(1000))
+    expected = blobs['1']
+
+    items = bucket.iteritems()
+    first = [next(items) for _ in xrange(10)]
+    fp = blobs.open_read('1')
+    assert fp.read(100) == expected[:100]
+
+    # Compacting moves records around, readers keep the old segment
+    storage.compact()
+    bucket['0'] = {'id': 0, 'version': 3}
+    blobs['1'] = 'New version'
+    storage.compact()
+
+    items = dict(first + list(items))
+    assert len(items) == 50
+    assert all(item['version'] == 2 for key, item in items.iteritems()
+               if key != '0')
+    assert fp.read() == expected[100:]
+    assert blobs['1'] == 'New version'
+    assert len(tmpdir.join('document', 'dataset')
+               .listdir('segment-*.log')) == 1
+
+
+def test_logstore_torn_tail(tmpdir):
+    from harvester.ext.storage.logstore import LogStorage
+
+    url = 'file://' + str(tmpdir)
+    storage = LogStorage(url)
+    storage.documents['dataset']['a'] = {'id': 'a'}
+    storage.close()
+
+    # A record left half-written by a crash is dropped before appending
+    segment, = tmpdir.join('document', 'dataset').listdir('segment-*.log')
+    segment.write('HVL1\x00\x00\x00', mode='ab')
+    storage = LogStorage(url)
+    storage.documents['dataset']['b'] = {'id': 'b'}
+    assert storage.documents['dataset']['b'] == {'id': 'b'}
+    storage.close()
+
+    storage = LogStorage(url)
+    assert sorted(storage.documents['dataset'].iteritems()) == [
+        ('a', {'id': 'a'}), ('b', {'id': 'b'})]
+
+
+def test_memory_storage_zero_copy():
+    from harvester.ext.storage.memory import MemoryStorage, thaw
+
+    storage = MemoryStorage(conf={'zero_copy': True})
+    bucket = storage.documents['dataset']
+    obj = {'title': 'Hello', 'tags': [{'name': 'a'}]}
+    bucket['1'] = obj
+
+    # Changing the original object doesn't affect the stored one
+    obj['tags'].append({'name': 'b'})
+    assert bucket['1'] == {'title': 'Hello', 'tags': [{'name': 'a'}]}
+
+    # Objects are returned without copying, so they are read-only
+    stored = bucket['1']
+    assert stored is bucket['1']
+    with pytest.raises(TypeError):
+        stored['title'] = 'Changed'
+    with pytest.raises(TypeError):
+        stored['tags'].append({})
+    with pytest.raises(TypeError):
+        stored['tags'][0].update({'name': 'b'})
+
+    mutable = thaw(stored)
+    mutable['tags'].append({'name': 'b'})
+    assert type(mutable) is dict and type(mutable['tags']) is list
+    assert len(bucket['1']['tags']) == 1
+
+    # Only json-serializable objects can be stored
+    with pytest.raises(TypeError):
+        bucket['2'] = {'obj': object()}
+
+
+def test_storage_find(storage):
+    bucket = storage.documents['dataset']
+    bucket['1'] = {'name': 'one', 'owner_org': 'pat',
+                   'tags': [{'name': 'energia'}, {'name': 'trasporti'}]}
+    bucket['2'] = {'name': 'two', 'owner_org': 'pat',
+                   'tags': [{'name': 'energia'}]}
+    bucket['3'] = {'name': 'three', 'owner_org': 'comune',
+                   'groups': ['energia'], 'extras': {'year': 2015}}
+
+    def _find(*a, **kw):
+        return sorted(key for key, doc in bucket.find(*a, **kw))
+
+    # Without indexes, the whole bucket is scanned
+    assert _find(tags__name='energia') == ['1', '2']
+    assert _find(owner_org='pat', name='two') == ['2']
+
+    bucket.create_index('tags.name')
+    bucket.create_index('owner_org')
+    bucket.create_index('owner_org')  # Already there: nothing happens
+    bucket.create_index('groups')
+
+    assert _find(tags__name='energia') == ['1', '2']
+    assert _find({'tags.name': 'trasporti'}) == ['1']
+    assert _find(owner_org='pat', name='two') == ['2']
+    assert _find(owner_org='pat', tags__name='trasporti') == ['1']
+    assert _find(groups='energia') == ['3']
+    assert _find(extras__year=2015) == ['3']
+    assert _find(extras__year='2015') == []
+    assert _find(owner_org='nobody') == []
+    assert dict(bucket.find(name='one'))['1']['owner_org'] == 'pat'
+
+    # Indexes are kept up to date on write
+    bucket['2'] = {'name': 'two', 'owner_org': 'comune', 'tags': []}
+    bucket['4'] = {'name': 'four', 'tags': [{'name': 'energia'}]}
+    del bucket['1']
+    assert _find(tags__name='energia') == ['4']
+    assert _find(owner_org='comune') == ['2', '3']
+
+
+def test_sqlite_index_created_by_other_storage(tmpdir):
+    from harvester.ext.storage.sqlite import SQLiteStorage
+
+    url = 'file://' + str(tmpdir.join('data.sqlite'))
+    storage = SQLiteStorage(url)
+    storage.documents['dataset']['1'] = {'name': 'one'}
+
+    # Indexes added meanwhile are kept up to date by all writers
+    other = SQLiteStorage(url)
+    other.documents['dataset'].create_index('name')
+    storage.documents['dataset']['2'] = {'name': 'two'}
+    with storage.batch():
+        storage.documents['dataset']['3'] = {'name': 'three'}
+
+    for st in (storage, other, SQLiteStorage(url)):
+        bucket = st.documents['dataset']
+        assert [key for key, doc in bucket.find(name='two')] == ['2']
+        assert [key for key, doc in bucket.find(name='three')] == ['3']
+    assert storage._query_one(
+        'SELECT count(*) AS n FROM "_index_document_dataset";')['n'] == 3
+
+
+def test_storage_iter_changed_since(storage):
+    bucket = storage.documents['dataset']
+    assert list(bucket.iter_changed_since(0)) == []
+
+    bucket['a'] = {'id': 'a'}
+    bucket['b'] = {'id': 'b'}
+    storage.blobs['resource']['1'] = 'Hello'
+    changes = list(bucket.iter_changed_since(0))
+    assert [(c.key, c.deleted) for c in changes] == [
+        ('a', False), ('b', False)]
+    assert changes[0].seq < changes[1].seq
+    assert all(c.timestamp > 0 for c in changes)
+    last_seq = changes[-1].seq
+
+    with storage.batch():
+        bucket['b'] = {'id': 'b', 'version': 2}
+        del bucket['a']
+        bucket['c'] = {'id': 'c'}
+
+    changes = list(bucket.iter_changed_since(last_seq))
+    assert [(c.key, c.deleted) for c in changes] == [
+        ('b', False), ('a', True), ('c', False)]
+    assert all(c.seq > last_seq for c in changes)
+
+    # Only the last change for each key is reported
+    assert sorted((c.key, c.deleted)
+                  for c in bucket.iter_changed_since(0)) == [
+        ('a', True), ('b', False), ('c', False)]
+    assert list(bucket.iter_changed_since(changes[-1].seq)) == []
+
+    changes = list(storage.blobs['resource'].iter_changed_since(0))
+    assert [(c.key, c.deleted) for c in changes] == [('1', False)]
+
+
+def test_storage_iter_hashes(storage):
+    from harvester.ext.storage.base import content_hash, document_hash
+
+    bucket = storage.documents['dataset']
+    assert list(bucket.iter_hashes()) == []
+
+    with storage.batch():
+        bucket['b'] = {'id': 'b', 'tags': ['x', 'y']}
+        bucket['a'] = {'id': 'a'}
+        bucket['c'] = {'id': 'c'}
+        del bucket['c']
+    storage.blobs['resource']['1'] = 'Hello'
+    with storage.blobs['resource'].open_write('2') as fp:
+        fp.write('Hello, ')
+        fp.write('world')
+
+    assert list(bucket.iter_hashes()) == [
+        ('a', document_hash({'id': 'a'})),
+        ('b', document_hash({'tags': ['x', 'y'], 'id': 'b'})),
+    ]
+    assert list(storage.blobs['resource'].iter_hashes()) == [
+        ('1', content_hash('Hello')),
+        ('2', content_hash('Hello, world')),
+    ]
+
+    bucket['a'] = {'id': 'a', 'version': 2}
+    assert dict(bucket.iter_hashes())['a'] == \
+        document_hash({'id': 'a', 'version': 2})
+
+
+def test_storage_skip_unchanged(storage):
+    storage.conf['skip_unchanged'] = True
+    bucket = storage.documents['dataset']
+
+    bucket['a'] = {'id': 'a', 'tags': ['x']}
+    bucket['b'] = {'id': 'b'}
+    storage.blobs['resource']['1'] = 'Hello'
+    assert storage.write_stats == {'written': 3, 'skipped': 0}
+    last_seq = max(c.seq for c in bucket.iter_changed_since(0))
+
+    with storage.batch():
+        bucket['a'] = {'tags': ['x'], 'id': 'a'}
+        bucket['b'] = {'id': 'b', 'version': 2}
+        storage.blobs['resource']['1'] = 'Hello'
+    assert storage.write_stats == {'written': 4, 'skipped': 2}
+    assert [c.key for c in bucket.iter_changed_since(last_seq)] == ['b']
+    assert bucket['b'] == {'id': 'b', 'version': 2}
+
+    # Deleted objects are written again
+    del bucket['a']
+    bucket['a'] = {'id': 'a', 'tags': ['x']}
+    assert storage.write_stats == {'written': 5, 'skipped': 2}
+    assert bucket['a'] == {'id': 'a', 'tags': ['x']}
+
+
+def test_sqlite_hashes_computed_when_needed(tmpdir, monkeypatch):
+    from harvester.ext.storage.base import document_hash
+    from harvester.ext.storage.sqlite import (SQLiteStorage,
+                                              SQLiteDocumentBucket)
+
+    hashed = []
+    hash_value = SQLiteDocumentBucket._hash_value.im_func
+
+    def _hash_value(self, value):
+        hashed.append(value)
+        return hash_value(self, value)
+
+    monkeypatch.setattr(SQLiteDocumentBucket, '_hash_value', _hash_value)
+    monkeypatch.setattr(SQLiteDocumentBucket, '_keeps_hashes', False)
+    storage = SQLiteStorage('file://' + str(tmpdir.join('data.sqlite')))
+    bucket = storage.documents['dataset']
+
+    bucket['a'] = {'id': 'a'}
+    assert hashed == []
+
+    # Missing hashes are computed on demand
+    assert list(bucket.iter_hashes()) == [('a', document_hash({'id': 'a'}))]
+
+    storage.conf['skip_unchanged'] = True
+    bucket['a'] = {'id': 'a'}
+    assert storage.write_stats == {'written': 1, 'skipped': 1}
+
+
+def test_storage_get_many_delete_many(storage):
+    bucket = storage.documents['dataset']
+    assert bucket.get_many(['1', '2']) == {}
+    bucket.delete_many(['1', '2'])
+
+    bucket.update_many((str(i), {'id': i}) for i in xrange(1200))
+    storage.blobs['resource']['1'] = 'Hello'
+    storage.blobs['resource']['2'] = 'World'
+
+    keys = [str(i) for i in xrange(0, 1300, 2)]
+    found = bucket.get_many(keys)
+    assert len(found) == 600
+    assert found['42'] == {'id': 42}
+    assert '1200' not in found
+    assert storage.blobs['resource'].get_many(iter(['2', '3', '1'])) == {
+        '1': 'Hello', '2': 'World'}
+
+    last_seq = max(c.seq for c in bucket.iter_changed_since(0))
+    bucket.delete_many(iter(keys))
+    assert len(bucket) == 600
+    assert '42' not in bucket and '43' in bucket
+    deleted = [c for c in bucket.iter_changed_since(last_seq)]
+    assert len(deleted) == 600 and all(c.deleted for c in deleted)
+
+    with storage.batch():
+        storage.blobs['resource'].delete_many(['1', '3'])
+    assert list(storage.blobs['resource']) == ['2']
+
+
+def test_storage_clear_and_staging(storage):
+    bucket = storage.documents['dataset']
+    bucket.create_index('org')
+    bucket.update_many([('a', {'id': 'a', 'org': 'pat'}),
+                        ('b', {'id': 'b', 'org': 'pat'}),
+                        ('c', {'id': 'c', 'org': 'comune'})])
+    last_seq = max(c.seq for c in bucket.iter_changed_since(0))
+
+    with storage.documents.staging('dataset') as staging:
+        staging['a'] = {'id': 'a', 'org': 'pat'}
+        staging['b'] = {'id': 'b', 'org': 'comune'}
+        staging['d'] = {'id': 'd', 'org': 'pat'}
+        assert sorted(bucket) == ['a', 'b', 'c']
+
+    assert sorted(bucket) == ['a', 'b', 'd']
+    assert bucket['b'] == {'id': 'b', 'org': 'comune'}
+    assert list(storage.documents['dataset__staging']) == []
+    assert list(storage.documents) == ['dataset']
+    assert sorted(k for k, doc in bucket.find(org='pat')) == ['a', 'd']
+    assert sorted((c.key, c.deleted)
+                  for c in bucket.iter_changed_since(last_seq)) == [
+        ('b', False), ('c', True), ('d', False)]
+
+    # The original bucket is left alone in case of errors
+    with pytest.raises(ValueError):
+        with storage.documents.staging('dataset') as staging:
+            staging['x'] = {'id': 'x'}
+            raise ValueError('Conversion failed')
+    assert sorted(bucket) == ['a', 'b', 'd']
+    assert list(storage.documents['dataset__staging']) == []
+
+    storage.blobs['resource']['1'] = 'Hello'
+    with storage.blobs['resource'].open_write('2') as fp:
+        fp.write('World')
+    with storage.blobs.staging('resource') as staging:
+        staging['2'] = 'New world'
+    assert storage.blobs['resource'].items() == [('2', 'New world')]
+
+    last_seq = max(c.seq for c in bucket.iter_changed_since(0))
+    bucket.clear()
+    bucket.clear()
+    assert len(bucket) == 0
+    assert list(bucket.find(org='pat')) == []
+    assert sorted((c.key, c.deleted)
+                  for c in bucket.iter_changed_since(last_seq)) == [
+        ('a', True), ('b', True), ('d', True)]
+    bucket['e'] = {'id': 'e', 'org': 'pat'}
+    assert list(bucket.find(org='pat')) == [('e', {'id': 'e', 'org': 'pat'})]
+
+
+def test_storage_keys_page(storage):
+    bucket = storage.documents['dataset']
+    assert bucket.keys_page() == []
+
+    bucket.update_many(('{0:03d}'.format(i), {'id': i}) for i in xrange(120))
+    storage.blobs['resource']['b'] = 'B'
+    storage.blobs['resource']['a'] = 'A'
+
+    pages, after = [], None
+    while True:
+        keys = bucket.keys_page(after=after, limit=50)
+        if not keys:
+            break
+        pages.append(keys)
+        after = keys[-1]
+    assert [len(page) for page in pages] == [50, 50, 20]
+    assert sum(pages, []) == sorted(bucket)
+    assert bucket.keys_page(after='041', limit=2) == ['042', '043']
+    assert bucket.keys_page(after='0415', limit=2) == ['042', '043']
+    assert storage.blobs['resource'].keys_page() == ['a', 'b']
+
+
+def test_storage_stats(storage):
+    assert storage.stats() == {}
+
+    storage.documents['dataset'].update_many(
+        (str(i), {'id': i, 'title': 'Dataset {0}'.format(i)})
+        for i in xrange(20))
+    storage.blobs['resource']['a'] = 'A' * 1000
+    storage.keyvals['meta']['x'] = 'X'
+    storage.flush()
+
+    stats = storage.stats()
+    assert sorted(stats) == [
+        ('blob', 'resource'), ('document', 'dataset'), ('keyval', 'meta')]
+    assert stats['document', 'dataset'].count == 20
+    assert stats['blob', 'resource'].count == 1
+    assert stats['keyval', 'meta'].count == 1
+    # Sizes are approximate (and not known to all the storages)
+    size = stats['blob', 'resource'].size
+    assert size is None or size >= 1000
+
+    for bucket_stats in stats.itervalues():
+        assert bucket_stats.last_modified is None \
+            or abs(bucket_stats.last_modified - time.time()) < 60
+
+    assert sorted(storage.stats(['document'])) == [('document', 'dataset')]
+    assert storage.documents['dataset'].stats() == stats['document', 'dataset']
+
+
+def test_storage_projection(storage):
+    bucket = storage.documents['dataset']
+    bucket['1'] = {
+        'title': 'Dataset 1', 'private': False, 'notes': None,
+        'raw_xml': '<dataset>...</dataset>',
+        'extras': {'source': 'statistica', 'other': 1},
+        'resources': [{'url': 'http://example.com/a.csv', 'format': 'csv'},
+                      {'format': 'json'}, 'not a resource']}
+    bucket['2'] = {'title': 'Dataset 2'}
+
+    assert bucket.get('1', fields=['title', 'private', 'notes']) == {
+        'title': 'Dataset 1', 'private': False, 'notes': None}
+    assert bucket.get('1', fields=['extras.source', 'resources.url']) == {
+        'extras': {'source': 'statistica'},
+        'resources': [{'url': 'http://example.com/a.csv'}, {}]}
+    assert bucket.get('1', fields=['extras', 'extras.other']) == {
+        'extras': {'source': 'statistica', 'other': 1}}
+    assert bucket.get('2', fields=['missing', 'title.missing']) == {}
+    assert bucket.get('3', fields=['title']) is None
+    assert bucket.get('3', 'default', fields=['title']) == 'default'
+    assert storage.documents['other'].get('1', fields=['title']) is None
+    assert bucket.get('2') == {'title': 'Dataset 2'}
+
+    assert sorted(bucket.iter_items(fields=['title'])) == [
+        ('1', {'title': 'Dataset 1'}), ('2', {'title': 'Dataset 2'})]
+
+    storage.keyvals['meta']['x'] = {'a': 1}
+    with pytest.raises(ValueError):
+        list(storage.keyvals['meta'].iter_items(fields=['a']))
+
+
+def test_sqlite_projection_compressed(tmpdir):
+    from harvester.ext.storage.sqlite import SQLiteStorage
+
+    url = 'file://' + str(tmpdir.join('example.sqlite'))
+    SQLiteStorage(url).documents['dataset']['1'] = {'title': 'Plain'}
+    storage = SQLiteStorage(url, conf={'document_codec': 'zlib'})
+    storage.documents['dataset']['2'] = {'title': 'Compressed', 'x': 1}
+
+    # Compressed documents can't be looked into by SQLite
+    assert dict(storage.documents['dataset'].iter_items(fields=['title'])) \
+        == {'1': {'title': 'Plain'}, '2': {'title': 'Compressed'}}
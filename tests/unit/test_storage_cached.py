@@ -0,0 +1,85 @@
+from harvester.ext.storage.cached import CachedStorage, LRUCache
+from harvester.utils import get_storage_direct
+
+
+def test_cached_storage(tmpdir):
+    url = 'jsondir+file://' + str(tmpdir.join('data'))
+    storage = get_storage_direct('cached+' + url, {'cache_size': 1000})
+    assert isinstance(storage, CachedStorage)
+
+    with storage.batch():
+        storage.documents['dataset']['1'] = {'title': 'Hello'}
+        storage.blobs['resource']['1'] = 'A' * 600
+        storage.blobs['resource']['2'] = 'B' * 600
+        storage.info['name'] = 'Example'
+
+    # Writes go straight to the wrapped storage
+    backend = get_storage_direct(url)
+    assert backend.documents['dataset']['1'] == {'title': 'Hello'}
+    assert backend.info['name'] == 'Example'
+
+    assert storage.documents['dataset']['1'] == {'title': 'Hello'}
+    obj = storage.documents['dataset']['1']
+    obj['title'] = 'Changed'  # Must not affect the cached copy
+    assert storage.documents['dataset']['1'] == {'title': 'Hello'}
+    stats = storage.cache_stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+
+    # Eviction by size
+    assert storage.blobs['resource']['1'] == 'A' * 600
+    assert storage.blobs['resource']['2'] == 'B' * 600
+    stats = storage.cache_stats()
+    assert stats['evictions'] == 2
+    assert stats['size'] == 600
+    assert storage.blobs['resource'].open_read('2').read() == 'B' * 600
+    assert storage.cache_stats()['hits'] == 3
+
+    # Writes drop cached copies
+    storage.documents['dataset']['1'] = {'title': 'Updated'}
+    assert storage.documents['dataset']['1'] == {'title': 'Updated'}
+    with storage.blobs['resource'].open_write('2') as fp:
+        fp.write('C')
+    assert storage.blobs['resource']['2'] == 'C'
+    del storage.blobs['resource']['2']
+    assert '2' not in storage.blobs['resource']
+
+    assert list(storage.documents) == ['dataset']
+    assert sorted(storage.blobs['resource']) == ['1']
+
+    # The cache is shared by storages wrapping the same url, with
+    # the same cache size
+    other = get_storage_direct('cached+' + url, {'cache_size': 1000})
+    assert other.documents['dataset']['1'] == {'title': 'Updated'}
+    assert other.cache_stats()['hits'] == storage.cache_stats()['hits']
+    bigger = get_storage_direct('cached+' + url, {'cache_size': 5000})
+    assert bigger.cache_stats()['max_size'] == 5000
+    assert bigger.cache_stats()['count'] == 0
+
+    storage.flush_storage()
+    assert storage.cache_stats()['count'] == 0
+    assert list(storage.documents) == []
+
+
+def test_lru_cache():
+    cache = LRUCache(10)
+    cache.put('a', 'aaa')
+    cache.put('b', 'bbb')
+    cache.put('c', 'ccc')
+    assert cache.get('a') == 'aaa'  # Now the most recently used
+    cache.put('d', 'ddd')  # Evicts 'b'
+    assert cache.get('b', None) is None
+    assert [cache.get(k) for k in 'acd'] == ['aaa', 'ccc', 'ddd']
+    assert cache.size == 9
+
+    cache.put('c', 'c')  # Replaced
+    cache.discard('a')
+    assert cache.size == 4
+    cache.put('e', 'eeeeee')
+    assert cache.stats()['evictions'] == 1
+    assert [cache.get(k, None) for k in 'acde'] == [
+        None, 'c', 'ddd', 'eeeeee']
+
+    cache.clear()
+    assert (cache.size, cache.stats()['count']) == (0, 0)
+    cache.put('f', 'f')
+    assert cache.get('f') == 'f'
@@ -0,0 +1,52 @@
+from harvester.ext.storage.cas import REF_MAGIC
+from harvester.ext.storage.sqlite import SQLiteStorage
+
+
+def test_content_addressed_blobs(tmpdir):
+    blob_store = 'jsondir+file://' + str(tmpdir.join('blobs'))
+
+    run1 = SQLiteStorage('file://' + str(tmpdir.join('run1.sqlite')),
+                         conf={'blob_store': blob_store})
+    run2 = SQLiteStorage('file://' + str(tmpdir.join('run2.sqlite')),
+                         conf={'blob_store': blob_store})
+
+    run1.blobs['resource']['1'] = 'Same data'
+    run1.blobs['resource']['2'] = 'Other data'
+    with run2.blobs['resource'].open_write('1') as fp:
+        fp.write('Same ')
+        fp.write('data')
+
+    assert run1.blobs['resource']['1'] == 'Same data'
+    assert run1.blobs['resource']['2'] == 'Other data'
+    assert run2.blobs['resource']['1'] == 'Same data'
+    assert run2.blobs['resource'].open_read('1').read() == 'Same data'
+    assert sorted(run1.blobs['resource']) == ['1', '2']
+    assert list(run1.blobs) == ['resource']
+
+    # Identical contents are stored only once
+    contents = run1._cached_blob_store.blobs['sha256']
+    assert len(contents) == 2
+
+    # Buckets only contain references
+    raw = SQLiteStorage(run1.url)
+    assert raw.blobs['resource']['1'].startswith(REF_MAGIC)
+
+    # Blobs stored before enabling the blob store are still readable
+    raw.blobs['resource']['3'] = 'Legacy data'
+    assert run1.blobs['resource']['3'] == 'Legacy data'
+    assert dict(run1.blobs['resource'].iteritems()) == {
+        '1': 'Same data', '2': 'Other data', '3': 'Legacy data'}
+    assert run1.blobs['resource'].get_many(['1', '3', '4']) == {
+        '1': 'Same data', '3': 'Legacy data'}
+
+    # ..even if they look like a reference
+    raw.blobs['resource']['4'] = REF_MAGIC + 'Legacy data'
+    assert run1.blobs['resource']['4'] == REF_MAGIC + 'Legacy data'
+    assert run1.blobs['resource'].open_read('4').read() == \
+        REF_MAGIC + 'Legacy data'
+    del raw.blobs['resource']['4']
+
+    # Deleting a reference keeps contents
+    del run1.blobs['resource']['1']
+    assert '1' not in run1.blobs['resource']
+    assert run2.blobs['resource']['1'] == 'Same data'
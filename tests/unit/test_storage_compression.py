@@ -0,0 +1,113 @@
+import io
+
+import pytest
+
+from harvester.ext.storage import compression
+
+
+class _Output(io.BytesIO):
+    def close(self):
+        self.result = self.getvalue()
+        super(_Output, self).close()
+
+
+@pytest.fixture(params=sorted(compression.CODECS))
+def codec_name(request):
+    return request.param
+
+
+def test_encode_decode(codec_name):
+    data = 'Hello, world! ' * 100
+    encoded = compression.encode(data, codec_name)
+    assert encoded.startswith(compression.MAGIC)
+    assert len(encoded) < len(data)
+    assert compression.decode(encoded) == data
+
+    # Untagged data is returned as-is
+    assert compression.encode(data, None) == data
+    assert compression.decode(data) == data
+    assert compression.decode('') == ''
+
+
+@pytest.mark.parametrize('data', [
+    '\x00HV', '\x00HVC', '\x00HVCz', '\x00HVC-', '\x00HVC-x', '\x00HVREF'])
+def test_escape_raw_data(data):
+    # Plain data looking like a header is tagged as raw
+    encoded = compression.encode(data, None)
+    assert encoded == compression.RAW_HEADER + data
+    assert compression.decode(encoded) == data
+    assert compression.DecodingReader(io.BytesIO(encoded)).read() == data
+
+    out = _Output()
+    with compression.wrap_writer(out, None) as fp:
+        for char in data:
+            fp.write(char)
+    assert out.result == encoded
+
+    out = _Output()
+    with compression.wrap_writer(out, None) as fp:
+        fp.write('\x00H')
+        fp.write('ello')
+    assert out.result == '\x00Hello'
+
+
+def test_unsupported_codec():
+    with pytest.raises(ValueError):
+        compression.encode('Hello', 'foobar')
+
+
+def test_streaming(codec_name):
+    data = ''.join('Line {0}\n'.format(i) for i in xrange(10000))
+
+    out = _Output()
+    with compression.wrap_writer(out, codec_name) as fp:
+        for i in xrange(0, len(data), 1000):
+            fp.write(data[i:i + 1000])
+    assert compression.decode(out.result) == data
+
+    reader = compression.DecodingReader(io.BytesIO(out.result))
+    assert reader.read(10) == data[:10]
+    assert reader.read() == data[10:]
+
+    reader = compression.DecodingReader(io.BytesIO(data))
+    assert reader.read(5) == data[:5]
+    assert reader.read() == data[5:]
+
+
+@pytest.mark.parametrize('storage_type', ['sqlite', 'memory', 'jsondir'])
+def test_compressed_storage(storage_type, tmpdir, codec_name):
+    from harvester.ext.storage.jsondir import JsonDirStorage
+    from harvester.ext.storage.memory import MemoryStorage
+    from harvester.ext.storage.sqlite import SQLiteStorage
+
+    storage_class, url = {
+        'sqlite': (SQLiteStorage, 'file://' + str(tmpdir.join('db.sqlite'))),
+        'memory': (MemoryStorage, None),
+        'jsondir': (JsonDirStorage, 'file://' + str(tmpdir)),
+    }[storage_type]
+
+    # Data stored without compression must stay readable
+    storage = storage_class(url)
+    storage.documents['dataset']['1'] = {'title': 'Uncompressed'}
+    storage.blobs['resource']['1'] = 'Uncompressed'
+
+    storage = storage_class(url, conf={
+        'codec': codec_name, 'document_codec': codec_name})
+    if storage_type == 'memory':
+        storage.documents['dataset']['1'] = {'title': 'Uncompressed'}
+        storage.blobs['resource']['1'] = 'Uncompressed'
+
+    storage.documents['dataset']['2'] = {'title': 'Compressed ' * 100}
+    storage.blobs['resource']['2'] = '\x00\xff' * 1000
+    with storage.blobs['resource'].open_write('3') as fp:
+        fp.write('Streamed ' * 1000)
+
+    assert storage.documents['dataset']['1'] == {'title': 'Uncompressed'}
+    assert storage.documents['dataset']['2'] == {'title': 'Compressed ' * 100}
+    assert storage.blobs['resource']['1'] == 'Uncompressed'
+    assert storage.blobs['resource']['2'] == '\x00\xff' * 1000
+    assert storage.blobs['resource']['3'] == 'Streamed ' * 1000
+
+    with storage.blobs['resource'].open_read('3') as fp:
+        assert fp.read(9) == 'Streamed '
+        assert fp.read() == 'Streamed ' * 999
@@ -0,0 +1,141 @@
+import gc
+import multiprocessing
+import os
+
+from harvester.ext.storage import connections
+from harvester.ext.storage.connections import ConnectionRegistry
+from harvester.ext.storage.sqlite import SQLiteStorage
+
+
+class Owner(object):
+    pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.healthy = True
+        self.closed = False
+        self.resets = 0
+
+
+def _connect():
+    return FakeConnection()
+
+
+def _check(conn):
+    return conn.healthy
+
+
+def _reset(conn):
+    conn.resets += 1
+
+
+def _close(conn):
+    conn.closed = True
+
+
+def _acquire(registry, owner, key='a', **kw):
+    return registry.acquire(owner, key, _connect, check=_check,
+                            reset=_reset, close=_close, **kw)
+
+
+def test_exclusive_connections():
+    registry = ConnectionRegistry()
+    first, second = Owner(), Owner()
+    conn1 = _acquire(registry, first)
+    conn2 = _acquire(registry, second)
+    assert conn1 is not conn2
+    assert registry.get_info() == {'a': (2, 0)}
+
+    # Connections are reused once their owner is gone
+    del first
+    gc.collect()
+    assert registry.get_info() == {'a': (1, 1)}
+    assert conn1.resets == 1
+    third = Owner()
+    assert _acquire(registry, third) is conn1
+    assert _acquire(registry, Owner(), key='b') is not conn1
+
+    registry.close_all()
+    assert not conn1.closed
+    del second, third
+    registry.close_all()
+    assert conn1.closed and conn2.closed
+    assert registry.get_info() == {}
+
+
+def test_shared_connections():
+    registry = ConnectionRegistry()
+    first, second = Owner(), Owner()
+    conn = _acquire(registry, first, shared=True)
+    assert _acquire(registry, second, shared=True) is conn
+    assert registry.get_info() == {'a': (1, 0)}
+
+    del first, second
+    assert registry.get_info() == {'a': (0, 1)}
+    assert conn.resets == 0
+    assert _acquire(registry, Owner(), shared=True) is conn
+
+
+def test_idle_connections(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(connections.time, 'time', lambda: now[0])
+    registry = ConnectionRegistry(max_idle=300, check_interval=30)
+
+    conn = _acquire(registry, Owner())
+    now[0] += 10
+    assert _acquire(registry, Owner()) is conn
+
+    # Broken connections are replaced, once checked
+    conn.healthy = False
+    assert _acquire(registry, Owner()) is conn
+    now[0] += 60
+    other = _acquire(registry, Owner())
+    assert other is not conn and conn.closed
+
+    # Unused connections get closed
+    now[0] += 300
+    registry.collect()
+    assert other.closed
+    assert registry.get_info() == {}
+
+
+def _write_from_child(storage):
+    storage.documents['dataset']['2'] = {'id': 2}
+    return os.getpid(), connections.registry.get_info().values()
+
+
+def test_sqlite_storage_connections(tmpdir):
+    url = 'file://' + str(tmpdir.join('data.sqlite'))
+    storage = SQLiteStorage(url)
+    storage.documents['dataset']['0'] = {'id': 0}
+    conn = storage._connection
+
+    # Instances in use get their own connection, the following ones
+    # reuse it
+    other = SQLiteStorage(url)
+    assert other._connection is not conn
+    del storage
+    gc.collect()
+    assert SQLiteStorage(url)._connection is conn
+    assert SQLiteStorage(url, {'read_only': True})._connection is not conn
+
+    # Writes left pending are rolled back
+    storage = SQLiteStorage(url)
+    storage.documents['dataset']['1'] = {'id': 1}
+    storage._batch_depth = 1  # As in a batch() block never exited
+    storage.documents['dataset']['2'] = {'id': 2}
+    del storage
+    gc.collect()
+    assert list(SQLiteStorage(url).documents['dataset']) == ['0', '1']
+
+    # Connections are not inherited by forked processes
+    pool = multiprocessing.Pool(1)
+    try:
+        pid, info = pool.apply(_write_from_child, (other,))
+    finally:
+        pool.close()
+        pool.join()
+    assert pid != os.getpid()
+    assert info == [(1, 0)]
+    assert len(other.documents['dataset']) == 3
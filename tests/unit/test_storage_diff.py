@@ -0,0 +1,43 @@
+from harvester.ext.storage.diff import (BucketDiff, diff_buckets,
+                                        diff_storages, iter_hash_diff)
+from harvester.ext.storage.memory import MemoryStorage
+from harvester.ext.storage.sqlite import SQLiteStorage
+
+
+def test_iter_hash_diff():
+    old = [('a', '1'), ('b', '2'), ('d', '4')]
+    new = [('b', '2'), ('c', '3'), ('d', '5'), ('e', '6')]
+    assert list(iter_hash_diff(old, new)) == [
+        ('removed', 'a'), ('added', 'c'), ('changed', 'd'), ('added', 'e')]
+    assert list(iter_hash_diff(old, old)) == []
+    assert list(iter_hash_diff([], new)) == [('added', k) for k, h in new]
+
+
+def test_diff_storages(tmpdir):
+    old = SQLiteStorage('file://' + str(tmpdir.join('old.sqlite')))
+    new = MemoryStorage()
+
+    with old.batch():
+        for i in xrange(1200):
+            old.documents['dataset'][str(i)] = {'id': i, 'tags': ['x']}
+        old.documents['group']['1'] = {'name': 'Group'}
+        old.blobs['resource']['1'] = 'Hello'
+    with new.batch():
+        for i in xrange(1, 1201):
+            new.documents['dataset'][str(i)] = {'tags': ['x'], 'id': i}
+        new.documents['dataset']['42'] = {'id': 42, 'tags': ['y']}
+        new.blobs['resource']['1'] = 'Hello'
+        new.keyvals['info']['name'] = 'Example'
+
+    assert diff_buckets(old.documents['dataset'],
+                        new.documents['dataset']) == BucketDiff(
+        added=['1200'], removed=['0'], changed=['42'])
+
+    assert diff_storages(old, new) == {
+        ('document', 'dataset'): BucketDiff(['1200'], ['0'], ['42']),
+        ('document', 'group'): BucketDiff([], ['1'], []),
+        ('blob', 'resource'): BucketDiff([], [], []),
+        ('keyval', 'info'): BucketDiff(['name'], [], []),
+    }
+    assert diff_storages(old, new, bucket_types=['blob']).keys() == [
+        ('blob', 'resource')]
@@ -0,0 +1,81 @@
+"""
+Run the MongoDB storage against mongomock, so that its code gets
+exercised even when no MongoDB server is available (see MONGO_URL
+in conftest.py for the full test suite).
+"""
+
+import pytest
+
+from harvester.ext.storage import mongodb
+from harvester.ext.storage.base import NotFound
+
+mongomock = pytest.importorskip('mongomock')
+
+MONGO_URL = 'mongodb://localhost/test_harvester/mongomock'
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setattr(mongodb, 'MongoClient', mongomock.MongoClient)
+    st = mongodb.MongodbStorage(MONGO_URL)
+    st.flush_storage()
+    return st
+
+
+def _get_counter(storage):
+    return storage._get_collection('_counters').find_one('changes')['seq']
+
+
+def test_documents(storage):
+    bucket = storage.documents['dataset']
+    for i in xrange(10):
+        bucket[str(i)] = {'id': i, 'title': 'Dataset {0}'.format(i)}
+    assert bucket['3'] == {'id': 3, 'title': 'Dataset 3'}
+
+    del bucket['3']
+    with pytest.raises(NotFound):
+        bucket['3']
+
+    changes = list(bucket.iter_changed_since())
+    assert [c.key for c in changes] == [str(i) for i in xrange(10)
+                                        if i != 3] + ['3']
+    assert changes[-1].deleted
+    assert [c.seq for c in changes] == range(1, 4) + range(5, 12)
+    assert [c.key for c in bucket.iter_changed_since(10)] == ['3']
+
+
+def test_batch_writes(storage):
+    with storage.batch():
+        for i in xrange(10):
+            storage.documents['dataset'][str(i)] = {'id': i}
+        storage.documents['dataset']['1'] = {'id': 1, 'updated': True}
+        del storage.documents['dataset']['2']
+        assert storage._pending_count == 12
+
+    assert storage._pending_count == 0
+    bucket = storage.documents['dataset']
+    assert bucket['1'] == {'id': 1, 'updated': True}
+    with pytest.raises(NotFound):
+        bucket['2']
+    changes = list(bucket.iter_changed_since())
+    assert sorted(c.key for c in changes) == [str(i) for i in xrange(10)]
+    assert [c.seq for c in changes] == range(1, 11)
+
+
+def test_seq_order(storage):
+    bucket = storage.documents['dataset']
+    with storage.batch():
+        for i in xrange(10):
+            bucket[str(i)] = {'id': i}
+
+    # A single counter increment per flush
+    assert _get_counter(storage) == 10
+
+    # Writes from other instances always get following numbers, so
+    # readers resuming from the last seq they saw miss nothing
+    other = mongodb.MongodbStorage(MONGO_URL)
+    other.documents['dataset']['a'] = {'id': 'a'}
+    bucket['b'] = {'id': 'b'}
+    assert [(c.key, c.seq) for c in bucket.iter_changed_since(10)] == [
+        ('a', 11), ('b', 12)]
+    assert _get_counter(storage) == 12
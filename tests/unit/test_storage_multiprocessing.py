@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import pickle
+
+import pytest
+
+from harvester.ext.storage.jsondir import JsonDirStorage
+from harvester.ext.storage.sqlite import SQLiteStorage
+
+
+WORKERS = 4
+OBJECTS_PER_WORKER = 200
+
+
+def _write_objects(args):
+    storage, worker = args
+    with storage.batch():
+        for i in xrange(OBJECTS_PER_WORKER):
+            key = '{0}-{1}'.format(worker, i)
+            storage.documents['dataset'][key] = {'worker': worker, 'i': i}
+    storage.blobs['resource'][str(worker)] = 'Worker {0}'.format(worker)
+    return os.getpid()
+
+
+@pytest.fixture(params=['sqlite', 'jsondir'])
+def shared_storage(request, tmpdir):
+    if request.param == 'sqlite':
+        return SQLiteStorage('file://' + str(tmpdir.join('data.sqlite')),
+                             conf={'batch_size': 50})
+    return JsonDirStorage('file://' + str(tmpdir.join('data')))
+
+
+def test_pickled_storage(shared_storage):
+    shared_storage.documents['dataset']['1'] = {'id': 1}
+    copy = pickle.loads(pickle.dumps(shared_storage))
+    assert copy.documents['dataset']['1'] == {'id': 1}
+
+
+def test_concurrent_writer_processes(shared_storage):
+    # Use the storage before forking, so that workers inherit
+    # its (open) connection
+    shared_storage.info['workers'] = WORKERS
+
+    pool = multiprocessing.Pool(WORKERS)
+    try:
+        pids = pool.map(_write_objects,
+                        [(shared_storage, w) for w in xrange(WORKERS)],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    assert os.getpid() not in pids
+
+    bucket = shared_storage.documents['dataset']
+    assert len(bucket) == WORKERS * OBJECTS_PER_WORKER
+    assert bucket['3-199'] == {'worker': 3, 'i': 199}
+    assert sorted(shared_storage.blobs['resource']) == ['0', '1', '2', '3']
+    assert shared_storage.info['workers'] == WORKERS
+
+
+def test_forked_process_reconnects(tmpdir):
+    storage = SQLiteStorage('file://' + str(tmpdir.join('data.sqlite')))
+    storage.documents['dataset']['parent'] = {'id': 'parent'}
+    parent_connection = storage._connection
+
+    def _child():
+        assert storage._connection is not parent_connection
+        storage.documents['dataset']['child'] = {'id': 'child'}
+
+    process = multiprocessing.Process(target=_child)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    assert storage._connection is parent_connection
+    assert sorted(storage.documents['dataset']) == ['child', 'parent']
@@ -0,0 +1,91 @@
+from harvester.ext.storage.memory import MemoryStorage
+from harvester.ext.storage.search import (SearchIndex, extract_text,
+                                          prepare_query)
+from harvester.ext.storage.sqlite import SQLiteStorage
+
+
+def test_extract_text():
+    doc = {'title': 'Consumo energia', 'year': 2015, 'private': False,
+           'tags': [{'name': 'energia'}, {'name': 'trasporti'}]}
+    assert sorted(extract_text(doc).split('\n')) == [
+        '2015', 'Consumo energia', 'energia', 'trasporti']
+    assert prepare_query(u'energia tras*  "x') == u'"energia" "tras"* """x"'
+    assert prepare_query(u' * ') == u''
+
+
+def test_search_index(storage, tmpdir):
+    bucket = storage.documents['dataset']
+    bucket.update_many(
+        (str(i), {'title': 'Dataset {0}'.format(i),
+                  'tags': ['energia' if i % 2 else 'trasporti']})
+        for i in xrange(1200))
+
+    index = SearchIndex(str(tmpdir.join('search', 'index.sqlite')))
+    results = index.search(bucket, 'dataset 42')
+    assert results == [(u'42', u'[Dataset] [42] trasporti')]
+    assert len(index.search(bucket, 'energia', limit=1000)) == 600
+    assert len(index.search(bucket, 'ener*', limit=1000)) == 600
+    assert index.search(bucket, 'nothing') == []
+    assert index.search(bucket, '') == []
+
+    # Changes are picked up on the next search
+    bucket['42'] = {'title': 'Dataset 42', 'tags': ['energia', 'nuovo']}
+    del bucket['43']
+    assert index.update(bucket) == 2
+    assert index.update(bucket) == 0
+    assert [key for key, snippet in index.search(bucket, 'nuovo')] == ['42']
+    assert len(index.search(bucket, 'energia', limit=1000)) == 600
+    bucket['1200'] = {'title': 'Dataset 1200', 'tags': ['nuovo']}
+    assert index.update(bucket) == 1
+    assert sorted(key for key, snippet in index.search(bucket, 'nuovo')) \
+        == ['1200', '42']
+
+    # The index survives reopening
+    index.close()
+    index = SearchIndex(str(tmpdir.join('search', 'index.sqlite')))
+    assert index.update(bucket) == 0
+    assert index.rebuild(bucket) == 1201  # Deletions included
+    assert len(index.search(bucket, 'nuovo')) == 2
+
+
+def test_search_index_memory_storage(tmpdir):
+    storage = MemoryStorage()
+    storage.documents['dataset']['a'] = {'title': u'Qualit\xe0 aria'}
+    storage.documents['other']['a'] = {'title': u'Acqua'}
+
+    index = SearchIndex(str(tmpdir.join('index.sqlite')))
+    assert index.search(storage.documents['dataset'], u'qualit\xe0') == [
+        (u'a', u'[Qualit\xe0] aria')]
+    assert index.search(storage.documents['other'], u'aria') == []
+
+
+def test_search_index_recreated_storage(tmpdir):
+    def _create_storage(name):
+        storage = SQLiteStorage('file://' + str(tmpdir.join(name)))
+        return storage.documents['dataset']
+
+    bucket = _create_storage('data.sqlite')
+    for i in xrange(5):
+        bucket['k{0}'.format(i)] = {'title': 'alpha'}
+
+    index = SearchIndex(str(tmpdir.join('index.sqlite')))
+    assert len(index.search(bucket, 'alpha')) == 5
+
+    # Updated objects supersede the last indexed change
+    bucket['k4'] = {'title': 'alpha gamma'}
+    bucket['k5'] = {'title': 'alpha'}
+    assert index.update(bucket) == 2
+    assert index.update(bucket) == 0
+
+    # Sequence numbers restart in a new storage, with fewer changes..
+    bucket = _create_storage('new.sqlite')
+    bucket['n0'] = {'title': 'beta'}
+    assert index.search(bucket, 'beta') == [(u'n0', u'[beta]')]
+    assert index.search(bucket, 'alpha') == []
+
+    # ..or more of them
+    bucket = _create_storage('newer.sqlite')
+    bucket.update_many(
+        ('m{0}'.format(i), {'title': 'delta'}) for i in xrange(10))
+    assert len(index.search(bucket, 'delta')) == 10
+    assert index.search(bucket, 'beta') == []
@@ -0,0 +1,57 @@
+from harvester.ext.storage.sharded import HashRing, ShardedStorage
+from harvester.utils import get_storage_direct
+
+
+def test_hash_ring():
+    keys = [str(i) for i in xrange(2000)]
+    ring = HashRing(['a', 'b', 'c'])
+    owners = dict((key, ring.get_node(key)) for key in keys)
+    assert set(owners.itervalues()) == set(['a', 'b', 'c'])
+
+    # Adding a node only moves keys to the new node
+    bigger = HashRing(['c', 'b', 'a', 'd'])
+    moved = [key for key in keys if bigger.get_node(key) != owners[key]]
+    assert all(bigger.get_node(key) == 'd' for key in moved)
+    assert 200 < len(moved) < 800
+
+
+def test_sharded_storage(tmpdir):
+    urls = ['sqlite+file://' + str(tmpdir.join('{0}.sqlite'.format(i)))
+            for i in xrange(3)]
+    storage = get_storage_direct('sharded+' + '|'.join(urls))
+    assert isinstance(storage, ShardedStorage)
+
+    bucket = storage.documents['dataset']
+    with storage.batch():
+        bucket['first'] = {'id': 'first'}
+        bucket.update_many((str(i), {'id': i}) for i in xrange(600))
+        storage.blobs['resource']['1'] = 'Hello'
+        storage.info['name'] = 'Example'
+
+    assert len(bucket) == 601
+    assert sorted(bucket) == sorted(['first'] + [str(i) for i in xrange(600)])
+    assert bucket['42'] == {'id': 42}
+    assert 'first' in bucket and '600' not in bucket
+    assert [k for k, h in bucket.iter_hashes()] == sorted(bucket)
+    assert list(storage.documents) == ['dataset']
+    assert storage.blobs['resource']['1'] == 'Hello'
+    assert storage.info['name'] == 'Example'
+    assert storage.write_stats['written'] == 602
+
+    # Keys are spread across all the shards
+    counts = [len(get_storage_direct(url).documents['dataset'])
+              for url in urls]
+    assert sum(counts) == 601
+    assert all(count > 100 for count in counts)
+    shard = storage.shards[storage.get_shard_index('42')]
+    assert shard.documents['dataset']['42'] == {'id': 42}
+
+    del bucket['42']
+    assert '42' not in bucket
+    assert len(bucket) == 600
+
+    found = bucket.get_many(str(i) for i in xrange(40, 50))
+    assert sorted(found) == ['40', '41', '43', '44', '45', '46', '47',
+                             '48', '49']
+    bucket.delete_many(found)
+    assert len(bucket) == 591
@@ -0,0 +1,60 @@
+from harvester.ext.storage.jsondir import JsonDirStorage
+from harvester.ext.storage.sqlite import SQLiteStorage
+from harvester.ext.storage.transfer import copy_storage, STATE_BUCKET
+
+
+def _fill_storage(storage):
+    with storage.batch():
+        for i in xrange(1200):
+            storage.documents['dataset'][str(i)] = {'id': i}
+        storage.documents['group']['1'] = {'name': 'Group'}
+        storage.keyvals['info']['name'] = 'Example'
+        storage.blobs['resource']['1'] = 'Hello, world'
+        storage.blobs['resource']['2'] = '\x00\xff' * 100000
+
+
+def test_copy_storage(tmpdir, storage):
+    source = SQLiteStorage('file://' + str(tmpdir.join('source.sqlite')))
+    _fill_storage(source)
+
+    copied = copy_storage(source, storage, jobs=2)
+    assert sorted(copied) == [
+        ('blob', 'resource', 2),
+        ('document', 'dataset', 1200),
+        ('document', 'group', 1),
+        ('keyval', 'info', 1),
+    ]
+
+    assert len(storage.documents['dataset']) == 1200
+    assert storage.documents['dataset']['42'] == {'id': 42}
+    assert storage.documents['group']['1'] == {'name': 'Group'}
+    assert storage.info['name'] == 'Example'
+    assert storage.blobs['resource']['2'] == '\x00\xff' * 100000
+    assert len(storage.keyvals[STATE_BUCKET]) == 4
+
+
+def test_copy_storage_resume(tmpdir):
+    source = JsonDirStorage('file://' + str(tmpdir.join('source')))
+    _fill_storage(source)
+    dest = SQLiteStorage('file://' + str(tmpdir.join('dest.sqlite')))
+
+    # Simulate an interrupted copy
+    dest.documents['group']['1'] = {'name': 'Old group'}
+    dest.keyvals[STATE_BUCKET][u'document/group'] = True
+    dest.documents['dataset']['1'] = {'id': 'old'}
+
+    copied = copy_storage(source, dest, jobs=3, resume=True)
+    assert sorted(copied) == [
+        ('blob', 'resource', 2),
+        ('document', 'dataset', 1199),
+        ('keyval', 'info', 1),
+    ]
+    assert dest.documents['group']['1'] == {'name': 'Old group'}
+    assert dest.documents['dataset']['1'] == {'id': 'old'}
+    assert len(dest.documents['dataset']) == 1200
+
+    # Without resume, everything is copied again
+    copied = copy_storage(source, dest)
+    assert len(copied) == 4
+    assert dest.documents['group']['1'] == {'name': 'Group'}
+    assert dest.documents['dataset']['1'] == {'id': 1}